@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Denis Vesnin, https://github.com/aeromg'
+
+import sys
+import time
+import argparse
+from threading import Thread, Lock, Event
+
+from parking import ParkingClient, ParkingMonitor, ParkingMonitorNotifier, CompactReservation, \
+    NotifyBackend, NotifyMessageFormatter, RemainStageNotifyFilter
+from fakeserver import FakeParkingState, FakeParkingServer
+
+
+BENCHMARK_EMAIL = 'benchmark@domain.tld'
+BENCHMARK_PASSWORD = 'password'
+
+# every request must reach the server
+BENCHMARK_CACHE_TTLS = {'reservations': 0, 'balance': 0}
+
+
+class SyntheticParkingClient(ParkingClient):
+    ZONES = 100
+
+    def __init__(self, size):
+        super(SyntheticParkingClient, self).__init__()
+
+        self._size = size
+        self._tick = 0
+
+    def _create_reservation(self, index):
+        remaining_minutes = 5 + (index * 7 + self._tick) % 240
+        return CompactReservation.from_json({
+            u'id': index,
+            u'renewed': False,
+            u'vrp': u'A{0:06d}BC59'.format(index),
+            u'zoneNumber': 100 + index % SyntheticParkingClient.ZONES,
+            u'start': 1474000000000,
+            u'end': 1474000000000 + remaining_minutes * 60000,
+            u'remainingTime': remaining_minutes * 60000,
+            u'vehicleType': ParkingClient.VEHICLE_TYPE_CAR,
+            u'accountId': 1
+        })
+
+    def get_reservations(self):
+        self._tick += 1
+        # every poll one reservation ends and one starts
+        return [self._create_reservation(index) for index in xrange(self._tick, self._tick + self._size)]
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def benchmark_measure_one_shot(size, polls):
+    client = SyntheticParkingClient(size)
+    monitor = ParkingMonitor(client=client)
+    monitor.measure_one_shot()
+
+    # reservations are built outside of the measured diff
+    samples = []
+    for _ in xrange(polls):
+        reservations = client.get_reservations()
+        started = time.time()
+        monitor._apply_reservations(reservations)
+        samples.append(time.time() - started)
+
+    return samples
+
+
+def benchmark_remain_filter(size, rounds):
+    remain_filter = RemainStageNotifyFilter()
+    for stage in (5, 15, 30, 60, 120):
+        remain_filter.add_remain_stage(stage)
+
+    keys = [(u'A{0:06d}BC59'.format(index), 100 + index % SyntheticParkingClient.ZONES, index * 7 % 240)
+            for index in xrange(size)]
+
+    # one sample is the mean cost of a remain event while size reservations count down
+    samples = []
+    for tick in xrange(rounds):
+        started = time.time()
+        for vehicle, zone, offset in keys:
+            remain_filter.remain_filter(vehicle=vehicle, zone=zone, remain=(offset - tick) % 240)
+        samples.append((time.time() - started) / size)
+
+    return samples
+
+
+class BenchmarkFormatter(NotifyMessageFormatter):
+    def get_new_reservation_message(self, vehicle, zone):
+        return 'new {0} {1}'.format(vehicle, zone)
+
+    def get_remove_reservation_message(self, vehicle, zone):
+        return 'remove {0} {1}'.format(vehicle, zone)
+
+    def get_remain_message(self, vehicle, zone, remain):
+        return 'remain {0} {1} {2}'.format(vehicle, zone, remain)
+
+
+class TimestampNotifyBackend(NotifyBackend):
+    def __init__(self):
+        super(TimestampNotifyBackend, self).__init__()
+
+        self._lock = Lock()
+        self._received = {}  # text -> time
+        self._events = {}  # text -> Event
+
+    def expect(self, text):
+        with self._lock:
+            self._events[text] = Event()
+
+    def wait(self, text, timeout):
+        if not self._events[text].wait(timeout):
+            raise Exception('No notification "{0}" in {1} s'.format(text, timeout))
+
+        return self._received[text]
+
+    def send(self, text):
+        with self._lock:
+            self._received[text] = time.time()
+            if text in self._events:
+                self._events[text].set()
+
+
+def create_server(args):
+    state = FakeParkingState(email=BENCHMARK_EMAIL, password=BENCHMARK_PASSWORD,
+                             fleet_size=args.fleet_size, zones=args.zones)
+    server = FakeParkingServer(state, latency=args.latency, error_rate=args.error_rate)
+    server.start()
+
+    return server
+
+
+def benchmark_requests_per_second(server, clients, duration):
+    counters = [0] * clients
+    errors = [0] * clients
+    deadline = time.time() + duration
+
+    def run(index):
+        client = server.create_client(BENCHMARK_EMAIL, BENCHMARK_PASSWORD, connection_retries=3,
+                                      cache_ttls=BENCHMARK_CACHE_TTLS)
+        while time.time() < deadline:
+            try:
+                client.get_reservations()
+                counters[index] += 1
+            except Exception:
+                errors[index] += 1
+
+        client.close()
+
+    threads = [Thread(target=run, args=(index, )) for index in xrange(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return sum(counters) / float(duration), sum(errors)
+
+
+def benchmark_server_measure_one_shot(server, polls):
+    client = server.create_client(BENCHMARK_EMAIL, BENCHMARK_PASSWORD, connection_retries=3,
+                                  cache_ttls=BENCHMARK_CACHE_TTLS)
+    monitor = ParkingMonitor(client=client)
+    monitor.measure_one_shot()
+
+    samples = []
+    for _ in xrange(polls):
+        started = time.time()
+        try:
+            monitor.measure_one_shot()
+        except Exception:
+            continue
+        samples.append(time.time() - started)
+
+    client.close()
+
+    return samples, monitor.last_poll_bytes
+
+
+def benchmark_notifier_event_latency(server, events, update_interval):
+    client = server.create_client(BENCHMARK_EMAIL, BENCHMARK_PASSWORD, connection_retries=3,
+                                  cache_ttls=BENCHMARK_CACHE_TTLS)
+    backend = TimestampNotifyBackend()
+    notifier = ParkingMonitorNotifier(monitor=ParkingMonitor(client=client),
+                                      notify_backend=backend,
+                                      formatter=BenchmarkFormatter(),
+                                      update_interval=update_interval,
+                                      idle_update_interval=update_interval)
+
+    thread = Thread(target=notifier.run)
+    thread.daemon = True
+    thread.start()
+
+    samples = []
+    for index in xrange(events):
+        vehicle = u'E{0:06d}BC59'.format(index)
+        text = 'new {0} {1}'.format(vehicle, FakeParkingState.ZONE_FIRST_NUMBER)
+
+        backend.expect(text)
+        started = time.time()
+        server.state.start_reservation(vehicle=vehicle, zone=FakeParkingState.ZONE_FIRST_NUMBER, duration=60)
+        samples.append(backend.wait(text, timeout=update_interval * 10 + 30) - started)
+
+    notifier.stop()
+    thread.join()
+    client.close()
+
+    return samples
+
+
+def report(name, samples):
+    if not samples:
+        print('{0:<48} no samples'.format(name))
+        return
+
+    print('{0:<48} p50 {1:10.3f} ms  p99 {2:10.3f} ms'.format(name,
+                                                             percentile(samples, 0.5) * 1000,
+                                                             percentile(samples, 0.99) * 1000))
+
+
+def run_diff(args):
+    for size in args.sizes:
+        report('measure_one_shot diff, {0} reservations'.format(size),
+               benchmark_measure_one_shot(size=size, polls=args.polls))
+
+
+def run_filter(args):
+    for size in args.sizes:
+        report('remain_filter per event, {0} reservations'.format(size),
+               benchmark_remain_filter(size=size, rounds=args.rounds))
+
+
+def run_server(args):
+    server = create_server(args)
+
+    try:
+        rps, errors = benchmark_requests_per_second(server, clients=args.clients, duration=args.duration)
+        print('{0:<48} {1:10.1f} req/s  ({2} errors)'.format(
+            'get_reservations, {0} clients'.format(args.clients), rps, errors))
+
+        samples, poll_bytes = benchmark_server_measure_one_shot(server, polls=args.polls)
+        report('measure_one_shot, {0} reservations'.format(args.fleet_size), samples)
+        print('{0:<48} {1:10d} bytes'.format('measure_one_shot wire transfer per poll', poll_bytes))
+
+        report('notifier new reservation event latency',
+               benchmark_notifier_event_latency(server, events=args.events, update_interval=args.update_interval))
+    finally:
+        server.stop()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='parking.py benchmarks')
+    subparsers = parser.add_subparsers()
+
+    diff_parser = subparsers.add_parser('diff', help='ParkingMonitor change detection on synthetic reservations')
+    diff_parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 100000])
+    diff_parser.add_argument('--polls', type=int, default=10)
+    diff_parser.set_defaults(func=run_diff)
+
+    filter_parser = subparsers.add_parser('filter', help='RemainStageNotifyFilter cost per remain event')
+    filter_parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 10000])
+    filter_parser.add_argument('--rounds', type=int, default=20)
+    filter_parser.set_defaults(func=run_filter)
+
+    server_parser = subparsers.add_parser('server', help='HttpParkingClient end to end against fakeserver.py')
+    server_parser.add_argument('--fleet-size', type=int, default=100)
+    server_parser.add_argument('--zones', type=int, default=20)
+    server_parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    server_parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of API requests that fail')
+    server_parser.add_argument('--clients', type=int, default=4)
+    server_parser.add_argument('--duration', type=float, default=5.0, help='seconds of requests/sec load')
+    server_parser.add_argument('--polls', type=int, default=100)
+    server_parser.add_argument('--events', type=int, default=20)
+    server_parser.add_argument('--update-interval', type=float, default=0.05)
+    server_parser.set_defaults(func=run_server)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
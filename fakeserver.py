@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Denis Vesnin, https://github.com/aeromg'
+
+import re
+import sys
+import json
+import zlib
+import time
+import random
+import urlparse
+import argparse
+from threading import Thread, Lock
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from parking import HttpParkingClient, ParkingClient
+
+
+class FakeParkingState(object):
+    ACCOUNT_ID = 1
+    ZONE_FIRST_NUMBER = 101
+    ZONE_PRICE = 3000  # cents per hour
+
+    # zones are squares on a grid around Perm city centre
+    ZONE_ORIGIN = (56.22, 58.0)  # lon, lat
+    ZONE_SIZE = 0.004  # degrees
+    ZONE_GAP = 0.0005  # degrees between neighbour zones
+    ZONE_COLUMNS = 10
+
+    def __init__(self, email, password, fleet_size=0, zones=20, balance_cent=10000000):
+        self._email = email
+        self._password = password
+        self._zones = zones
+        self._balance_cent = balance_cent
+
+        self._lock = Lock()
+        self._sessions = set()
+        self._reservations = {}  # id -> dict
+        self._next_id = 1
+
+        for index in xrange(fleet_size):
+            self.start_reservation(vehicle=u'A{0:06d}BC59'.format(index),
+                                   zone=FakeParkingState.ZONE_FIRST_NUMBER + index % zones,
+                                   duration=60 + index % 180)
+
+    def login(self, email, password):
+        if email != self._email or password != self._password:
+            return None
+
+        session = '{0:032x}'.format(random.getrandbits(128))
+        with self._lock:
+            self._sessions.add(session)
+
+        return session
+
+    def is_session_valid(self, session):
+        return session in self._sessions
+
+    def expire_sessions(self):
+        with self._lock:
+            self._sessions.clear()
+
+    def _now_ms(self):
+        return int(time.time() * 1000)
+
+    def _drop_expired(self):
+        now = self._now_ms()
+        for reservation_id in [k for k, r in self._reservations.iteritems() if r[u'end'] <= now]:
+            del self._reservations[reservation_id]
+
+    def _export(self, reservation):
+        exported = dict(reservation)
+        exported[u'remainingTime'] = max(0, reservation[u'end'] - self._now_ms())
+
+        return exported
+
+    def get_reservations(self):
+        with self._lock:
+            self._drop_expired()
+            return [self._export(r) for r in self._reservations.itervalues()]
+
+    def start_reservation(self, vehicle, zone, duration, vehicle_type=ParkingClient.VEHICLE_TYPE_CAR):
+        now = self._now_ms()
+
+        with self._lock:
+            reservation = {
+                u'id': self._next_id,
+                u'renewed': False,
+                u'vrp': vehicle,
+                u'zoneNumber': zone,
+                u'start': now,
+                u'end': now + duration * 60000,
+                u'vehicleType': vehicle_type,
+                u'accountId': FakeParkingState.ACCOUNT_ID
+            }
+
+            self._next_id += 1
+            self._reservations[reservation[u'id']] = reservation
+            self._balance_cent -= FakeParkingState.ZONE_PRICE * duration / 60
+
+            return self._export(reservation)
+
+    def renew_reservation(self, reservation_id, duration):
+        with self._lock:
+            reservation = self._reservations[reservation_id]
+            if reservation[u'renewed']:
+                raise KeyError(reservation_id)
+
+            reservation[u'renewed'] = True
+            reservation[u'end'] += duration * 60000
+            self._balance_cent -= FakeParkingState.ZONE_PRICE * duration / 60
+
+            return self._export(reservation)
+
+    def cancel_reservation(self, reservation_id):
+        with self._lock:
+            return self._export(self._reservations.pop(reservation_id))
+
+    @property
+    def balance_cent(self):
+        return self._balance_cent
+
+    def get_zone_location(self, index):
+        lon = FakeParkingState.ZONE_ORIGIN[0] + (index % FakeParkingState.ZONE_COLUMNS) * FakeParkingState.ZONE_SIZE
+        lat = FakeParkingState.ZONE_ORIGIN[1] + (index / FakeParkingState.ZONE_COLUMNS) * FakeParkingState.ZONE_SIZE
+        size = FakeParkingState.ZONE_SIZE - FakeParkingState.ZONE_GAP
+
+        return {
+            u'type': u'Polygon',
+            u'coordinates': [[[lon, lat], [lon + size, lat], [lon + size, lat + size], [lon, lat + size], [lon, lat]]]
+        }
+
+    def get_zones(self):
+        return [{
+            u'type': u'zone',
+            u'number': FakeParkingState.ZONE_FIRST_NUMBER + index,
+            u'location': self.get_zone_location(index),
+            u'prices': [{u'vehicleType': ParkingClient.VEHICLE_TYPE_CAR, u'price': FakeParkingState.ZONE_PRICE}]
+        } for index in xrange(self._zones)]
+
+
+class FakeParkingRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # one write per response, small unbuffered writes stall on delayed ACKs
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    SESSION_COOKIE_RE = re.compile(r'sid=([0-9a-f]+)')
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def _read_body(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        return self.rfile.read(length) if length > 0 else ''
+
+    def _send(self, status, body='', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, data):
+        body = json.dumps(data)
+        headers = {'Content-Type': 'application/json'}
+
+        if self.server.compression and 'gzip' in (self.headers.getheader('accept-encoding') or ''):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            headers['Content-Encoding'] = 'gzip'
+
+        self._send(200, body, headers)
+
+    def _send_error(self, name, message):
+        self._send_json({'errorName': name, 'error': message})
+
+    def _is_authorized(self):
+        match = FakeParkingRequestHandler.SESSION_COOKIE_RE.search(self.headers.getheader('cookie') or '')
+        return match is not None and self.server.state.is_session_valid(match.group(1))
+
+    def _handle(self, method):
+        server = self.server
+        if server.latency > 0:
+            time.sleep(server.latency)
+
+        body = self._read_body()
+        path = self.path
+        state = server.state
+
+        if method == 'POST' and path == HttpParkingClient.URL_LOGIN:
+            form = urlparse.parse_qs(body)
+            session = state.login(form.get('email', [''])[0], form.get('password', [''])[0])
+            if session is None:
+                self._send(302, headers={'Location': '/login?failed=true'})
+            else:
+                self._send(302, headers={'Location': '/',
+                                         'Set-Cookie': 'sid={0}; Path=/; Max-Age={1}'.format(session,
+                                                                                           server.session_max_age)})
+            return
+
+        if random.random() < server.error_rate:
+            self._send_error('ServiceUnavailableError', 'Injected failure')
+            return
+
+        if not self._is_authorized():
+            self._send_error('ForbiddenError', 'Forbidden')
+            return
+
+        try:
+            params = json.loads(body) if body else {}
+
+            if method == 'GET' and path == HttpParkingClient.URL_USER_INFO:
+                self._send_json({'account': {'id': FakeParkingState.ACCOUNT_ID,
+                                             'user': {'accountId': FakeParkingState.ACCOUNT_ID}}})
+            elif method == 'GET' and path == HttpParkingClient.URL_RESERVATIONS:
+                self._send_json({'reservations': state.get_reservations()})
+            elif method == 'GET' and path == HttpParkingClient.URL_ZONES:
+                self._send_json({'objects': state.get_zones()})
+            elif method == 'PUT' and path == HttpParkingClient.URL_BALANCE:
+                self._send_json({'balance': state.balance_cent})
+            elif method == 'PUT' and path == HttpParkingClient.URL_START:
+                self._send_json({'reservation': state.start_reservation(vehicle=params['vrp'],
+                                                                        zone=params['zoneNumber'],
+                                                                        duration=params['duration'],
+                                                                        vehicle_type=params['vehicleType'])})
+            elif method == 'PUT' and path == HttpParkingClient.URL_RENEW:
+                self._send_json({'reservation': state.renew_reservation(params['reservationId'],
+                                                                        params['duration'])})
+            elif method == 'PUT' and path == HttpParkingClient.URL_CANCEL:
+                self._send_json({'reservation': state.cancel_reservation(params['reservationId'])})
+            else:
+                self._send(404)
+        except KeyError, e:
+            self._send_error('NotFoundError', 'Unknown reservation {0}'.format(e))
+        except (TypeError, ValueError), e:
+            self._send_error('BadRequestError', repr(e))
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+
+class FakeParkingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, state, address=('127.0.0.1', 0), latency=0.0, error_rate=0.0, session_max_age=3600,
+                 compression=True, verbose=False):
+        HTTPServer.__init__(self, address, FakeParkingRequestHandler)
+
+        assert isinstance(state, FakeParkingState)
+        assert latency >= 0
+        assert 0 <= error_rate < 1
+
+        self.state = state
+        self.latency = latency
+        self.error_rate = error_rate
+        self.session_max_age = session_max_age
+        self.compression = compression
+        self.verbose = verbose
+
+        self._thread = None
+
+    @property
+    def host(self):
+        return '{0}:{1}'.format(*self.server_address)
+
+    def create_client(self, email, password, **kwargs):
+        return HttpParkingClient(email, password, host=self.host, secure=False, **kwargs)
+
+    def start(self):
+        self._thread = Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Local stand-in for the parking API 2.7')
+    parser.add_argument('--bind', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--email', default='example@domain.tld')
+    parser.add_argument('--password', default='password')
+    parser.add_argument('--fleet-size', type=int, default=10)
+    parser.add_argument('--zones', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of API requests that fail')
+    parser.add_argument('--no-compression', action='store_true', help='ignore Accept-Encoding: gzip')
+    args = parser.parse_args(argv)
+
+    state = FakeParkingState(email=args.email, password=args.password,
+                             fleet_size=args.fleet_size, zones=args.zones)
+    server = FakeParkingServer(state, address=(args.bind, args.port),
+                               latency=args.latency, error_rate=args.error_rate,
+                               compression=not args.no_compression, verbose=True)
+
+    sys.stderr.write('Serving on {0}\n'.format(server.host))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -4,22 +4,310 @@ __author__ = 'Denis Vesnin, https://github.com/aeromg'
 import httplib
 import urllib
 import json
+import zlib
+import math
 import datetime
 import time
+import random
 import sys
-from threading import Thread
+import os
+import re
+import select
+import socket
+import heapq
+import hashlib
+import multiprocessing
+import collections
+import bisect
+import Queue
+import sqlite3
+import atexit
+from threading import Thread, Lock, Condition, Event
+from email.utils import parsedate_tz, mktime_tz
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn, ThreadingUnixStreamServer, StreamRequestHandler
+import urlparse
 import argparse
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 def first(iterable):
     for e in iterable:
         return e
 
 
+class MetricsRegistry(object):
+    # base registry records nothing, instrumentation costs one no-op call when metrics are disabled
+    def __init__(self):
+        pass
+
+    @property
+    def enabled(self):
+        return False
+
+    def inc(self, name, value=1, labels=None):
+        pass
+
+    def set(self, name, value, labels=None):
+        pass
+
+    def observe(self, name, value, labels=None):
+        pass
+
+
+NULL_METRICS = MetricsRegistry()
+
+
+class PrometheusMetricsRegistry(MetricsRegistry):
+    KIND_COUNTER = 'counter'
+    KIND_GAUGE = 'gauge'
+    KIND_HISTOGRAM = 'histogram'
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=None):
+        super(PrometheusMetricsRegistry, self).__init__()
+
+        self._buckets = tuple(sorted(PrometheusMetricsRegistry.DEFAULT_BUCKETS if buckets is None else buckets))
+
+        self._lock = Lock()
+        self._kinds = {}  # name -> kind
+        self._values = {}  # (name, labels) -> float or histogram list(bucket counts..., sum, count)
+
+    @property
+    def enabled(self):
+        return True
+
+    def _get_key(self, name, kind, labels):
+        known_kind = self._kinds.setdefault(name, kind)
+        assert known_kind == kind, 'Metric {0} is a {1}'.format(name, known_kind)
+
+        return name, tuple(sorted(labels.items())) if labels else ()
+
+    def inc(self, name, value=1, labels=None):
+        with self._lock:
+            key = self._get_key(name, PrometheusMetricsRegistry.KIND_COUNTER, labels)
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        with self._lock:
+            self._values[self._get_key(name, PrometheusMetricsRegistry.KIND_GAUGE, labels)] = value
+
+    def observe(self, name, value, labels=None):
+        position = bisect.bisect_left(self._buckets, value)
+
+        with self._lock:
+            key = self._get_key(name, PrometheusMetricsRegistry.KIND_HISTOGRAM, labels)
+            histogram = self._values.get(key)
+            if histogram is None:
+                histogram = self._values[key] = [0] * (len(self._buckets) + 2)
+
+            if position < len(self._buckets):
+                histogram[position] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def get(self, name, labels=None):
+        with self._lock:
+            return self._values.get((name, tuple(sorted(labels.items())) if labels else ()))
+
+    def _format_labels(self, labels, extra=None):
+        labels = list(labels) + ([extra] if extra is not None else [])
+        if not labels:
+            return ''
+
+        escaped = [(k, unicode(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                   for k, v in labels]
+
+        return '{' + ','.join(['{0}="{1}"'.format(k, v) for k, v in escaped]) + '}'
+
+    def render(self):
+        with self._lock:
+            kinds = dict(self._kinds)
+            values = dict((key, list(value) if isinstance(value, list) else value)
+                          for key, value in self._values.items())
+
+        lines = []
+        for name in sorted(kinds.keys()):
+            lines.append('# TYPE {0} {1}'.format(name, kinds[name]))
+
+            for (metric_name, labels), value in sorted(values.items()):
+                if metric_name != name:
+                    continue
+
+                if kinds[name] != PrometheusMetricsRegistry.KIND_HISTOGRAM:
+                    lines.append('{0}{1} {2}'.format(name, self._format_labels(labels), repr(float(value))))
+                    continue
+
+                cumulative = 0
+                for bound, count in zip(self._buckets, value):
+                    cumulative += count
+                    lines.append('{0}_bucket{1} {2}'.format(name, self._format_labels(labels, ('le', repr(bound))),
+                                                            cumulative))
+                lines.append('{0}_bucket{1} {2}'.format(name, self._format_labels(labels, ('le', '+Inf')), value[-1]))
+                lines.append('{0}_sum{1} {2}'.format(name, self._format_labels(labels), repr(float(value[-2]))))
+                lines.append('{0}_count{1} {2}'.format(name, self._format_labels(labels), value[-1]))
+
+        return (u'\n'.join(lines) + u'\n').encode('utf-8')
+
+
+class PrometheusExporter(object):
+    class RequestHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+
+            body = self.server.registry.render()
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def __init__(self, registry, address=('127.0.0.1', 9108)):
+        assert isinstance(registry, PrometheusMetricsRegistry)
+
+        self._server = HTTPServer(address, PrometheusExporter.RequestHandler)
+        self._server.registry = registry
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def start(self):
+        self._thread = Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class Task(object):
+    def __init__(self, func, args=(), kwargs=None):
+        self._func = func
+        self._args = args
+        self._kwargs = {} if kwargs is None else kwargs
+
+        self._lock = Lock()
+        self._done_event = Event()
+        self._done_callbacks = []
+
+        self._result = None
+        self._error = None
+
+    def run(self):
+        try:
+            self._result = self._func(*self._args, **self._kwargs)
+        except Exception, e:
+            self._error = e
+
+        with self._lock:
+            self._done_event.set()
+            callbacks = list(self._done_callbacks)
+
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        with self._lock:
+            if not self._done_event.is_set():
+                self._done_callbacks.append(callback)
+                return
+
+        callback(self)
+
+    def wait(self, timeout=None):
+        return self._done_event.wait(timeout)
+
+    @property
+    def done(self):
+        return self._done_event.is_set()
+
+    @property
+    def error(self):
+        self.wait()
+        return self._error
+
+    @property
+    def result(self):
+        self.wait()
+        if self._error is not None:
+            raise self._error
+
+        return self._result
+
+
+class WorkerPool(object):
+    def __init__(self, workers=4, queue_size=0):
+        assert isinstance(workers, int) and workers > 0
+
+        self._workers = workers
+        self._queue = Queue.Queue(queue_size)
+        self._threads = []
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                break
+
+            task.run()
+
+    @property
+    def is_running(self):
+        return len(self._threads) > 0
+
+    def start(self):
+        if self.is_running:
+            return
+
+        for _ in range(self._workers):
+            thread = Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, func, *args, **kwargs):
+        task = Task(func, args, kwargs)
+        self._queue.put(task)
+
+        return task
+
+    def stop(self, wait=True):
+        threads = self._threads
+        self._threads = []
+
+        for _ in threads:
+            self._queue.put(None)
+
+        if wait:
+            for thread in threads:
+                thread.join()
+
+
 class Reservation(object):
+    __slots__ = ()
+
     def __init__(self):
         pass
 
+    @property
+    def key(self):
+        # what a monitor tells reservations apart by, vehicle and zone come first
+        return self.vrp, self.zone
+
     @property
     def renewed(self):
         raise NotImplementedError('Method must be implemented in child class')
@@ -108,6 +396,38 @@ class JsonReservation(Reservation):
         return self._data[u'accountId']
 
 
+class CompactReservation(Reservation):
+    # slots shadow the abstract properties, values are parsed once per poll
+    __slots__ = ('renewed', 'vrp', 'end', 'zone', 'start', 'remaining_second', 'remaining_minutes',
+                 'vehicleType', 'id', 'account')
+
+    def __init__(self, renewed, vrp, end, zone, start, remaining_second, vehicleType, id, account):
+        super(CompactReservation, self).__init__()
+
+        self.renewed = renewed
+        self.vrp = vrp
+        self.end = end
+        self.zone = zone
+        self.start = start
+        self.remaining_second = remaining_second
+        self.remaining_minutes = remaining_second / 60
+        self.vehicleType = vehicleType
+        self.id = id
+        self.account = account
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(renewed=data[u'renewed'],
+                   vrp=data[u'vrp'],
+                   end=datetime.datetime.fromtimestamp(data[u'end'] / 1000),
+                   zone=data[u'zoneNumber'],
+                   start=datetime.datetime.fromtimestamp(data[u'start'] / 1000),
+                   remaining_second=data[u'remainingTime'] / 1000,
+                   vehicleType=data[u'vehicleType'],
+                   id=data[u'id'],
+                   account=data[u'accountId'])
+
+
 class ParkingClient(object):
     VEHICLE_TYPE_CAR = 'car'
 
@@ -147,283 +467,2522 @@ class ParkingClient(object):
     def login(self):
         raise NotImplementedError('Method must be implemented in child class')
 
+    @property
+    def transfer_stats(self):
+        # clients without a wire level counter report nothing
+        return None
 
-class HttpParkingClient(ParkingClient):
-    HOST_NAME = 'permparking.ru'
+    def _prepare_batch(self):
+        pass
 
-    URL_LOGIN = '/auth/login'
-    URL_USER_INFO = '/api/2.7/accounts/me'
-    URL_RESERVATIONS = '/api/2.7/accounts/me/reservations'
-    URL_BALANCE = '/api/2.7/accounts/getbalance'
-    URL_NOTIFICATIONS = '/api/2.7/accounts/me/settings/notifications'
-    URL_RENEW = '/api/2.7/accounts/me/reservations/renew'
-    URL_START = '/api/2.7/accounts/me/reservations/start'
-    URL_CANCEL = '/api/2.7/accounts/me/reservations/cancel'
-    URL_ZONES = '/api/2.7/objects/?types=zones'
+    def _run_batch(self, func, items, concurrency):
+        assert isinstance(concurrency, int) and concurrency > 0
 
-    CLIENT_BASE_HEADERS = {
-        'Pragma': 'no-cache',
-        'Origin': 'https://permparking.ru',
-        'Accept-Encoding': 'none',
-        'Accept-Language': 'ru-RU,ru;q=0.8,en-US;q=0.6,en;q=0.4',
-        'Upgrade-Insecure-Requests': '1',
-        'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/52.0.2743.116 Safari/537.36',
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-        'Cache-Control': 'no-cache',
-        'Referer': 'https://permparking.ru',
-        'Connection': 'keep-alive'
-    }
+        if len(items) == 0:
+            return []
 
-    class Response(object):
-        def __init__(self, headers, body):
-            self._headers = dict(headers)
-            self._body = body
+        self._prepare_batch()
 
-        @property
-        def headers(self):
-            return dict(self._headers)
+        pool = WorkerPool(workers=min(concurrency, len(items)))
+        pool.start()
 
-        @property
-        def body(self):
-            return self._body
+        try:
+            tasks = [pool.submit(func, item) for item in items]
+            return [BatchResult(item=item,
+                                result=None if task.error is not None else task.result,
+                                error=task.error)
+                    for item, task in zip(items, tasks)]
+        finally:
+            pool.stop(wait=False)
+
+    def start_reservations(self, items, concurrency=8):
+        # items: (vehicle, zone, duration) or (vehicle, zone, duration, vehicle_type)
+        return self._run_batch(lambda item: self.start_reservation(*item), list(items), concurrency)
+
+    def renew_reservations(self, reservations, duration, concurrency=8):
+        assert all([isinstance(reservation, Reservation) for reservation in reservations])
+        return self._run_batch(lambda reservation: self.renew_reservation(reservation, duration),
+                               list(reservations), concurrency)
+
+    def stop_reservations(self, reservations, concurrency=8):
+        assert all([isinstance(reservation, Reservation) for reservation in reservations])
+        return self._run_batch(self.stop_reservation, list(reservations), concurrency)
+
+
+class BatchResult(object):
+    def __init__(self, item, result=None, error=None):
+        self._item = item
+        self._result = result
+        self._error = error
 
-    def __init__(self, email, password, connection_retries=1):
-        super(HttpParkingClient, self).__init__()
+    @property
+    def item(self):
+        return self._item
 
-        self._email = email
-        self._password = password
+    @property
+    def result(self):
+        return self._result
 
-        assert connection_retries > 0
-        self._connection_retries = connection_retries
+    @property
+    def error(self):
+        return self._error
 
-        self._is_login_ok = False
+    @property
+    def ok(self):
+        return self._error is None
 
-        self._cookie = None
-        self._user_info_cached = None
-        self._zones_cached = None
 
-    def _get_client_headers(self, is_form=False, append=None, is_json=False):
-        if append is None:
-            append = {}
+class ParkingApiError(Exception):
+    def __init__(self, name, message):
+        super(ParkingApiError, self).__init__(message)
 
-        if not self._cookie is None:
-            append['Cookie'] = self._cookie
+        self.name = name
 
-        if is_form:
-            append['Content-type'] = 'application/x-www-form-urlencoded'
 
-        if is_json:
-            append['Content-Type'] = 'application/json'
+class RequestNotConfirmedError(Exception):
+    def __init__(self, method, url, error):
+        super(RequestNotConfirmedError, self).__init__(
+            '{0} {1} was sent but its response was lost, not replayed: {2}'.format(method, url, repr(error)))
 
-        headers = HttpParkingClient.CLIENT_BASE_HEADERS.copy()
-        headers.update(append)
+        self.method = method
+        self.url = url
+        self.error = error
 
-        return headers
 
-    def _request(self, method, url, is_form=False, params=None, params_json=None, headers=None):
-        assert params_json is None or params is None
+class CircuitOpenError(Exception):
+    def __init__(self, host):
+        super(CircuitOpenError, self).__init__('Circuit for {0} is open'.format(host))
 
-        data = None
+        self.host = host
 
-        if params is not None:
-            data = urllib.urlencode(params)
-        elif params_json is not None:
-            data = json.dumps(params_json)
 
-        headers = self._get_client_headers(is_form=is_form, append=headers, is_json=not params_json is None)
+class CircuitBreaker(object):
+    STATE_CLOSED = 'closed'
+    STATE_OPEN = 'open'
+    STATE_HALF_OPEN = 'half_open'
 
-        connection = httplib.HTTPSConnection(HttpParkingClient.HOST_NAME)
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        assert isinstance(failure_threshold, int) and failure_threshold > 0
+        assert reset_timeout > 0
 
-        retry_countdown = self._connection_retries
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+
+        self._lock = Lock()
+        self._state = CircuitBreaker.STATE_CLOSED
+        self._failures = 0
+        self._opened_at = None
+
+    @property
+    def state(self):
+        return self._state
+
+    def allow(self):
+        with self._lock:
+            if self._state == CircuitBreaker.STATE_CLOSED:
+                return True
+
+            # a single trial request probes the host once the reset timeout is over
+            if self._state == CircuitBreaker.STATE_OPEN and time.time() - self._opened_at >= self._reset_timeout:
+                self._state = CircuitBreaker.STATE_HALF_OPEN
+                return True
+
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._state = CircuitBreaker.STATE_CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+
+            if self._state == CircuitBreaker.STATE_HALF_OPEN or self._failures >= self._failure_threshold:
+                self._state = CircuitBreaker.STATE_OPEN
+                self._opened_at = time.time()
+
+
+class RetryPolicy(object):
+    RETRYABLE_ERRORS = (socket.error, httplib.HTTPException)
+
+    def __init__(self, retries=3, base_delay=0.5, max_delay=30.0, multiplier=2.0, jitter=0.5,
+                 retryable=RETRYABLE_ERRORS, failure_threshold=5, reset_timeout=30.0):
+        assert isinstance(retries, int) and retries > 0
+        assert 0 <= base_delay <= max_delay
+        assert multiplier >= 1
+        assert 0 <= jitter <= 1
+
+        self._retries = retries
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._multiplier = multiplier
+        self._jitter = jitter
+        self._retryable = retryable
+
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._breakers_lock = Lock()
+        self._breakers = {}  # host -> CircuitBreaker
+
+    def get_breaker(self, host):
+        with self._breakers_lock:
+            breaker = self._breakers.get(host)
+            if breaker is None:
+                breaker = self._breakers[host] = CircuitBreaker(failure_threshold=self._failure_threshold,
+                                                                reset_timeout=self._reset_timeout)
+
+            return breaker
+
+    @property
+    def retries(self):
+        return self._retries
+
+    def get_delay(self, attempt):
+        delay = min(self._max_delay, self._base_delay * self._multiplier ** attempt)
+        return delay * (1.0 - self._jitter * random.random())
+
+    def is_retryable(self, error):
+        # a write whose outcome is unknown is never sent twice, whatever the policy
+        return isinstance(error, self._retryable) and not isinstance(error, RequestNotConfirmedError)
+
+    def call(self, func, host=None, on_retry=None):
+        breaker = None if host is None else self.get_breaker(host)
+        attempt = 0
 
         while True:
-            retry_countdown -= 1
+            if breaker is not None and not breaker.allow():
+                raise CircuitOpenError(host)
+
+            # other callers are refused while half open, so this call holds the single trial
+            trial = breaker is not None and breaker.state == CircuitBreaker.STATE_HALF_OPEN
+
             try:
-                connection.request(method=method,
-                                   url=url,
-                                   body=data,
-                                   headers=headers)
-                break
+                result = func()
             except Exception, e:
-                if retry_countdown == 0:
-                    raise e
+                retryable = self.is_retryable(e)
 
-        http_response = connection.getresponse()
+                # only transport failures say something about the host health, a lost write response is one
+                # even though it is never retried; a failed trial of any kind must reopen the breaker
+                # or it stays half open for good
+                if breaker is not None and (retryable or trial or isinstance(e, RequestNotConfirmedError)):
+                    breaker.record_failure()
 
-        response = HttpParkingClient.Response(headers=http_response.getheaders(), body=http_response.read())
+                attempt += 1
+                if not retryable or attempt >= self._retries:
+                    raise
 
-        http_response.close()
-        connection.close()
+                if on_retry is not None:
+                    on_retry(e)
 
-        return response
+                time.sleep(self.get_delay(attempt - 1))
+                continue
 
-    def _get_json(self, url, params_json=None, method='GET'):
-        if not self.is_login_ok:
-            self.login()
+            if breaker is not None:
+                breaker.record_success()
 
-        headers = {
-            'Content-Type': 'application/json, text/javascript, */*; q=0.01',
-            'X-Requested-With': 'XMLHttpRequest'
-        }
+            return result
 
-        while True:
-            http_response = self._request(method=method, url=url, params_json=params_json, headers=headers)
-            json_response = json.loads(http_response.body)
-            if 'errorName' in json_response.keys():
-                if json_response['errorName'] == 'ForbiddenError':
-                    self.login()
-                    if self.is_login_ok:
-                        continue
-                    else:
-                        raise Exception(json_response['error'])
-                else:
-                    raise Exception(json_response['error'])
 
-            return json_response
+class HttpConnectionPool(object):
+    def __init__(self, host, max_size=4, idle_timeout=60.0, connection_class=httplib.HTTPSConnection, timeout=None):
+        assert max_size > 0
+        assert idle_timeout > 0
 
-    def renew_reservation(self, reservation, duration):
-        if reservation.renewed:
-            raise Exception('Already renewed')
+        self._host = host
+        self._max_size = max_size
+        self._idle_timeout = idle_timeout
+        self._connection_class = connection_class
+        self._timeout = timeout
 
-        params = {
-            'reservationId': reservation.id,
-            'duration': duration
+        self._lock = Lock()
+        self._idle = []  # list((connection, released_at)), most recently released last
+
+        self._stats = {
+            'created': 0,
+            'reused': 0,
+            'released': 0,
+            'discarded': 0,
+            'expired': 0,
+            'stale': 0
         }
 
-        self._get_json(HttpParkingClient.URL_RENEW,
-                       params_json=params,
-                       method='PUT')
+    def _is_stale(self, connection):
+        sock = connection.sock
 
-    def stop_reservation(self, reservation):
-        assert isinstance(reservation, Reservation)
+        if sock is None:
+            return True
 
-        params = {
-            'reservationId': reservation.id
-        }
+        # idle keep-alive socket must not be readable: readable means EOF or unexpected data
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return True
 
-        return self._get_json(url=HttpParkingClient.URL_CANCEL,
-                              params_json=params,
-                              method='PUT')
+        return len(readable) > 0
 
-    def start_reservation(self, vehicle, zone, duration, vehicle_type=None):
-        assert (isinstance(vehicle, str) or isinstance(vehicle, unicode)) and vehicle
-        assert isinstance(zone, int) and (zone > 0)
+    def _create(self):
+        if self._timeout is None:
+            return self._connection_class(self._host)
 
-        if vehicle_type is None:
-            vehicle_type = ParkingClient.VEHICLE_TYPE_CAR
+        return self._connection_class(self._host, timeout=self._timeout)
 
-        params = {
-            'zoneNumber': zone,
-            'vrp': vehicle,
-            'vehicleType': vehicle_type,
-            'duration': duration,
-            'accountId': self.account_id
-        }
+    def acquire(self):
+        now = time.time()
 
-        return self._get_json(url=HttpParkingClient.URL_START,
-                              params_json=params,
-                              method='PUT')
+        with self._lock:
+            while self._idle:
+                connection, released_at = self._idle.pop()
 
-    def _load_zones(self):
-        self._zones_cached = self._get_json(url=HttpParkingClient.URL_ZONES, method='GET')['objects']
+                if now - released_at > self._idle_timeout:
+                    self._stats['expired'] += 1
+                elif self._is_stale(connection):
+                    self._stats['stale'] += 1
+                else:
+                    self._stats['reused'] += 1
+                    return connection, True
 
-    def get_price(self, zone, vehicle_type):
-        if self._zones_cached is None:
-            self._load_zones()
+                connection.close()
 
-        for obj in self._zones_cached:
-            if obj['number'] == zone:
-                for price in obj['prices']:
-                    if price['vehicleType'] == vehicle_type:
-                        return price['price']
+            self._stats['created'] += 1
 
-        raise Exception('No zone {0} with vehicle type {1}'.format(zone, vehicle_type))
+        return self._create(), False
 
-    @property
-    def account_id(self):
-        return self._get_user_info()['user']['accountId']
+    def release(self, connection):
+        with self._lock:
+            if len(self._idle) < self._max_size:
+                self._stats['released'] += 1
+                self._idle.append((connection, time.time()))
+                return
 
-    def _load_user_info(self):
-        self._user_info_cached = self._get_json(HttpParkingClient.URL_USER_INFO)['account']
+            self._stats['discarded'] += 1
 
-    def _get_user_info(self):
-        if self._user_info_cached is None:
-            self._load_user_info()
+        connection.close()
 
-        return self._user_info_cached
+    def discard(self, connection):
+        with self._lock:
+            self._stats['discarded'] += 1
 
-    def get_reservations(self):
-        return list(map(JsonReservation, self._get_json(HttpParkingClient.URL_RESERVATIONS)['reservations']))
+        connection.close()
 
-    def get_balance_cent(self):
-        params = {
-            'accountId': self._get_user_info()['id']
-        }
+    def close(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = []
 
-        response = self._get_json(url=HttpParkingClient.URL_BALANCE, params_json=params, method='PUT')
+        for connection, _ in idle:
+            connection.close()
 
-        return response['balance']
+    @property
+    def host(self):
+        return self._host
 
     @property
-    def is_login_ok(self):
-        return self._is_login_ok
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle'] = len(self._idle)
 
-    def login(self):
-        response = self._request(method='POST',
-                                 url=HttpParkingClient.URL_LOGIN,
-                                 is_form=True,
-                                 params={'email': self._email, 'password': self._password})
+        return stats
 
-        self._is_login_ok = 'location' in response.headers.keys() and '?failed=true' not in response.headers['location']
 
-        if self._is_login_ok:
-            self._cookie = response.headers['set-cookie']
+class ZoneCatalog(object):
+    def __init__(self, loader, ttl=3600.0, snapshot_path=None):
+        assert callable(loader)
+        assert ttl > 0
 
-        return response
+        self._loader = loader
+        self._ttl = ttl
+        self._snapshot_path = snapshot_path
 
+        self._lock = Lock()
+        self._refreshing = False
 
-class SMSClient(object):
-    HOSTNAME = 'sms.ru'
+        self._objects = None
+        self._loaded_at = None
+        self._zones = {}  # number -> zone object
+        self._prices = {}  # (number, vehicle type) -> price
 
-    RESPONSE_SENT = 100
-    RESPONSE_INSUFFICIENT_FOUNDS = 201
+        self._refresh_handlers = []
 
-    def __init__(self, api_id, testing=False):
-        self._api_id = api_id
-        self._testing = testing
+    def add_on_refresh_event(self, handler):
+        self._refresh_handlers.append(handler)
 
-    def send(self, to, text):
-        connection = httplib.HTTPConnection(SMSClient.HOSTNAME)
+    def remove_on_refresh_event(self, handler):
+        self._refresh_handlers.remove(handler)
 
-        params_dict = {
-            'api_id': self._api_id,
+    def _set_objects(self, objects, loaded_at):
+        zones = {}
+        prices = {}
+
+        for obj in objects:
+            zones[obj['number']] = obj
+            for price in obj['prices']:
+                prices[(obj['number'], price['vehicleType'])] = price['price']
+
+        with self._lock:
+            self._objects = objects
+            self._loaded_at = loaded_at
+            self._zones = zones
+            self._prices = prices
+
+        for handler in self._refresh_handlers:
+            try:
+                handler(objects)
+            except Exception, e:
+                sys.stderr.write(repr(e))
+
+    def load_snapshot(self):
+        if self._snapshot_path is None or not os.path.exists(self._snapshot_path):
+            return False
+
+        try:
+            with open(self._snapshot_path, 'rb') as snapshot:
+                data = json.load(snapshot)
+
+            self._set_objects(data['objects'], data['loaded_at'])
+        except (IOError, ValueError, KeyError, TypeError), e:
+            sys.stderr.write(repr(e))
+            return False
+
+        return True
+
+    def save_snapshot(self):
+        if self._snapshot_path is None:
+            return
+
+        with self._lock:
+            data = {
+                'loaded_at': self._loaded_at,
+                'objects': self._objects
+            }
+
+        temp_path = self._snapshot_path + '.tmp'
+        with open(temp_path, 'wb') as snapshot:
+            json.dump(data, snapshot)
+
+        os.rename(temp_path, self._snapshot_path)
+
+    def refresh(self):
+        self._set_objects(self._loader(), time.time())
+        self.save_snapshot()
+
+    def _refresh_background(self):
+        try:
+            self.refresh()
+        except Exception, e:
+            sys.stderr.write(repr(e))
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    @property
+    def is_expired(self):
+        return self._loaded_at is None or time.time() - self._loaded_at > self._ttl
+
+    def _ensure_loaded(self):
+        if self._objects is None and not self.load_snapshot():
+            self.refresh()
+            return
+
+        if not self.is_expired:
+            return
+
+        # stale data keeps answering while a single background refresh runs
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        thread = Thread(target=self._refresh_background)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def objects(self):
+        self._ensure_loaded()
+        return self._objects
+
+    def get_zone(self, zone):
+        self._ensure_loaded()
+
+        try:
+            return self._zones[zone]
+        except KeyError:
+            raise Exception('No zone {0}'.format(zone))
+
+    def get_price(self, zone, vehicle_type):
+        self._ensure_loaded()
+
+        try:
+            return self._prices[(zone, vehicle_type)]
+        except KeyError:
+            raise Exception('No zone {0} with vehicle type {1}'.format(zone, vehicle_type))
+
+
+class PriceQuoteEngine(object):
+    # prices are per hour, costs are in the same cents as the balance;
+    # results are lists of floats with None for unsold combinations, numpy only speeds up the tables when installed
+    def __init__(self, catalog, balance_loader=None, price_period=60):
+        assert isinstance(catalog, ZoneCatalog)
+        assert balance_loader is None or callable(balance_loader)
+        assert price_period > 0
+
+        self._catalog = catalog
+        self._balance_loader = balance_loader
+        self._price_period = float(price_period)
+
+        self._lock = Lock()
+        self._source = None  # catalog objects the tables were built from
+        self._tables = None  # (zones, zone index, vehicle types, vehicle type index, prices)
+
+        catalog.add_on_refresh_event(self._build)
+
+    def _build(self, objects):
+        zones = sorted(set(obj['number'] for obj in objects))
+        vehicle_types = sorted(set(price['vehicleType'] for obj in objects for price in obj['prices']))
+        zone_index = dict((zone, row) for row, zone in enumerate(zones))
+        type_index = dict((vehicle_type, column) for column, vehicle_type in enumerate(vehicle_types))
+
+        if numpy is not None:
+            prices = numpy.empty((len(zones), len(vehicle_types)))
+            prices.fill(numpy.nan)
+        else:
+            prices = [[None] * len(vehicle_types) for _ in zones]
+
+        for obj in objects:
+            row = zone_index[obj['number']]
+            for price in obj['prices']:
+                if numpy is not None:
+                    prices[row, type_index[price['vehicleType']]] = price['price']
+                else:
+                    prices[row][type_index[price['vehicleType']]] = float(price['price'])
+
+        with self._lock:
+            self._source = objects
+            self._tables = (zones, zone_index, vehicle_types, type_index, prices)
+
+    def _get_tables(self):
+        objects = self._catalog.objects
+
+        with self._lock:
+            if self._source is objects:
+                return self._tables
+
+        self._build(objects)
+
+        with self._lock:
+            return self._tables
+
+    def _get_rows(self, zone_index, zones):
+        try:
+            return [zone_index[zone] for zone in zones]
+        except KeyError, e:
+            raise Exception('No zone {0}'.format(e.args[0]))
+
+    def _get_budget(self, budget_cent):
+        if budget_cent is not None:
+            return budget_cent
+
+        assert self._balance_loader is not None
+        return self._balance_loader()
+
+    @property
+    def zones(self):
+        return list(self._get_tables()[0])
+
+    @property
+    def vehicle_types(self):
+        return list(self._get_tables()[2])
+
+    def _to_list(self, values):
+        # NaN marks unsold combinations inside numpy arrays only
+        return [None if numpy.isnan(value) else float(value) for value in values]
+
+    def _get_zone_prices(self, vehicle_type, zones):
+        all_zones, zone_index, _, type_index, prices = self._get_tables()
+        zones = all_zones if zones is None else list(zones)
+        rows = self._get_rows(zone_index, zones)
+        column = type_index.get(vehicle_type)
+
+        if numpy is not None:
+            if column is None:
+                return zones, numpy.repeat(numpy.nan, len(rows))
+            return zones, prices[rows, column]
+
+        return zones, [None if column is None else prices[row][column] for row in rows]
+
+    def get_prices(self, vehicle_type=ParkingClient.VEHICLE_TYPE_CAR, zones=None):
+        zones, zone_prices = self._get_zone_prices(vehicle_type, zones)
+
+        if numpy is not None:
+            return zones, self._to_list(zone_prices)
+
+        return zones, zone_prices
+
+    def cost_matrix(self, durations, vehicle_type=ParkingClient.VEHICLE_TYPE_CAR, zones=None):
+        # rows follow the returned zones, columns follow durations
+        zones, zone_prices = self._get_zone_prices(vehicle_type, zones)
+
+        if numpy is not None:
+            costs = numpy.outer(zone_prices, numpy.asarray(durations, dtype=float) / self._price_period)
+            return zones, [self._to_list(row) for row in costs]
+
+        return zones, [[None if price is None else price * duration / self._price_period for duration in durations]
+                       for price in zone_prices]
+
+    def quote(self, queries):
+        # queries: (zone, vehicle type, duration) triples
+        _, zone_index, _, type_index, prices = self._get_tables()
+
+        if numpy is not None:
+            if len(queries) == 0:
+                return []
+
+            zones, vehicle_types, durations = zip(*queries)
+            rows = numpy.array([zone_index.get(zone, -1) for zone in zones])
+            columns = numpy.array([type_index.get(vehicle_type, -1) for vehicle_type in vehicle_types])
+            known = (rows >= 0) & (columns >= 0)
+
+            costs = numpy.empty(len(queries))
+            costs.fill(numpy.nan)
+            costs[known] = prices[rows[known], columns[known]] * \
+                numpy.asarray(durations, dtype=float)[known] / self._price_period
+
+            return self._to_list(costs)
+
+        costs = []
+        for zone, vehicle_type, duration in queries:
+            row = zone_index.get(zone)
+            column = type_index.get(vehicle_type)
+            price = None if row is None or column is None else prices[row][column]
+            costs.append(None if price is None else price * duration / self._price_period)
+
+        return costs
+
+    def cheapest_zones(self, duration, vehicle_type=ParkingClient.VEHICLE_TYPE_CAR, zones=None, count=1):
+        zones, zone_prices = self._get_zone_prices(vehicle_type, zones)
+
+        if numpy is not None:
+            costs = zone_prices * (duration / self._price_period)
+            order = [position for position in numpy.argsort(costs, kind='mergesort')
+                     if not numpy.isnan(costs[position])]
+            return [(zones[position], float(costs[position])) for position in order[:count]]
+
+        quotes = [(price * duration / self._price_period, position)
+                  for position, price in enumerate(zone_prices) if price is not None]
+        return [(zones[position], cost) for cost, position in sorted(quotes)[:count]]
+
+    def max_durations(self, vehicle_type=ParkingClient.VEHICLE_TYPE_CAR, zones=None, budget_cent=None):
+        # whole minutes the budget pays for in every zone, inf where parking is free
+        budget = self._get_budget(budget_cent)
+        zones, zone_prices = self._get_zone_prices(vehicle_type, zones)
+
+        if numpy is not None:
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                durations = numpy.floor(budget * self._price_period / zone_prices)
+                durations[zone_prices == 0] = numpy.inf
+
+            return zones, [None if numpy.isnan(duration) else float('inf') if numpy.isinf(duration) else
+                           int(duration) for duration in durations]
+
+        return zones, [None if price is None else float('inf') if price == 0 else
+                       int(budget * self._price_period // price) for price in zone_prices]
+
+    def fit_budget(self, queries, budget_cent=None):
+        budget = self._get_budget(budget_cent)
+        costs = self.quote(queries)
+
+        return costs, [cost is not None and cost <= budget for cost in costs]
+
+
+class ZoneSpatialIndex(object):
+    # zone geometry is GeoJSON in lon/lat order; distances are meters on a local equirectangular projection,
+    # which is accurate well beyond the size of a city
+    METERS_PER_DEGREE_LAT = 110574.0
+    METERS_PER_DEGREE_LON = 111320.0
+
+    GEOMETRY_KEYS = ('location', 'geometry', 'center')
+
+    def __init__(self, catalog=None, cell_size=0.005):
+        assert catalog is None or isinstance(catalog, ZoneCatalog)
+        assert cell_size > 0
+
+        self._catalog = catalog
+        self._cell_size = float(cell_size)
+
+        self._lock = Lock()
+        self._source = None  # catalog objects the index was built from
+        self._geometry = {}  # zone -> raw geometry, compared on refresh
+        self._shapes = {}  # zone -> (polygons, points), polygons are lists of rings of (lon, lat)
+        self._zone_cells = {}  # zone -> cells covered by its bounding box
+        self._cells = collections.defaultdict(set)  # (column, row) -> zones
+        self._bounds = None  # (min column, min row, max column, max row) of occupied cells
+
+        if catalog is not None:
+            catalog.add_on_refresh_event(self.update)
+
+    def _get_raw_geometry(self, obj):
+        for key in ZoneSpatialIndex.GEOMETRY_KEYS:
+            geometry = obj.get(key)
+            if isinstance(geometry, dict) and 'coordinates' in geometry:
+                return geometry
+
+        return None
+
+    def _get_shape(self, geometry):
+        kind = geometry.get('type')
+        coordinates = geometry['coordinates']
+
+        if kind == 'Point':
+            return [], [tuple(coordinates[:2])]
+        if kind == 'MultiPoint':
+            return [], [tuple(point[:2]) for point in coordinates]
+        if kind == 'Polygon':
+            coordinates = [coordinates]
+        elif kind != 'MultiPolygon':
+            raise Exception('Unsupported zone geometry {0}'.format(kind))
+
+        return [[[tuple(point[:2]) for point in ring] for ring in polygon] for polygon in coordinates], []
+
+    def _get_cell(self, lon, lat):
+        return int(math.floor(lon / self._cell_size)), int(math.floor(lat / self._cell_size))
+
+    def _get_shape_cells(self, shape):
+        polygons, points = shape
+        vertices = [point for polygon in polygons for point in polygon[0]] + points
+
+        min_column, min_row = self._get_cell(min(lon for lon, _ in vertices), min(lat for _, lat in vertices))
+        max_column, max_row = self._get_cell(max(lon for lon, _ in vertices), max(lat for _, lat in vertices))
+
+        return [(column, row) for column in xrange(min_column, max_column + 1)
+                for row in xrange(min_row, max_row + 1)]
+
+    def _remove_zone(self, zone):
+        for cell in self._zone_cells.pop(zone, ()):
+            zones = self._cells[cell]
+            zones.discard(zone)
+            if not zones:
+                del self._cells[cell]
+
+        self._shapes.pop(zone, None)
+        self._geometry.pop(zone, None)
+
+    def _add_zone(self, zone, geometry):
+        shape = self._get_shape(geometry)
+        cells = self._get_shape_cells(shape)
+
+        self._geometry[zone] = geometry
+        self._shapes[zone] = shape
+        self._zone_cells[zone] = cells
+
+        for cell in cells:
+            self._cells[cell].add(zone)
+
+    def _update_bounds(self):
+        if not self._cells:
+            self._bounds = None
+            return
+
+        columns = [column for column, _ in self._cells]
+        rows = [row for _, row in self._cells]
+        self._bounds = (min(columns), min(rows), max(columns), max(rows))
+
+    def update(self, objects):
+        geometries = {}
+        for obj in objects:
+            geometry = self._get_raw_geometry(obj)
+            if geometry is not None:
+                geometries[obj['number']] = geometry
+
+        with self._lock:
+            # only zones whose geometry changed are re-indexed
+            for zone in [zone for zone in self._geometry if geometries.get(zone) != self._geometry[zone]]:
+                self._remove_zone(zone)
+
+            for zone, geometry in geometries.iteritems():
+                if zone in self._geometry:
+                    continue
+
+                try:
+                    self._add_zone(zone, geometry)
+                except Exception, e:
+                    sys.stderr.write('{0}: {1}\n'.format(zone, repr(e)))
+
+            self._update_bounds()
+            self._source = objects
+
+    def _ensure_updated(self):
+        if self._catalog is None:
+            return
+
+        objects = self._catalog.objects
+        if self._source is not objects:
+            self.update(objects)
+
+    @property
+    def zones(self):
+        self._ensure_updated()
+
+        with self._lock:
+            return sorted(self._shapes.keys())
+
+    def _contains(self, polygon, lon, lat):
+        inside = False
+
+        # even-odd rule over the outer ring and the holes
+        for ring in polygon:
+            previous_lon, previous_lat = ring[-1]
+            for point_lon, point_lat in ring:
+                if (point_lat > lat) != (previous_lat > lat) and \
+                        lon < (previous_lon - point_lon) * (lat - point_lat) / (previous_lat - point_lat) + point_lon:
+                    inside = not inside
+                previous_lon, previous_lat = point_lon, point_lat
+
+        return inside
+
+    def _segment_distance(self, x, y, x1, y1, x2, y2):
+        dx = x2 - x1
+        dy = y2 - y1
+        length = dx * dx + dy * dy
+        t = 0.0 if length == 0 else max(0.0, min(1.0, ((x - x1) * dx + (y - y1) * dy) / length))
+
+        return math.hypot(x - x1 - t * dx, y - y1 - t * dy)
+
+    def _distance(self, zone, lon, lat, scale_lon):
+        polygons, points = self._shapes[zone]
+        scale_lat = ZoneSpatialIndex.METERS_PER_DEGREE_LAT
+        best = float('inf')
+
+        for polygon in polygons:
+            if self._contains(polygon, lon, lat):
+                return 0.0
+
+            for ring in polygon:
+                for (lon1, lat1), (lon2, lat2) in zip(ring, ring[1:] + ring[:1]):
+                    best = min(best, self._segment_distance(0.0, 0.0,
+                                                            (lon1 - lon) * scale_lon, (lat1 - lat) * scale_lat,
+                                                            (lon2 - lon) * scale_lon, (lat2 - lat) * scale_lat))
+
+        for point_lon, point_lat in points:
+            best = min(best, math.hypot((point_lon - lon) * scale_lon, (point_lat - lat) * scale_lat))
+
+        return best
+
+    def _get_lon_scale(self, lat):
+        return ZoneSpatialIndex.METERS_PER_DEGREE_LON * math.cos(math.radians(lat))
+
+    def point_in_zone(self, lat, lon):
+        self._ensure_updated()
+
+        with self._lock:
+            return sorted(zone for zone in self._cells.get(self._get_cell(lon, lat), ())
+                          if any(self._contains(polygon, lon, lat) for polygon in self._shapes[zone][0]))
+
+    def zones_within(self, lat, lon, radius):
+        self._ensure_updated()
+
+        scale_lon = self._get_lon_scale(lat)
+        min_column, min_row = self._get_cell(lon - radius / scale_lon,
+                                             lat - radius / ZoneSpatialIndex.METERS_PER_DEGREE_LAT)
+        max_column, max_row = self._get_cell(lon + radius / scale_lon,
+                                             lat + radius / ZoneSpatialIndex.METERS_PER_DEGREE_LAT)
+
+        with self._lock:
+            if self._bounds is None:
+                return []
+
+            # a radius larger than the city covers more cells than are occupied
+            min_column, min_row = max(min_column, self._bounds[0]), max(min_row, self._bounds[1])
+            max_column, max_row = min(max_column, self._bounds[2]), min(max_row, self._bounds[3])
+
+            candidates = set()
+            if (max_column - min_column + 1) * (max_row - min_row + 1) > len(self._cells):
+                for (column, row), zones in self._cells.iteritems():
+                    if min_column <= column <= max_column and min_row <= row <= max_row:
+                        candidates.update(zones)
+            else:
+                for column in xrange(min_column, max_column + 1):
+                    for row in xrange(min_row, max_row + 1):
+                        candidates.update(self._cells.get((column, row), ()))
+
+            found = [(self._distance(zone, lon, lat, scale_lon), zone) for zone in candidates]
+
+        return [(zone, distance) for distance, zone in sorted(found) if distance <= radius]
+
+    def _get_ring_cells(self, column, row, ring):
+        # perimeter of the square ring, clipped to occupied cells
+        min_column, min_row, max_column, max_row = self._bounds
+        columns = xrange(max(column - ring, min_column), min(column + ring, max_column) + 1)
+
+        for ring_row in (row - ring, row + ring) if ring > 0 else (row, ):
+            if min_row <= ring_row <= max_row:
+                for ring_column in columns:
+                    yield ring_column, ring_row
+
+        for ring_column in (column - ring, column + ring) if ring > 0 else ():
+            if min_column <= ring_column <= max_column:
+                for ring_row in xrange(max(row - ring + 1, min_row), min(row + ring - 1, max_row) + 1):
+                    yield ring_column, ring_row
+
+    def nearest_zone(self, lat, lon, max_distance=None):
+        self._ensure_updated()
+
+        scale_lon = self._get_lon_scale(lat)
+        # no zone in a cell ring further out can be closer than this per ring step
+        ring_step = self._cell_size * min(scale_lon, ZoneSpatialIndex.METERS_PER_DEGREE_LAT)
+        column, row = self._get_cell(lon, lat)
+
+        with self._lock:
+            if self._bounds is None:
+                return None
+
+            min_column, min_row, max_column, max_row = self._bounds
+            first_ring = max(0, min_column - column, column - max_column, min_row - row, row - max_row)
+            last_ring = max(abs(column - min_column), abs(column - max_column), abs(row - min_row), abs(row - max_row))
+
+            best = (float('inf'), None)
+            seen = set()
+
+            for ring in xrange(first_ring, last_ring + 1):
+                if best[0] <= (ring - 1) * ring_step or \
+                        (max_distance is not None and (ring - 1) * ring_step > max_distance):
+                    break
+
+                for cell in self._get_ring_cells(column, row, ring):
+                    for zone in self._cells.get(cell, ()):
+                        if zone not in seen:
+                            seen.add(zone)
+                            best = min(best, (self._distance(zone, lon, lat, scale_lon), zone))
+
+        if best[1] is None or (max_distance is not None and best[0] > max_distance):
+            return None
+
+        return best[1], best[0]
+
+
+class SessionStore(object):
+    def __init__(self):
+        pass
+
+    def load(self, key):
+        raise NotImplementedError('Method must be implemented in child class')
+
+    def save(self, key, session):
+        raise NotImplementedError('Method must be implemented in child class')
+
+    def delete(self, key):
+        raise NotImplementedError('Method must be implemented in child class')
+
+
+class MemorySessionStore(SessionStore):
+    def __init__(self):
+        super(MemorySessionStore, self).__init__()
+
+        self._sessions = {}
+
+    def load(self, key):
+        session = self._sessions.get(key)
+        return None if session is None else dict(session)
+
+    def save(self, key, session):
+        self._sessions[key] = dict(session)
+
+    def delete(self, key):
+        self._sessions.pop(key, None)
+
+
+class JsonFileSessionStore(SessionStore):
+    def __init__(self, path):
+        super(JsonFileSessionStore, self).__init__()
+
+        self._path = path
+        self._lock = Lock()
+
+    def _read(self):
+        if not os.path.exists(self._path):
+            return {}
+
+        try:
+            with open(self._path, 'rb') as sessions:
+                return json.load(sessions)
+        except (IOError, ValueError), e:
+            sys.stderr.write(repr(e))
+            return {}
+
+    def _write(self, sessions):
+        temp_path = self._path + '.tmp'
+        with open(temp_path, 'wb') as output:
+            json.dump(sessions, output)
+
+        # cookies are credentials
+        os.chmod(temp_path, 0600)
+        os.rename(temp_path, self._path)
+
+    def load(self, key):
+        with self._lock:
+            return self._read().get(key)
+
+    def save(self, key, session):
+        with self._lock:
+            sessions = self._read()
+            sessions[key] = session
+            self._write(sessions)
+
+    def delete(self, key):
+        with self._lock:
+            sessions = self._read()
+            if sessions.pop(key, None) is not None:
+                self._write(sessions)
+
+
+class ResponseCache(object):
+    def __init__(self, ttls=None):
+        self._ttls = {} if ttls is None else dict(ttls)  # key -> seconds, 0 coalesces without caching
+
+        self._lock = Lock()
+        self._entries = {}  # key -> (expires_at, value)
+        self._in_flight = {}  # key -> Task
+        self._generations = {}  # key -> int, bumped by invalidate
+
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'coalesced': 0,
+            'invalidations': 0
+        }
+
+    @property
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def get(self, key, loader, ttl=None):
+        if ttl is None:
+            ttl = self._ttls.get(key, 0)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                self._stats['hits'] += 1
+                return entry[1]
+
+            task = self._in_flight.get(key)
+            is_owner = task is None
+
+            if is_owner:
+                self._stats['misses'] += 1
+                task = self._in_flight[key] = Task(loader)
+                generation = self._generations.get(key, 0)
+            else:
+                self._stats['coalesced'] += 1
+
+        if is_owner:
+            task.run()
+
+            with self._lock:
+                if self._in_flight.get(key) is task:
+                    del self._in_flight[key]
+
+                # a result fetched before an invalidation is already stale
+                if task.error is None and ttl > 0 and self._generations.get(key, 0) == generation:
+                    self._entries[key] = (time.time() + ttl, task.result)
+
+        return task.result
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+                self._in_flight.pop(key, None)
+                self._generations[key] = self._generations.get(key, 0) + 1
+
+            self._stats['invalidations'] += len(keys)
+
+    def clear(self):
+        with self._lock:
+            keys = self._entries.keys()
+
+        self.invalidate(*keys)
+
+
+class HttpParkingClient(ParkingClient):
+    HOST_NAME = 'permparking.ru'
+
+    URL_LOGIN = '/auth/login'
+    URL_USER_INFO = '/api/2.7/accounts/me'
+    URL_RESERVATIONS = '/api/2.7/accounts/me/reservations'
+    URL_BALANCE = '/api/2.7/accounts/getbalance'
+    URL_NOTIFICATIONS = '/api/2.7/accounts/me/settings/notifications'
+    URL_RENEW = '/api/2.7/accounts/me/reservations/renew'
+    URL_START = '/api/2.7/accounts/me/reservations/start'
+    URL_CANCEL = '/api/2.7/accounts/me/reservations/cancel'
+    URL_ZONES = '/api/2.7/objects/?types=zones'
+
+    CLIENT_BASE_HEADERS = {
+        'Pragma': 'no-cache',
+        'Accept-Encoding': 'gzip, deflate',
+        'Accept-Language': 'ru-RU,ru;q=0.8,en-US;q=0.6,en;q=0.4',
+        'Upgrade-Insecure-Requests': '1',
+        'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/52.0.2743.116 Safari/537.36',
+        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+        'Cache-Control': 'no-cache',
+        'Connection': 'keep-alive'
+    }
+
+    class Response(object):
+        def __init__(self, headers, body, raw_size=None):
+            self._headers = dict(headers)
+            self._body = body
+            self._raw_size = len(body) if raw_size is None else raw_size
+
+        @property
+        def headers(self):
+            return dict(self._headers)
+
+        @property
+        def body(self):
+            return self._body
+
+        @property
+        def raw_size(self):
+            return self._raw_size
+
+    READ_CHUNK_SIZE = 16384
+
+    # replayed after a lost response; start, renew and cancel are PUTs and never are
+    IDEMPOTENT_METHODS = ('GET', 'HEAD')
+
+    CACHE_RESERVATIONS = 'reservations'
+    CACHE_BALANCE = 'balance'
+    CACHE_USER_INFO = 'user_info'
+
+    DEFAULT_CACHE_TTLS = {
+        CACHE_RESERVATIONS: 2.0,
+        CACHE_BALANCE: 10.0
+    }
+
+    SESSION_EXPIRES_RE = re.compile(r'expires=([^;]+)', re.IGNORECASE)
+    SESSION_MAX_AGE_RE = re.compile(r'max-age=(\d+)', re.IGNORECASE)
+
+    # floor between two logins, whatever lifetime the server grants
+    SESSION_MIN_REFRESH_INTERVAL = 10.0
+
+    def __init__(self, email, password, connection_retries=1, pool_size=4, pool_idle_timeout=60.0,
+                 zones_ttl=3600.0, zones_snapshot_path=None,
+                 session_store=None, session_ttl=1800.0, session_refresh_ahead=120.0,
+                 host=None, secure=True, metrics=None, retry_policy=None, cache_ttls=None, compression=True,
+                 timeout=30.0):
+        super(HttpParkingClient, self).__init__()
+
+        assert metrics is None or isinstance(metrics, MetricsRegistry)
+        self._metrics = NULL_METRICS if metrics is None else metrics
+
+        self._email = email
+        self._password = password
+
+        assert connection_retries > 0
+        assert retry_policy is None or isinstance(retry_policy, RetryPolicy)
+        assert timeout > 0
+        self._retry_policy = RetryPolicy(retries=connection_retries) if retry_policy is None else retry_policy
+
+        self._pool = HttpConnectionPool(host=HttpParkingClient.HOST_NAME if host is None else host,
+                                        max_size=pool_size,
+                                        idle_timeout=pool_idle_timeout,
+                                        connection_class=httplib.HTTPSConnection if secure else httplib.HTTPConnection,
+                                        timeout=timeout)
+
+        # every city deployment checks requests against its own site
+        origin = '{0}://{1}'.format('https' if secure else 'http', self._pool.host)
+        self._site_headers = {
+            'Origin': origin,
+            'Referer': origin
+        }
+
+        assert session_store is None or isinstance(session_store, SessionStore)
+        assert session_ttl > session_refresh_ahead >= 0
+        self._session_store = session_store
+        self._session_ttl = session_ttl
+        self._session_refresh_ahead = session_refresh_ahead
+        self._session_started = None
+        self._session_expires = None
+        self._session_restored = False
+        self._login_lock = Lock()
+        self._session_refresher_stop = None
+
+        self._compression = compression
+        self._transfer_lock = Lock()
+        self._transfer_stats = {
+            'responses': 0,
+            'raw_bytes': 0,
+            'decoded_bytes': 0
+        }
+
+        self._is_login_ok = False
+
+        self._cookie = None
+        self._user_info_cached = None
+        ttls = dict(HttpParkingClient.DEFAULT_CACHE_TTLS)
+        ttls.update(cache_ttls or {})
+        self._cache = ResponseCache(ttls=ttls)
+
+        self._zone_catalog = ZoneCatalog(loader=self._load_zones,
+                                         ttl=zones_ttl,
+                                         snapshot_path=zones_snapshot_path)
+        self._quote_engine = None
+        self._spatial_index = None
+
+    def _get_client_headers(self, is_form=False, append=None, is_json=False):
+        if append is None:
+            append = {}
+
+        if not self._cookie is None:
+            append['Cookie'] = self._cookie
+
+        if is_form:
+            append['Content-type'] = 'application/x-www-form-urlencoded'
+
+        if is_json:
+            append['Content-Type'] = 'application/json'
+
+        if not self._compression:
+            append['Accept-Encoding'] = 'identity'
+
+        headers = HttpParkingClient.CLIENT_BASE_HEADERS.copy()
+        headers.update(self._site_headers)
+        headers.update(append)
+
+        return headers
+
+    class BodyDecoder(object):
+        # a corrupt body keeps the error instead of raising, the caller still drains the socket
+        def __init__(self, content_encoding):
+            self.encoding = (content_encoding or '').strip().lower()
+            self.error = None
+            self._head = None  # deflate bytes seen before the header was accepted
+
+            if self.encoding in ('gzip', 'x-gzip'):
+                self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            elif self.encoding == 'deflate':
+                # zlib wrapped deflate, header autodetected; some servers send the raw stream instead
+                self._decoder = zlib.decompressobj(32 + zlib.MAX_WBITS)
+                self._head = ''
+            else:
+                self._decoder = None
+
+        def decompress(self, chunk):
+            if self._decoder is None:
+                return chunk
+            if self.error is not None:
+                return ''
+
+            try:
+                if self._head is None:
+                    return self._decoder.decompress(chunk)
+
+                self._head += chunk
+                data = self._decoder.decompress(chunk)
+                if len(self._head) >= 2:
+                    self._head = None
+
+                return data
+            except zlib.error, e:
+                if self._head is None:
+                    self.error = e
+                    return ''
+
+                head, self._head = self._head, None
+                self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+                return self.decompress(head)
+
+        def flush(self):
+            if self._decoder is None or self.error is not None:
+                return ''
+
+            try:
+                return self._decoder.flush()
+            except zlib.error, e:
+                self.error = e
+                return ''
+
+    def _read_body(self, http_response):
+        # chunks are decompressed as they arrive, the compressed body is never held whole
+        decoder = HttpParkingClient.BodyDecoder(http_response.getheader('content-encoding'))
+        chunks = []
+        raw_size = 0
+
+        while True:
+            chunk = http_response.read(HttpParkingClient.READ_CHUNK_SIZE)
+            if not chunk:
+                break
+
+            raw_size += len(chunk)
+            chunks.append(decoder.decompress(chunk))
+
+        chunks.append(decoder.flush())
+
+        return raw_size, ''.join(chunks), decoder
+
+    @property
+    def transfer_stats(self):
+        with self._transfer_lock:
+            return dict(self._transfer_stats)
+
+    def _request(self, method, url, is_form=False, params=None, params_json=None, headers=None, idempotent=None):
+        assert params_json is None or params is None
+
+        if idempotent is None:
+            idempotent = method in HttpParkingClient.IDEMPOTENT_METHODS
+
+        data = None
+
+        if params is not None:
+            data = urllib.urlencode(params)
+        elif params_json is not None:
+            data = json.dumps(params_json)
+
+        headers = self._get_client_headers(is_form=is_form, append=headers, is_json=not params_json is None)
+
+        labels = {'endpoint': url.split('?')[0], 'method': method}
+        started = time.time()
+
+        def send():
+            while True:
+                connection, reused = self._pool.acquire()
+                try:
+                    connection.request(method=method,
+                                       url=url,
+                                       body=data,
+                                       headers=headers)
+                except Exception:
+                    self._pool.discard(connection)
+                    # keep-alive socket was closed by the server while idle, nothing was processed
+                    if reused:
+                        self._metrics.inc('parking_http_stale_connections_total', labels=labels)
+                        continue
+
+                    raise
+
+                try:
+                    http_response = connection.getresponse()
+                    return (connection, http_response) + self._read_body(http_response)
+                except Exception, e:
+                    self._pool.discard(connection)
+
+                    # the server may already have acted on the request, only safe requests are sent again
+                    if not idempotent:
+                        self._metrics.inc('parking_http_unconfirmed_total', labels=labels)
+                        raise RequestNotConfirmedError(method, url, e)
+
+                    if reused:
+                        self._metrics.inc('parking_http_stale_connections_total', labels=labels)
+                        continue
+
+                    raise
+
+        try:
+            connection, http_response, raw_size, body, decoder = self._retry_policy.call(
+                send,
+                host=self._pool.host,
+                on_retry=lambda error: self._metrics.inc('parking_http_retries_total', labels=labels))
+        except CircuitOpenError:
+            self._metrics.inc('parking_http_circuit_open_total', labels=labels)
+            raise
+        except Exception:
+            self._metrics.inc('parking_http_errors_total', labels=labels)
+            raise
+
+        # a corrupt body is reported here, out of the retried block: the request already reached the server
+        if decoder.error is not None:
+            self._pool.discard(connection)
+            self._metrics.inc('parking_http_errors_total', labels=labels)
+            raise httplib.HTTPException('Corrupt {0} response body: {1}'.format(decoder.encoding, decoder.error))
+
+        self._metrics.observe('parking_http_request_seconds', time.time() - started, labels=labels)
+        self._metrics.inc('parking_http_requests_total',
+                          labels={'endpoint': labels['endpoint'], 'method': method, 'status': http_response.status})
+
+        self._metrics.inc('parking_http_received_bytes_total', raw_size, labels=labels)
+        self._metrics.inc('parking_http_decoded_bytes_total', len(body), labels=labels)
+
+        with self._transfer_lock:
+            self._transfer_stats['responses'] += 1
+            self._transfer_stats['raw_bytes'] += raw_size
+            self._transfer_stats['decoded_bytes'] += len(body)
+
+        response = HttpParkingClient.Response(headers=http_response.getheaders(), body=body, raw_size=raw_size)
+
+        http_response.close()
+
+        if http_response.will_close:
+            self._pool.discard(connection)
+        else:
+            self._pool.release(connection)
+
+        return response
+
+    @property
+    def _session_key(self):
+        return '{0}/{1}'.format(self._pool.host, self._email)
+
+    def _restore_session(self):
+        self._session_restored = True
+
+        if self._session_store is None:
+            return False
+
+        session = self._session_store.load(self._session_key)
+        if session is None:
+            return False
+
+        # a malformed entry is a cache miss, the login that follows overwrites it
+        try:
+            expires = float(session['expires'])
+            started = float(session.get('started', time.time()))
+            cookie = session['cookie']
+            user_info = session['user_info']
+        except (KeyError, TypeError, ValueError, AttributeError):
+            return False
+
+        if expires <= time.time() or time.time() >= self._get_session_refresh_at(started, expires):
+            return False
+
+        self._cookie = cookie
+        self._session_started = started
+        self._session_expires = expires
+        self._user_info_cached = user_info
+        self._is_login_ok = True
+
+        return True
+
+    def _save_session(self):
+        if self._session_store is None or not self._is_login_ok:
+            return
+
+        self._session_store.save(self._session_key, {
+            'cookie': self._cookie,
+            'started': self._session_started,
+            'expires': self._session_expires,
+            'user_info': self._user_info_cached
+        })
+
+    def _parse_session_expires(self, cookie):
+        now = time.time()
+        expires = []
+
+        for max_age in HttpParkingClient.SESSION_MAX_AGE_RE.findall(cookie):
+            expires.append(now + int(max_age))
+
+        for date in HttpParkingClient.SESSION_EXPIRES_RE.findall(cookie):
+            parsed = parsedate_tz(date.strip())
+            if parsed is not None:
+                expires.append(mktime_tz(parsed))
+
+        return min(expires) if expires else now + self._session_ttl
+
+    @property
+    def session_expires(self):
+        return self._session_expires
+
+    def _get_session_refresh_at(self, started, expires):
+        # short lived sessions are refreshed halfway through, never sooner than the minimum interval
+        refresh_ahead = min(self._session_refresh_ahead, max(0.0, expires - started) / 2.0)
+        return max(expires - refresh_ahead, started + HttpParkingClient.SESSION_MIN_REFRESH_INTERVAL)
+
+    def _is_session_expiring(self):
+        return self._session_expires is not None and \
+            time.time() >= self._get_session_refresh_at(self._session_started, self._session_expires)
+
+    def _ensure_session(self):
+        if self._is_login_ok and not self._is_session_expiring():
+            return
+
+        with self._login_lock:
+            # callers queued behind a login find the session it established
+            if not self._is_login_ok and not self._session_restored and self._restore_session():
+                return
+
+            if not self._is_login_ok or self._is_session_expiring():
+                self._login()
+
+    def _replace_session(self, rejected_cookie):
+        with self._login_lock:
+            # requests rejected with the same cookie log in once
+            if not self._is_login_ok or self._cookie == rejected_cookie:
+                self._login()
+
+    def _run_session_refresher(self, stop_event):
+        while not stop_event.is_set():
+            if self._session_expires is None:
+                delay = self._session_refresh_ahead or self._session_ttl
+            else:
+                delay = self._get_session_refresh_at(self._session_started, self._session_expires) - time.time()
+
+            if delay > 0 and stop_event.wait(delay):
+                break
+
+            try:
+                # a request may have refreshed the session while the refresher slept
+                self._ensure_session()
+            except Exception, e:
+                sys.stderr.write(repr(e))
+                sys.stderr.write('\n')
+                stop_event.wait(min(self._session_ttl, 30.0))
+
+    def start_session_refresher(self):
+        if self._session_refresher_stop is not None:
+            return
+
+        if not self._is_login_ok:
+            self._ensure_session()
+
+        self._session_refresher_stop = Event()
+
+        thread = Thread(target=self._run_session_refresher, args=(self._session_refresher_stop, ))
+        thread.daemon = True
+        thread.start()
+
+    def stop_session_refresher(self):
+        if self._session_refresher_stop is not None:
+            self._session_refresher_stop.set()
+            self._session_refresher_stop = None
+
+    def _get_json(self, url, params_json=None, method='GET', idempotent=None):
+        self._ensure_session()
+
+        headers = {
+            'Content-Type': 'application/json, text/javascript, */*; q=0.01',
+            'X-Requested-With': 'XMLHttpRequest'
+        }
+
+        while True:
+            cookie = self._cookie
+            http_response = self._request(method=method, url=url, params_json=params_json, headers=headers,
+                                          idempotent=idempotent)
+            json_response = json.loads(http_response.body)
+            if 'errorName' in json_response.keys():
+                self._metrics.inc('parking_api_errors_total', labels={'error': json_response['errorName']})
+                if json_response['errorName'] == 'ForbiddenError':
+                    self._metrics.inc('parking_forbidden_logins_total')
+                    self._replace_session(cookie)
+                    if self.is_login_ok:
+                        continue
+
+                raise ParkingApiError(json_response['errorName'], json_response['error'])
+
+            return json_response
+
+    def renew_reservation(self, reservation, duration):
+        if reservation.renewed:
+            raise Exception('Already renewed')
+
+        params = {
+            'reservationId': reservation.id,
+            'duration': duration
+        }
+
+        try:
+            return self._get_json(HttpParkingClient.URL_RENEW,
+                                  params_json=params,
+                                  method='PUT')
+        finally:
+            self._invalidate_account_cache()
+
+    def stop_reservation(self, reservation):
+        assert isinstance(reservation, Reservation)
+
+        params = {
+            'reservationId': reservation.id
+        }
+
+        try:
+            return self._get_json(url=HttpParkingClient.URL_CANCEL,
+                                  params_json=params,
+                                  method='PUT')
+        finally:
+            self._invalidate_account_cache()
+
+    def start_reservation(self, vehicle, zone, duration, vehicle_type=None):
+        assert (isinstance(vehicle, str) or isinstance(vehicle, unicode)) and vehicle
+        assert isinstance(zone, int) and (zone > 0)
+
+        if vehicle_type is None:
+            vehicle_type = ParkingClient.VEHICLE_TYPE_CAR
+
+        params = {
+            'zoneNumber': zone,
+            'vrp': vehicle,
+            'vehicleType': vehicle_type,
+            'duration': duration,
+            'accountId': self.account_id
+        }
+
+        try:
+            return self._get_json(url=HttpParkingClient.URL_START,
+                                  params_json=params,
+                                  method='PUT')
+        finally:
+            self._invalidate_account_cache()
+
+    def _invalidate_account_cache(self):
+        # a write may have landed upstream even when its response was lost
+        self._cache.invalidate(HttpParkingClient.CACHE_RESERVATIONS, HttpParkingClient.CACHE_BALANCE)
+
+    def _prepare_batch(self):
+        # one login and user info lookup up front, workers then share the session
+        self._get_user_info()
+
+    def _load_zones(self):
+        return self._get_json(url=HttpParkingClient.URL_ZONES, method='GET')['objects']
+
+    @property
+    def zone_catalog(self):
+        return self._zone_catalog
+
+    def get_price(self, zone, vehicle_type):
+        return self._zone_catalog.get_price(zone=zone, vehicle_type=vehicle_type)
+
+    @property
+    def quote_engine(self):
+        if self._quote_engine is None:
+            self._quote_engine = PriceQuoteEngine(catalog=self._zone_catalog, balance_loader=self.get_balance_cent)
+
+        return self._quote_engine
+
+    @property
+    def spatial_index(self):
+        if self._spatial_index is None:
+            self._spatial_index = ZoneSpatialIndex(catalog=self._zone_catalog)
+
+        return self._spatial_index
+
+    @property
+    def account_id(self):
+        return self._get_user_info()['user']['accountId']
+
+    def _load_user_info(self):
+        self._user_info_cached = self._get_json(HttpParkingClient.URL_USER_INFO)['account']
+        self._save_session()
+
+    def _get_user_info(self):
+        if self._user_info_cached is None:
+            # a restored session carries user info along with the cookie
+            self._ensure_session()
+
+        if self._user_info_cached is None:
+            # concurrent first lookups share one request
+            self._cache.get(HttpParkingClient.CACHE_USER_INFO, self._load_user_info, ttl=0)
+
+        return self._user_info_cached
+
+    def _load_reservations(self):
+        return [CompactReservation.from_json(data)
+                for data in self._get_json(HttpParkingClient.URL_RESERVATIONS)['reservations']]
+
+    def get_reservations(self):
+        return list(self._cache.get(HttpParkingClient.CACHE_RESERVATIONS, self._load_reservations))
+
+    def _load_balance_cent(self):
+        params = {
+            'accountId': self._get_user_info()['id']
+        }
+
+        # a read despite the PUT, safe to send again
+        response = self._get_json(url=HttpParkingClient.URL_BALANCE, params_json=params, method='PUT',
+                                  idempotent=True)
+
+        return response['balance']
+
+    def get_balance_cent(self):
+        return self._cache.get(HttpParkingClient.CACHE_BALANCE, self._load_balance_cent)
+
+    @property
+    def cache(self):
+        return self._cache
+
+    @property
+    def host(self):
+        return self._pool.host
+
+    @property
+    def pool_stats(self):
+        return self._pool.stats
+
+    def close(self):
+        self._pool.close()
+
+    @property
+    def is_login_ok(self):
+        return self._is_login_ok
+
+    def login(self):
+        with self._login_lock:
+            return self._login()
+
+    def _login(self):
+        self._metrics.inc('parking_logins_total')
+
+        response = self._request(method='POST',
+                                 url=HttpParkingClient.URL_LOGIN,
+                                 is_form=True,
+                                 params={'email': self._email, 'password': self._password},
+                                 idempotent=True)
+
+        self._is_login_ok = 'location' in response.headers.keys() and \
+            '?failed=true' not in response.headers['location']
+
+        if self._is_login_ok:
+            self._cookie = response.headers['set-cookie']
+            self._session_started = time.time()
+            self._session_expires = self._parse_session_expires(self._cookie)
+            self._save_session()
+        else:
+            self._session_expires = None
+
+        return response
+
+
+class FederatedReservation(Reservation):
+    __slots__ = ('_host', '_reservation')
+
+    def __init__(self, host, reservation):
+        super(FederatedReservation, self).__init__()
+
+        assert isinstance(reservation, Reservation)
+
+        self._host = host
+        self._reservation = reservation
+
+    @property
+    def host(self):
+        return self._host
+
+    @property
+    def key(self):
+        # zone numbers and plates repeat across cities
+        return self._reservation.vrp, self._reservation.zone, self._host
+
+    @property
+    def reservation(self):
+        return self._reservation
+
+    @property
+    def renewed(self):
+        return self._reservation.renewed
+
+    @property
+    def vrp(self):
+        return self._reservation.vrp
+
+    @property
+    def end(self):
+        return self._reservation.end
+
+    @property
+    def zone(self):
+        return self._reservation.zone
+
+    @property
+    def start(self):
+        return self._reservation.start
+
+    @property
+    def remaining_second(self):
+        return self._reservation.remaining_second
+
+    @property
+    def remaining_minutes(self):
+        return self._reservation.remaining_minutes
+
+    @property
+    def vehicleType(self):
+        return self._reservation.vehicleType
+
+    @property
+    def id(self):
+        return self._reservation.id
+
+    @property
+    def account(self):
+        return self._reservation.account
+
+
+class FederatedParkingClient(ParkingClient):
+    def __init__(self, clients, default_host=None, workers=None, metrics=None):
+        super(FederatedParkingClient, self).__init__()
+
+        assert isinstance(clients, dict) and len(clients) > 0
+        assert all([isinstance(client, ParkingClient) for client in clients.values()])
+        assert default_host is None or default_host in clients
+        assert metrics is None or isinstance(metrics, MetricsRegistry)
+
+        self._clients = dict(clients)
+        self._default_host = sorted(clients.keys())[0] if default_host is None else default_host
+        self._pool = WorkerPool(workers=len(clients) if workers is None else workers)
+        self._metrics = NULL_METRICS if metrics is None else metrics
+
+        self._stats_lock = Lock()
+        self._host_stats = dict((host, {'requests': 0, 'errors': 0, 'latency_last': None,
+                                        'latency_total': 0.0, 'latency_max': 0.0})
+                                for host in clients)
+        self._reservations_lock = Lock()
+        self._last_reservations = {}  # host -> list of FederatedReservation from the last successful poll
+
+    @classmethod
+    def create(cls, email, password, hosts, default_host=None, workers=None, metrics=None, **kwargs):
+        clients = dict((host, HttpParkingClient(email, password, host=host, metrics=metrics, **kwargs))
+                       for host in hosts)
+
+        return cls(clients=clients, default_host=default_host, workers=workers, metrics=metrics)
+
+    @property
+    def hosts(self):
+        return sorted(self._clients.keys())
+
+    @property
+    def default_host(self):
+        return self._default_host
+
+    def get_client(self, host=None):
+        return self._clients[self._default_host if host is None else host]
+
+    def _record_latency(self, host, latency, failed):
+        labels = {'host': host}
+        self._metrics.observe('parking_federation_request_seconds', latency, labels=labels)
+        if failed:
+            self._metrics.inc('parking_federation_errors_total', labels=labels)
+
+        with self._stats_lock:
+            stats = self._host_stats[host]
+            stats['requests'] += 1
+            stats['errors'] += 1 if failed else 0
+            stats['latency_last'] = latency
+            stats['latency_total'] += latency
+            stats['latency_max'] = max(stats['latency_max'], latency)
+
+    def _call_host(self, host, func):
+        started = time.time()
+        failed = True
+
+        try:
+            result = func(self._clients[host])
+            failed = False
+            return result
+        finally:
+            self._record_latency(host, time.time() - started, failed)
+
+    def fan_out(self, func):
+        self._pool.start()
+
+        hosts = self.hosts
+        tasks = [self._pool.submit(self._call_host, host, func) for host in hosts]
+
+        return dict((host, BatchResult(item=host,
+                                       result=None if task.error is not None else task.result,
+                                       error=task.error))
+                    for host, task in zip(hosts, tasks))
+
+    @property
+    def host_stats(self):
+        with self._stats_lock:
+            host_stats = dict((host, dict(stats)) for host, stats in self._host_stats.items())
+
+        for stats in host_stats.values():
+            stats['latency_avg'] = stats['latency_total'] / stats['requests'] if stats['requests'] else None
+
+        return host_stats
+
+    def _raise_first_error(self, results):
+        for host in sorted(results.keys()):
+            if not results[host].ok:
+                raise results[host].error
+
+    @property
+    def account_id(self):
+        return self.get_client().account_id
+
+    def get_all_reservations(self):
+        return self.fan_out(lambda client: client.get_reservations())
+
+    def get_reservations(self):
+        results = self.fan_out(lambda client: client.get_reservations())
+        reservations = []
+
+        with self._reservations_lock:
+            for host, result in sorted(results.items()):
+                if result.ok:
+                    self._last_reservations[host] = [FederatedReservation(host=host, reservation=reservation)
+                                                     for reservation in result.result]
+                elif host not in self._last_reservations:
+                    raise result.error
+                else:
+                    # an unreachable city keeps its last known reservations instead of reporting them all removed
+                    sys.stderr.write('{0}: {1}\n'.format(host, repr(result.error)))
+
+                reservations.extend(self._last_reservations[host])
+
+        return reservations
+
+    def _get_reservation_host(self, reservation):
+        if isinstance(reservation, FederatedReservation):
+            return reservation.host, reservation.reservation
+
+        return self._default_host, reservation
+
+    def renew_reservation(self, reservation, duration):
+        assert isinstance(reservation, Reservation)
+
+        host, reservation = self._get_reservation_host(reservation)
+        return self._call_host(host, lambda client: client.renew_reservation(reservation, duration))
+
+    def stop_reservation(self, reservation):
+        assert isinstance(reservation, Reservation)
+
+        host, reservation = self._get_reservation_host(reservation)
+        return self._call_host(host, lambda client: client.stop_reservation(reservation))
+
+    def start_reservation(self, vehicle, zone, duration, vehicle_type=None, host=None):
+        host = self._default_host if host is None else host
+        return self._call_host(host, lambda client: client.start_reservation(vehicle=vehicle, zone=zone,
+                                                                             duration=duration,
+                                                                             vehicle_type=vehicle_type))
+
+    def get_price(self, zone, vehicle_type, host=None):
+        host = self._default_host if host is None else host
+        return self._call_host(host, lambda client: client.get_price(zone=zone, vehicle_type=vehicle_type))
+
+    def get_prices(self, zone, vehicle_type):
+        return self.fan_out(lambda client: client.get_price(zone=zone, vehicle_type=vehicle_type))
+
+    def get_balances_cent(self):
+        return self.fan_out(lambda client: client.get_balance_cent())
+
+    def get_balance_cent(self):
+        results = self.get_balances_cent()
+        self._raise_first_error(results)
+
+        return sum([result.result for result in results.values()])
+
+    @property
+    def is_login_ok(self):
+        return all([client.is_login_ok for client in self._clients.values()])
+
+    def login(self):
+        self._raise_first_error(self.fan_out(lambda client: client.login()))
+
+    @property
+    def transfer_stats(self):
+        stats = [client.transfer_stats for client in self._clients.values()]
+        stats = [host_stats for host_stats in stats if host_stats is not None]
+        if not stats:
+            return None
+
+        return dict((key, sum([host_stats[key] for host_stats in stats])) for key in stats[0])
+
+    def _prepare_batch(self):
+        self.fan_out(lambda client: client._prepare_batch())
+
+    def close(self):
+        for client in self._clients.values():
+            if isinstance(client, HttpParkingClient):
+                client.close()
+
+        self._pool.stop(wait=False)
+
+
+class SMSClient(object):
+    HOSTNAME = 'sms.ru'
+
+    RESPONSE_SENT = 100
+    RESPONSE_INSUFFICIENT_FOUNDS = 201
+
+    MAX_RECIPIENTS = 100
+
+    def __init__(self, api_id, testing=False):
+        self._api_id = api_id
+        self._testing = testing
+
+    def send(self, to, text):
+        # one API call delivers to a comma separated recipients list
+        if isinstance(to, list):
+            assert 0 < len(to) <= SMSClient.MAX_RECIPIENTS
+            to = ','.join(to)
+
+        connection = httplib.HTTPConnection(SMSClient.HOSTNAME)
+
+        params_dict = {
+            'api_id': self._api_id,
             'to': to,
             'text': text
         }
 
-        if self._testing:
-            params_dict['test'] = 1
+        if self._testing:
+            params_dict['test'] = 1
+
+        connection.request('GET', url='/sms/send?' + urllib.urlencode(params_dict))
+        response = connection.getresponse().read().splitlines()[0]
+
+        connection.close()
+
+        return int(response)
+
+
+class SMSDeliveryQueue(object):
+    def __init__(self, sms_client, workers=2, coalesce_window=5.0, separator='\n'):
+        assert isinstance(sms_client, SMSClient)
+        assert coalesce_window >= 0
+
+        self._sms_client = sms_client
+        self._coalesce_window = coalesce_window
+        self._separator = separator
+
+        self._pool = WorkerPool(workers=workers)
+        self._condition = Condition()
+        self._pending = {}  # recipient -> list(text)
+        self._flush_at = None
+        self._thread = None
+        self._run_flag = False
+        self._exit_hook = False
+
+        self._stats = {
+            'queued': 0,
+            'sent': 0,
+            'failed': 0,
+            'api_calls': 0
+        }
+
+    @property
+    def stats(self):
+        with self._condition:
+            stats = dict(self._stats)
+            stats['pending'] = sum([len(texts) for texts in self._pending.values()])
+
+        return stats
+
+    def put(self, recipients, text):
+        with self._condition:
+            for recipient in recipients:
+                self._pending.setdefault(recipient, []).append(text)
+
+            self._stats['queued'] += len(recipients)
+
+            if self._flush_at is None:
+                self._flush_at = time.time() + self._coalesce_window
+                self._condition.notify()
+
+    def _take_batches(self):
+        pending = self._pending
+        self._pending = {}
+        self._flush_at = None
+
+        # recipients that got the same merged text share one API call
+        recipients_by_text = {}
+        for recipient, texts in pending.items():
+            recipients_by_text.setdefault(self._separator.join(texts), []).append(recipient)
+
+        batches = []
+        for text, recipients in recipients_by_text.items():
+            for offset in range(0, len(recipients), SMSClient.MAX_RECIPIENTS):
+                batches.append((recipients[offset:offset + SMSClient.MAX_RECIPIENTS], text))
+
+        return batches
+
+    def _deliver(self, recipients, text):
+        try:
+            response = self._sms_client.send(to=recipients, text=text)
+        except Exception, e:
+            response = e
+
+        with self._condition:
+            self._stats['api_calls'] += 1
+            self._stats['sent' if response == SMSClient.RESPONSE_SENT else 'failed'] += len(recipients)
+
+        if response != SMSClient.RESPONSE_SENT:
+            sys.stderr.write('SMS to {0} failed: {1}\n'.format(','.join(recipients), repr(response)))
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._run_flag and (self._flush_at is None or self._flush_at > time.time()):
+                    self._condition.wait(None if self._flush_at is None else self._flush_at - time.time())
+
+                batches = self._take_batches()
+                run_flag = self._run_flag
+
+            for recipients, text in batches:
+                self._pool.submit(self._deliver, recipients, text)
+
+            if not run_flag:
+                break
+
+    @property
+    def is_running(self):
+        return self._thread is not None
+
+    def start(self):
+        with self._condition:
+            if self.is_running:
+                return
+
+            self._run_flag = True
+            self._pool.start()
+
+            self._thread = Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+            # daemon threads die with the interpreter, a script that exits right after sending keeps its messages
+            if not self._exit_hook:
+                self._exit_hook = True
+                atexit.register(self.stop)
+
+    def stop(self):
+        if not self.is_running:
+            return
+
+        with self._condition:
+            self._run_flag = False
+            self._condition.notify()
+
+        # pending messages are flushed before workers exit
+        self._thread.join()
+        self._thread = None
+        self._pool.stop()
+
+
+class ParkingMonitor(object):
+    def __init__(self, client, metrics=None):
+        assert isinstance(client, ParkingClient)
+        assert metrics is None or isinstance(metrics, MetricsRegistry)
+
+        self._client = client
+        self._metrics = NULL_METRICS if metrics is None else metrics
+        self._observed = {}  # reservation key -> remain
+        self._apply_lock = Lock()
+        self._last_poll_bytes = None
+
+        self._new_reservation_handlers = []
+        self._remove_reservation_handlers = []
+        self._remain_changed_handlers = []
+        self._poll_handlers = []
+
+    def add_on_new_reservation_event(self, handler):
+        self._new_reservation_handlers.append(handler)
+
+    def add_on_remove_reservation_event(self, handler):
+        self._remove_reservation_handlers.append(handler)
+
+    def remove_on_new_reservation_event(self, handler):
+        self._new_reservation_handlers.remove(handler)
+
+    def remove_on_remove_reservation_event(self, handler):
+        self._remove_reservation_handlers.remove(handler)
+
+    def add_on_remain_changed_event(self, handler):
+        self._remain_changed_handlers.append(handler)
+
+    def remove_on_remain_changed_event(self, handler):
+        self._remain_changed_handlers.remove(handler)
+
+    def add_on_poll_event(self, handler):
+        self._poll_handlers.append(handler)
+
+    def remove_on_poll_event(self, handler):
+        self._poll_handlers.remove(handler)
+
+    def _try_invoke_notify_handlers(self, handlers, *args):
+        for handler in handlers:
+            try:
+                handler(*args)
+            except Exception, e:
+                self._metrics.inc('parking_monitor_handler_failures_total')
+                sys.stderr.write(repr(e))
+
+    def _on_new_reservation(self, vehicle, zone):
+        self._try_invoke_notify_handlers(self._new_reservation_handlers,
+                                         vehicle,
+                                         zone)
+
+    def _on_remove_reservation(self, vehicle, zone):
+        self._try_invoke_notify_handlers(self._remove_reservation_handlers,
+                                         vehicle,
+                                         zone)
+
+    def _on_remain_change(self, vehicle, zone, remain):
+        self._try_invoke_notify_handlers(self._remain_changed_handlers,
+                                         vehicle,
+                                         zone,
+                                         remain)
+
+    def _index_reservations(self, reservations):
+        index = {}
+
+        for reservation in reservations:
+            key = reservation.key
+            remain = reservation.remaining_minutes
+
+            if key not in index or index[key] < remain:
+                index[key] = remain
+
+        return index
+
+    def _get_changes(self, index):
+        observed = self._observed
+
+        new_keys = [key for key in index if key not in observed]
+        removed_keys = [key for key in observed if key not in index]
+        remain_changed = [(key, remain) for key, remain in index.iteritems()
+                          if key not in observed or observed[key] != remain]
 
-        connection.request('GET', url='/sms/send?' + urllib.urlencode(params_dict))
-        response = connection.getresponse().read().splitlines()[0]
+        return new_keys, removed_keys, remain_changed
 
-        connection.close()
+    def _apply_reservations(self, reservations):
+        index = self._index_reservations(reservations)
+        new_keys, removed_keys, remain_changed = self._get_changes(index)
 
-        return int(response)
+        self._observed = index
 
+        self._metrics.set('parking_monitor_reservations', len(index))
+        self._metrics.inc('parking_monitor_events_total', len(new_keys), labels={'event': 'new'})
+        self._metrics.inc('parking_monitor_events_total', len(removed_keys), labels={'event': 'remove'})
+        self._metrics.inc('parking_monitor_events_total', len(remain_changed), labels={'event': 'remain'})
 
-class ParkingMonitor(object):
-    __VEHICLE_KEY = 'vehicle'
-    __ZONE_KEY = 'zone'
-    __REMAIN_KEY = 'remain'
-    __REMAIN_MAP_KEY_FORMAT = '{0}/{1}'
+        for key in new_keys:
+            self._on_new_reservation(key[0], key[1])
+
+        for key in removed_keys:
+            self._on_remove_reservation(key[0], key[1])
+
+        for key, remain in remain_changed:
+            self._on_remain_change(key[0], key[1], remain)
+
+        self._try_invoke_notify_handlers(self._poll_handlers, reservations)
+
+    def _get_received_bytes(self):
+        transfer_stats = self._client.transfer_stats
+        return None if transfer_stats is None else transfer_stats['raw_bytes']
+
+    def _record_poll_bytes(self, received_before):
+        received_after = self._get_received_bytes()
+        if received_before is None or received_after is None:
+            return
+
+        self._last_poll_bytes = received_after - received_before
+        self._metrics.set('parking_monitor_last_poll_bytes', self._last_poll_bytes)
+
+    @property
+    def last_poll_bytes(self):
+        return self._last_poll_bytes
+
+    @property
+    def observed(self):
+        with self._apply_lock:
+            return dict(self._observed)
+
+    def restore_observed(self, observed):
+        # a monitor taking over from another one reports only what changed since
+        with self._apply_lock:
+            self._observed = dict(observed)
+
+    def measure_one_shot(self):
+        started = time.time()
+        received_before = self._get_received_bytes()
+
+        try:
+            reservations = self._client.get_reservations()
+        except Exception:
+            self._metrics.inc('parking_monitor_poll_errors_total')
+            raise
+
+        self._record_poll_bytes(received_before)
+
+        with self._apply_lock:
+            self._apply_reservations(reservations)
+
+        self._metrics.observe('parking_monitor_poll_seconds', time.time() - started)
+
+        return reservations
+
+
+class ParkingFleetMonitor(object):
+    # golden ratio fraction spreads any number of accounts evenly over the update interval
+    __STAGGER_STEP = 0.6180339887498949
+
+    def __init__(self, workers=8, update_interval=30.0, idle_update_interval=None, metrics=None):
+        assert (isinstance(update_interval, int) or isinstance(update_interval, float)) and update_interval > 0
+
+        self._metrics = metrics
+        self._pool = WorkerPool(workers=workers)
+        self._update_interval = update_interval
+        self._idle_update_interval = update_interval * 2.0 if idle_update_interval is None else idle_update_interval
+
+        self._condition = Condition()
+        self._monitors = {}  # account -> ParkingMonitor
+        self._generations = {}  # account -> int, drops heap entries of removed accounts
+        self._schedule = []  # heap of (due, generation, account)
+        self._added_count = 0
+
+        self._run_flag = False
+
+        self._new_reservation_handlers = []
+        self._remove_reservation_handlers = []
+        self._remain_changed_handlers = []
+
+    def add_on_new_reservation_event(self, handler):
+        self._new_reservation_handlers.append(handler)
+
+    def add_on_remove_reservation_event(self, handler):
+        self._remove_reservation_handlers.append(handler)
+
+    def remove_on_new_reservation_event(self, handler):
+        self._new_reservation_handlers.remove(handler)
+
+    def remove_on_remove_reservation_event(self, handler):
+        self._remove_reservation_handlers.remove(handler)
+
+    def add_on_remain_changed_event(self, handler):
+        self._remain_changed_handlers.append(handler)
+
+    def remove_on_remain_changed_event(self, handler):
+        self._remain_changed_handlers.remove(handler)
+
+    def _try_invoke_notify_handlers(self, handlers, *args):
+        for handler in handlers:
+            try:
+                handler(*args)
+            except Exception, e:
+                sys.stderr.write(repr(e))
 
-    def __init__(self, client):
+    def _subscribe_account_events(self, account, monitor):
+        monitor.add_on_new_reservation_event(
+            lambda vehicle, zone: self._try_invoke_notify_handlers(self._new_reservation_handlers,
+                                                                   account, vehicle, zone))
+        monitor.add_on_remove_reservation_event(
+            lambda vehicle, zone: self._try_invoke_notify_handlers(self._remove_reservation_handlers,
+                                                                   account, vehicle, zone))
+        monitor.add_on_remain_changed_event(
+            lambda vehicle, zone, remain: self._try_invoke_notify_handlers(self._remain_changed_handlers,
+                                                                           account, vehicle, zone, remain))
+
+    def add_account(self, account, client, observed=None):
         assert isinstance(client, ParkingClient)
 
-        self._client = client
-        self._observed_vz_map = {}  # vehicle -> list(zone), ...
-        self._observed_remain_map = {}  # vehicle/zone -> { vehicle, zone, remain }
+        monitor = ParkingMonitor(client=client, metrics=self._metrics)
+        if observed is not None:
+            monitor.restore_observed(observed)
+        self._subscribe_account_events(account, monitor)
+
+        with self._condition:
+            assert account not in self._monitors
+
+            offset = (self._added_count * ParkingFleetMonitor.__STAGGER_STEP) % 1.0 * self._update_interval
+            generation = self._generations.get(account, 0) + 1
+
+            self._added_count += 1
+            self._monitors[account] = monitor
+            self._generations[account] = generation
+
+            heapq.heappush(self._schedule, (time.time() + offset, generation, account))
+            self._condition.notify()
+
+        return monitor
+
+    def add_federation(self, client):
+        # one account per city host, a single monitor would merge equal plates and zones of different cities
+        assert isinstance(client, FederatedParkingClient)
+
+        return [self.add_account(host, client.get_client(host)) for host in client.hosts]
+
+    def remove_account(self, account):
+        with self._condition:
+            del self._monitors[account]
+            self._generations[account] += 1
+
+    @property
+    def accounts(self):
+        with self._condition:
+            return list(self._monitors.keys())
+
+    def get_monitor(self, account):
+        return self._monitors[account]
+
+    def _measure_account(self, account, monitor):
+        try:
+            return monitor.measure_one_shot()
+        except Exception, e:
+            sys.stderr.write('{0}: {1}\n'.format(account, repr(e)))
+
+    def measure_one_shot(self):
+        self._pool.start()
+
+        with self._condition:
+            monitors = dict(self._monitors)
+
+        tasks = dict((account, self._pool.submit(self._measure_account, account, monitor))
+                     for account, monitor in monitors.items())
+
+        return dict((account, task.result) for account, task in tasks.items())
+
+    def _poll_scheduled(self, account, monitor, generation):
+        reservations = self._measure_account(account, monitor)
+        interval = self._update_interval if reservations else self._idle_update_interval
+
+        with self._condition:
+            if self._generations.get(account) == generation:
+                heapq.heappush(self._schedule, (time.time() + interval, generation, account))
+                self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self._run_flag = False
+            self._condition.notify()
+
+    def run(self):
+        self._run_flag = True
+        self._pool.start()
+
+        with self._condition:
+            while self._run_flag:
+                now = time.time()
+
+                while self._schedule and self._schedule[0][0] <= now:
+                    _, generation, account = heapq.heappop(self._schedule)
+                    if self._generations.get(account) == generation:
+                        self._pool.submit(self._poll_scheduled, account, self._monitors[account], generation)
+
+                timeout = self._schedule[0][0] - now if self._schedule else None
+                self._condition.wait(timeout)
+
+        self._pool.stop(wait=False)
+
+
+class ConsistentHashRing(object):
+    def __init__(self, replicas=64):
+        assert isinstance(replicas, int) and replicas > 0
+
+        self._replicas = replicas
+        self._hashes = []  # sorted
+        self._nodes = {}  # hash -> node
+
+    def _hash(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+
+        return int(hashlib.md5(str(key)).hexdigest()[:16], 16)
+
+    @property
+    def nodes(self):
+        return sorted(set(self._nodes.values()))
+
+    def add_node(self, node):
+        for replica in xrange(self._replicas):
+            point = self._hash('{0}#{1}'.format(node, replica))
+            if point not in self._nodes:
+                bisect.insort(self._hashes, point)
+            self._nodes[point] = node
+
+    def remove_node(self, node):
+        self._hashes = [point for point in self._hashes if self._nodes[point] != node]
+        self._nodes = dict((point, self._nodes[point]) for point in self._hashes)
+
+    def get_node(self, key):
+        if not self._hashes:
+            return None
+
+        position = bisect.bisect(self._hashes, self._hash(key)) % len(self._hashes)
+        return self._nodes[self._hashes[position]]
+
+
+def _run_fleet_shard(name, commands, events, client_factory, update_interval, idle_update_interval, workers,
+                     flush_interval):
+    fleet = ParkingFleetMonitor(workers=workers, update_interval=update_interval,
+                                idle_update_interval=idle_update_interval)
+    clients = {}
+
+    buffer_lock = Lock()
+    buffer = []
+
+    def publish(event, account, vehicle, zone, remain=None):
+        with buffer_lock:
+            buffer.append((event, account, vehicle, zone, remain))
+
+    fleet.add_on_new_reservation_event(
+        lambda account, vehicle, zone: publish(ShardedFleetMonitor.EVENT_NEW, account, vehicle, zone))
+    fleet.add_on_remove_reservation_event(
+        lambda account, vehicle, zone: publish(ShardedFleetMonitor.EVENT_REMOVE, account, vehicle, zone))
+    fleet.add_on_remain_changed_event(
+        lambda account, vehicle, zone, remain: publish(ShardedFleetMonitor.EVENT_REMAIN, account, vehicle, zone,
+                                                       remain))
+
+    thread = Thread(target=fleet.run)
+    thread.daemon = True
+    thread.start()
+
+    running = True
+    while running:
+        try:
+            command = commands.get(timeout=flush_interval)
+        except Queue.Empty:
+            command = ()
+
+        if command is None:
+            running = False
+        elif command:
+            action, account, config, observed = command
+
+            try:
+                if action == ShardedFleetMonitor.COMMAND_ADD:
+                    clients[account] = client_factory(**config)
+                    fleet.add_account(account, clients[account], observed=observed)
+                else:
+                    fleet.remove_account(account)
+                    client = clients.pop(account)
+                    if isinstance(client, HttpParkingClient):
+                        client.close()
+            except Exception, e:
+                sys.stderr.write('{0}: {1}\n'.format(account, repr(e)))
+
+        # one message per flush keeps the pipe cost per event low
+        with buffer_lock:
+            batch = list(buffer)
+            del buffer[:]
+
+        if batch:
+            events.put((name, batch))
+
+    fleet.stop()
+
+
+class ShardedFleetMonitor(object):
+    EVENT_NEW = 'new'
+    EVENT_REMOVE = 'remove'
+    EVENT_REMAIN = 'remain'
+
+    COMMAND_ADD = 'add'
+    COMMAND_REMOVE = 'remove'
+
+    def __init__(self, client_factory=HttpParkingClient, update_interval=30.0, idle_update_interval=None,
+                 workers_per_shard=8, replicas=64, flush_interval=0.05, check_interval=1.0):
+        assert (isinstance(update_interval, int) or isinstance(update_interval, float)) and update_interval > 0
+
+        self._client_factory = client_factory
+        self._update_interval = update_interval
+        self._idle_update_interval = idle_update_interval
+        self._workers_per_shard = workers_per_shard
+        self._flush_interval = flush_interval
+        self._check_interval = check_interval
+
+        self._lock = Lock()
+        self._ring = ConsistentHashRing(replicas=replicas)
+        self._shards = {}  # name -> (process, commands)
+        self._shard_count = 0
+        self._configs = {}  # account -> client_factory kwargs
+        self._owners = {}  # account -> shard name
+        self._observed = {}  # account -> {(vehicle, zone): remain}, handed over when an account moves
+        self._events = multiprocessing.Queue()
+
+        self._run_flag = False
+        self._thread = None
 
         self._new_reservation_handlers = []
         self._remove_reservation_handlers = []
@@ -454,161 +3013,674 @@ class ParkingMonitor(object):
             except Exception, e:
                 sys.stderr.write(repr(e))
 
+    @property
+    def shards(self):
+        with self._lock:
+            return sorted(self._shards.keys())
+
+    @property
+    def accounts(self):
+        with self._lock:
+            return list(self._configs.keys())
+
+    def get_owner(self, account):
+        with self._lock:
+            return self._owners.get(account)
+
+    def _send(self, shard, action, account):
+        if shard not in self._shards:
+            return
+
+        config = self._configs.get(account) if action == ShardedFleetMonitor.COMMAND_ADD else None
+        observed = dict(self._observed.get(account, {})) if action == ShardedFleetMonitor.COMMAND_ADD else None
+        self._shards[shard][1].put((action, account, config, observed))
+
+    def _rebalance(self):
+        # only accounts whose ring position changed owner move
+        for account in self._configs:
+            owner = self._ring.get_node(account)
+            previous = self._owners.get(account)
+
+            if owner == previous:
+                continue
+
+            if previous is not None:
+                self._send(previous, ShardedFleetMonitor.COMMAND_REMOVE, account)
+
+            if owner is None:
+                del self._owners[account]
+            else:
+                self._owners[account] = owner
+                self._send(owner, ShardedFleetMonitor.COMMAND_ADD, account)
+
+    def add_shard(self, name=None):
+        with self._lock:
+            self._shard_count += 1
+            name = 'shard-{0}'.format(self._shard_count) if name is None else name
+            assert name not in self._shards
+
+            commands = multiprocessing.Queue()
+            process = multiprocessing.Process(target=_run_fleet_shard,
+                                              args=(name, commands, self._events, self._client_factory,
+                                                    self._update_interval, self._idle_update_interval,
+                                                    self._workers_per_shard, self._flush_interval))
+            process.daemon = True
+            process.start()
+
+            self._shards[name] = (process, commands)
+            self._ring.add_node(name)
+            self._rebalance()
+
+        return name
+
+    def _drop_shard(self, name):
+        process, commands = self._shards.pop(name)
+        self._ring.remove_node(name)
+
+        for account, owner in self._owners.items():
+            if owner == name:
+                del self._owners[account]
+
+        self._rebalance()
+
+        return process, commands
+
+    def remove_shard(self, name, timeout=None):
+        with self._lock:
+            process, commands = self._drop_shard(name)
+
+        commands.put(None)
+        process.join(timeout)
+
+    def add_account(self, account, config):
+        assert isinstance(config, dict)
+
+        with self._lock:
+            assert account not in self._configs
+
+            self._configs[account] = dict(config)
+            self._rebalance()
+
+    def remove_account(self, account):
+        with self._lock:
+            del self._configs[account]
+            self._observed.pop(account, None)
+
+            owner = self._owners.pop(account, None)
+            if owner is not None:
+                self._send(owner, ShardedFleetMonitor.COMMAND_REMOVE, account)
+
+    def _check_shards(self):
+        with self._lock:
+            dead = [name for name, (process, _) in self._shards.items() if not process.is_alive()]
+
+            for name in dead:
+                sys.stderr.write('{0} exited, rebalancing\n'.format(name))
+                self._drop_shard(name)
+
+    def _apply_events(self, shard, batch):
+        accepted = []
+
+        with self._lock:
+            for event, account, vehicle, zone, remain in batch:
+                # late events of an account that already moved away are stale
+                if self._owners.get(account) != shard:
+                    continue
+
+                observed = self._observed.setdefault(account, {})
+                if event == ShardedFleetMonitor.EVENT_REMOVE:
+                    observed.pop((vehicle, zone), None)
+                else:
+                    observed[(vehicle, zone)] = remain if remain is not None else observed.get((vehicle, zone))
+
+                accepted.append((event, account, vehicle, zone, remain))
+
+        for event, account, vehicle, zone, remain in accepted:
+            if event == ShardedFleetMonitor.EVENT_NEW:
+                self._try_invoke_notify_handlers(self._new_reservation_handlers, account, vehicle, zone)
+            elif event == ShardedFleetMonitor.EVENT_REMOVE:
+                self._try_invoke_notify_handlers(self._remove_reservation_handlers, account, vehicle, zone)
+            else:
+                self._try_invoke_notify_handlers(self._remain_changed_handlers, account, vehicle, zone, remain)
+
+    def _pump(self):
+        while self._run_flag:
+            try:
+                shard, batch = self._events.get(timeout=self._check_interval)
+            except Queue.Empty:
+                shard, batch = None, None
+
+            if batch:
+                self._apply_events(shard, batch)
+
+            self._check_shards()
+
+    def start(self, shards=None):
+        if self._thread is not None:
+            return
+
+        for _ in xrange(multiprocessing.cpu_count() if shards is None else shards):
+            self.add_shard()
+
+        self._run_flag = True
+        self._thread = Thread(target=self._pump)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        for name in self.shards:
+            self.remove_shard(name)
+
+        self._run_flag = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def reservation_to_dict(reservation):
+    assert isinstance(reservation, Reservation)
+
+    return {
+        'id': reservation.id,
+        'account': reservation.account,
+        'vrp': reservation.vrp,
+        'zone': reservation.zone,
+        'vehicleType': reservation.vehicleType,
+        'renewed': reservation.renewed,
+        'start': time.mktime(reservation.start.timetuple()),
+        'end': time.mktime(reservation.end.timetuple()),
+        'remaining_second': reservation.remaining_second
+    }
+
+
+class MonitorFanoutServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    EVENT_NEW = 'new'
+    EVENT_REMOVE = 'remove'
+    EVENT_REMAIN = 'remain'
+    EVENT_SNAPSHOT = 'snapshot'
+
+    class RequestHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, data):
+            body = json.dumps(data)
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _get_sequence(self, value):
+            try:
+                return int(value)
+            except (TypeError, ValueError):
+                return None
+
+        def _do_snapshot(self, query):
+            self._send_json(self.server.get_snapshot())
+
+        def _get_timeout(self, value):
+            try:
+                timeout = float(value)
+            except (TypeError, ValueError):
+                return None
+
+            if math.isinf(timeout) or math.isnan(timeout) or timeout < 0:
+                return None
+
+            return min(timeout, self.server.poll_timeout)
+
+        def _do_poll(self, query):
+            since = self._get_sequence(query.get('since', [None])[0])
+            timeout = self._get_timeout(query.get('timeout', [self.server.poll_timeout])[0])
+            if timeout is None:
+                self.send_error(400, 'Invalid timeout')
+                return
+
+            self._send_json(self.server.wait_events(since=since, timeout=timeout))
+
+        def _write_sse(self, sequence, event, data):
+            self.wfile.write('id: {0}\nevent: {1}\ndata: {2}\n\n'.format(sequence, event, json.dumps(data)))
+            self.wfile.flush()
+
+        def _do_events(self, query):
+            self.close_connection = 1
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+
+            server = self.server
+            since = self._get_sequence(self.headers.getheader('last-event-id'))
+
+            try:
+                while server.is_serving:
+                    update = server.wait_events(since=since, timeout=server.keepalive_interval)
+
+                    if 'snapshot' in update:
+                        self._write_sse(update['sequence'], MonitorFanoutServer.EVENT_SNAPSHOT, update['snapshot'])
+
+                    for event in update['events']:
+                        self._write_sse(event['sequence'], event['event'], event)
+
+                    if 'snapshot' not in update and not update['events']:
+                        self.wfile.write(': keepalive\n\n')
+                        self.wfile.flush()
+
+                    since = update['sequence']
+            except socket.error:
+                pass
+
+        def do_GET(self):
+            parsed = urlparse.urlparse(self.path)
+            handler = {
+                '/snapshot': self._do_snapshot,
+                '/poll': self._do_poll,
+                '/events': self._do_events
+            }.get(parsed.path)
+
+            if handler is None:
+                self.send_error(404)
+                return
+
+            handler(urlparse.parse_qs(parsed.query))
+
+    def __init__(self, monitor, address=('127.0.0.1', 8090), update_interval=30.0, history_size=1024,
+                 poll_timeout=30.0, keepalive_interval=15.0):
+        HTTPServer.__init__(self, address, MonitorFanoutServer.RequestHandler)
+
+        assert isinstance(monitor, ParkingMonitor)
+        assert update_interval > 0
+        assert history_size > 0
+
+        self._monitor = monitor
+        self._update_interval = update_interval
+        self.poll_timeout = poll_timeout
+        self.keepalive_interval = keepalive_interval
+
+        self._condition = Condition()  # subscribers wait here for published events
+        self._stop_event = Event()  # the poll loop waits here, events never cut its interval short
+        self._events = collections.deque(maxlen=history_size)  # event dicts ordered by sequence
+        self._sequence = 0
+        self._snapshot = {'sequence': 0, 'updated': None, 'reservations': []}
+
+        self._run_flag = False
+        self._threads = []
+
+        monitor.add_on_new_reservation_event(self._on_new_reservation)
+        monitor.add_on_remove_reservation_event(self._on_remove_reservation)
+        monitor.add_on_remain_changed_event(self._on_remain_change)
+        monitor.add_on_poll_event(self._on_poll)
+
+    @property
+    def is_serving(self):
+        return self._run_flag
+
+    def _publish(self, event, vehicle, zone, **extra):
+        with self._condition:
+            self._sequence += 1
+
+            data = {'sequence': self._sequence, 'event': event, 'vehicle': vehicle, 'zone': zone, 'time': time.time()}
+            data.update(extra)
+
+            self._events.append(data)
+            self._condition.notify_all()
+
     def _on_new_reservation(self, vehicle, zone):
-        self._try_invoke_notify_handlers(self._new_reservation_handlers,
-                                         vehicle,
-                                         zone)
+        self._publish(MonitorFanoutServer.EVENT_NEW, vehicle, zone)
 
     def _on_remove_reservation(self, vehicle, zone):
-        self._try_invoke_notify_handlers(self._remove_reservation_handlers,
-                                         vehicle,
-                                         zone)
+        self._publish(MonitorFanoutServer.EVENT_REMOVE, vehicle, zone)
+
+    def _on_remain_change(self, vehicle, zone, remain):
+        self._publish(MonitorFanoutServer.EVENT_REMAIN, vehicle, zone, remain=remain)
+
+    def _on_poll(self, reservations):
+        snapshot = [reservation_to_dict(reservation) for reservation in reservations]
+
+        with self._condition:
+            self._snapshot = {'sequence': self._sequence, 'updated': time.time(), 'reservations': snapshot}
+
+    def get_snapshot(self):
+        with self._condition:
+            return dict(self._snapshot)
+
+    def wait_events(self, since, timeout):
+        deadline = time.time() + timeout
+
+        with self._condition:
+            while self._run_flag and since is not None and since >= self._sequence and time.time() < deadline:
+                self._condition.wait(deadline - time.time())
+
+            update = {'sequence': self._sequence}
+
+            # unknown or evicted position: start over from the current snapshot
+            oldest = self._events[0]['sequence'] if self._events else self._sequence + 1
+            if since is None or since > self._sequence or since + 1 < oldest:
+                update['snapshot'] = dict(self._snapshot)
+                update['events'] = [event for event in self._events if event['sequence'] > self._snapshot['sequence']]
+            else:
+                update['events'] = [event for event in self._events if event['sequence'] > since]
+
+            return update
+
+    def _poll(self):
+        while self._run_flag:
+            try:
+                self._monitor.measure_one_shot()
+            except Exception, e:
+                sys.stderr.write(repr(e))
+                sys.stderr.write('\n')
+
+            self._stop_event.wait(self._update_interval)
+
+    def handle_error(self, request, client_address):
+        # subscribers dropping long polls and event streams, also on stop(), are not errors
+        if isinstance(sys.exc_info()[1], socket.error):
+            return
+
+        HTTPServer.handle_error(self, request, client_address)
+
+    def start(self):
+        self._run_flag = True
+        self._stop_event.clear()
+
+        for target in (self._poll, self.serve_forever):
+            thread = Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        with self._condition:
+            self._run_flag = False
+            self._condition.notify_all()
+        self._stop_event.set()
+
+        self.shutdown()
+        self.server_close()
+
+
+class ReservationHistoryStore(object):
+    # reservations rows are written once and touched again only on renewal and when they disappear,
+    # so the database grows with parking sessions rather than with the number of polls
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS reservations ('
+        'id, source TEXT, account, vrp TEXT, zone INTEGER, vehicle_type TEXT, renewed INTEGER, '
+        'start REAL, end REAL, first_seen REAL, last_seen REAL, PRIMARY KEY (source, id))',
+        'CREATE INDEX IF NOT EXISTS reservations_vrp ON reservations (vrp, start)',
+        'CREATE INDEX IF NOT EXISTS reservations_zone ON reservations (zone, start)',
+        'CREATE INDEX IF NOT EXISTS reservations_start ON reservations (start)',
+        'CREATE INDEX IF NOT EXISTS reservations_active ON reservations (source) WHERE last_seen IS NULL',
+        'CREATE TABLE IF NOT EXISTS events ('
+        'time REAL, source TEXT, event TEXT, vrp TEXT, zone INTEGER, remain INTEGER)',
+        'CREATE INDEX IF NOT EXISTS events_vrp ON events (vrp, time)',
+        'CREATE INDEX IF NOT EXISTS events_zone ON events (zone, time)',
+        'CREATE INDEX IF NOT EXISTS events_time ON events (time)'
+    )
+
+    RESERVATION_COLUMNS = ('id', 'source', 'account', 'vrp', 'zone', 'vehicleType', 'renewed',
+                           'start', 'end', 'first_seen', 'last_seen')
+    EVENT_COLUMNS = ('time', 'source', 'event', 'vrp', 'zone', 'remain')
+
+    EVENT_NEW = 'new'
+    EVENT_REMOVE = 'remove'
+    EVENT_REMAIN = 'remain'
+    EVENT_RENEW = 'renew'
+
+    def __init__(self, path, record_remain=False, batch_size=256):
+        assert isinstance(batch_size, int) and batch_size > 0
+
+        self._path = path
+        self._record_remain = record_remain
+        self._batch_size = batch_size
+
+        self._lock = Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._queue = Queue.Queue()
+        self._subscriptions = {}  # id(monitor) -> (monitor, handlers)
+        self._thread = None
+
+        with self._lock:
+            if path != ':memory:':
+                self._connection.execute('PRAGMA journal_mode=WAL')
+                self._connection.execute('PRAGMA synchronous=NORMAL')
+
+            for statement in ReservationHistoryStore.SCHEMA:
+                self._connection.execute(statement)
+            self._connection.commit()
+
+            # source -> {id: (end, renewed)} of reservations that have not disappeared yet
+            self._active = collections.defaultdict(dict)
+            for source, id, end, renewed in self._connection.execute(
+                    'SELECT source, id, end, renewed FROM reservations WHERE last_seen IS NULL'):
+                self._active[source][id] = (end, renewed)
+
+    def attach(self, monitor, source=''):
+        assert isinstance(monitor, ParkingMonitor)
+        assert id(monitor) not in self._subscriptions
+
+        handlers = (
+            lambda vehicle, zone: self._put_event(source, ReservationHistoryStore.EVENT_NEW, vehicle, zone),
+            lambda vehicle, zone: self._put_event(source, ReservationHistoryStore.EVENT_REMOVE, vehicle, zone),
+            lambda vehicle, zone, remain: self._put_event(source, ReservationHistoryStore.EVENT_REMAIN,
+                                                          vehicle, zone, remain),
+            lambda reservations: self._put_poll(source, reservations)
+        )
+
+        monitor.add_on_new_reservation_event(handlers[0])
+        monitor.add_on_remove_reservation_event(handlers[1])
+        if self._record_remain:
+            monitor.add_on_remain_changed_event(handlers[2])
+        monitor.add_on_poll_event(handlers[3])
+
+        self._subscriptions[id(monitor)] = (monitor, handlers)
+        self.start()
+
+    def detach(self, monitor):
+        monitor, handlers = self._subscriptions.pop(id(monitor))
+
+        monitor.remove_on_new_reservation_event(handlers[0])
+        monitor.remove_on_remove_reservation_event(handlers[1])
+        if self._record_remain:
+            monitor.remove_on_remain_changed_event(handlers[2])
+        monitor.remove_on_poll_event(handlers[3])
+
+    def _put_event(self, source, event, vehicle, zone, remain=None):
+        self._queue.put(('event', (time.time(), source, event, vehicle, zone, remain)))
+
+    def _put_poll(self, source, reservations):
+        # reservations are flattened on the poll thread, the writer never touches client objects
+        rows = [reservation_to_dict(reservation) for reservation in reservations]
+        self._queue.put(('poll', (time.time(), source, rows)))
+
+    def _write_event(self, cursor, item):
+        cursor.execute('INSERT INTO events (time, source, event, vrp, zone, remain) VALUES (?, ?, ?, ?, ?, ?)',
+                       item)
+
+    def _write_poll(self, cursor, item):
+        polled, source, rows = item
+        active = self._active[source]
+        seen = set()
+
+        for row in rows:
+            id = row['id']
+            state = (row['end'], int(row['renewed']))
+            seen.add(id)
+
+            if id not in active:
+                # an id that disappeared and came back is active again, its row loses the stale last_seen
+                cursor.execute('UPDATE reservations SET account = ?, vrp = ?, zone = ?, vehicle_type = ?, '
+                               'renewed = ?, start = ?, end = ?, last_seen = NULL WHERE id = ? AND source = ?',
+                               (row['account'], row['vrp'], row['zone'], row['vehicleType'],
+                                state[1], row['start'], state[0], id, source))
+                if cursor.rowcount == 0:
+                    cursor.execute('INSERT INTO reservations '
+                                   '(id, source, account, vrp, zone, vehicle_type, renewed, start, end, first_seen) '
+                                   'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                   (id, source, row['account'], row['vrp'], row['zone'], row['vehicleType'],
+                                    state[1], row['start'], state[0], polled))
+            elif active[id] != state:
+                cursor.execute('UPDATE reservations SET end = ?, renewed = ? WHERE id = ? AND source = ?',
+                               state + (id, source))
+                if state[0] > active[id][0]:
+                    self._write_event(cursor, (polled, source, ReservationHistoryStore.EVENT_RENEW,
+                                               row['vrp'], row['zone'], None))
+
+            active[id] = state
+
+        for id in [id for id in active if id not in seen]:
+            cursor.execute('UPDATE reservations SET last_seen = ? WHERE id = ? AND source = ?', (polled, id, source))
+            del active[id]
+
+    def _write_batch(self, batch):
+        with self._lock:
+            cursor = self._connection.cursor()
+
+            try:
+                for kind, item in batch:
+                    if kind == 'event':
+                        self._write_event(cursor, item)
+                    else:
+                        self._write_poll(cursor, item)
+
+                self._connection.commit()
+            except sqlite3.Error, e:
+                self._connection.rollback()
+                sys.stderr.write(repr(e))
+                sys.stderr.write('\n')
 
-    def _on_remain_change(self, vehicle, zone, remain):
-        self._try_invoke_notify_handlers(self._remain_changed_handlers,
-                                         vehicle,
-                                         zone,
-                                         remain)
+    def _run(self):
+        running = True
+
+        while running:
+            batch = [self._queue.get()]
 
-    def _create_vz_map(self, reservations):
-        vz_map = {}
+            while len(batch) < self._batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
 
-        for vehicle in set([r.vrp for r in reservations]):
-            vz_map[vehicle] = set([r.zone for r in reservations if r.vrp == vehicle])
+            running = batch[-1] is not None
+            items = [entry for entry in batch if entry is not None]
 
-        return vz_map
+            if items:
+                self._write_batch(items)
 
-    def _create_remain_map(self, reservations):
-        vzt_map = {}
+            for _ in batch:
+                self._queue.task_done()
 
-        for vehicle in set([r.vrp for r in reservations]):
-            for zone in set([r.zone for r in reservations if r.vrp == vehicle]):
-                vzt_map[ParkingMonitor.__REMAIN_MAP_KEY_FORMAT.format(vehicle, zone)] = {
-                    ParkingMonitor.__VEHICLE_KEY: vehicle,
-                    ParkingMonitor.__ZONE_KEY: zone,
-                    ParkingMonitor.__REMAIN_KEY: max(
-                        [r.remaining_minutes for r in reservations if r.vrp == vehicle and r.zone == zone]
-                    )
-                }
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
 
-        return vzt_map
+            self._thread = Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
 
-    def _apply_vz_map_diff(self, vz_map=None, vz_map_to_insert=None, vz_map_to_remove=None):
-        if vz_map is None:
-            vz_map = self._observed_vz_map
+    def flush(self):
+        self._queue.join()
 
-        if not vz_map_to_insert is None:
-            for vehicle in vz_map_to_insert:
-                if vehicle not in vz_map.keys():
-                    vz_map[vehicle] = vz_map_to_insert[vehicle]
-                else:
-                    for zone in vz_map_to_insert[vehicle]:
-                        if zone not in vz_map[vehicle]:
-                            vz_map[vehicle].add(zone)
+    def close(self):
+        for monitor, _ in self._subscriptions.values():
+            self.detach(monitor)
 
-        if not vz_map_to_remove is None:
-            for vehicle in vz_map_to_remove.keys():
-                if vehicle in vz_map.keys():
-                    for zone in vz_map_to_remove[vehicle]:
-                        if zone in vz_map[vehicle]:
-                            vz_map[vehicle].remove(zone)
+        with self._lock:
+            thread = self._thread
+            self._thread = None
 
-                        if len(vz_map[vehicle]) == 0:
-                            del vz_map[vehicle]
-                            break
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
 
-        return vz_map if vz_map != self._observed_vz_map else None
+        with self._lock:
+            self._connection.close()
 
-    def _apply_remain_map(self, update, remain_map=None):
-        if remain_map is None:
-            remain_map = self._observed_remain_map
+    def _build_filter(self, time_column, vehicle, zone, source, until, extra=None):
+        conditions = []
+        params = []
 
-        remain_map.update(update)
+        for column, value in (('vrp', vehicle), ('zone', zone), ('source', source)) + (extra or ()):
+            if value is not None:
+                conditions.append('{0} = ?'.format(column))
+                params.append(value)
 
-        return remain_map if remain_map != remain_map else None
+        if until is not None:
+            conditions.append('{0} < ?'.format(time_column))
+            params.append(until)
 
-    def _get_remain_update(self, remain_map):
-        update = {}
-        observed = self._observed_remain_map
+        return conditions, params
 
-        for key in remain_map.keys():
-            remain = remain_map[key][ParkingMonitor.__REMAIN_KEY]
+    def _query(self, sql, params, columns):
+        with self._lock:
+            return [dict(zip(columns, row)) for row in self._connection.execute(sql, params)]
 
-            if key not in observed.keys() or observed[key][ParkingMonitor.__REMAIN_KEY] != remain:
-                update[key] = remain_map[key].copy()
+    def get_reservations(self, vehicle=None, zone=None, source=None, since=None, until=None, limit=None):
+        conditions, params = self._build_filter('start', vehicle, zone, source, until)
 
-        return update
+        # overlap with [since, until): a reservation lasts until it disappeared or, while active, its end
+        if since is not None:
+            conditions.append('COALESCE(last_seen, end) >= ?')
+            params.append(since)
 
-    def _get_vz_map_diff(self, old_map, new_map):
-        assert isinstance(old_map, dict)
-        assert isinstance(new_map, dict)
+        sql = 'SELECT id, source, account, vrp, zone, vehicle_type, renewed, start, end, first_seen, last_seen ' \
+              'FROM reservations'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY start'
+        if limit is not None:
+            sql += ' LIMIT {0:d}'.format(limit)
 
-        diff_vz_map = {}
+        return self._query(sql, params, ReservationHistoryStore.RESERVATION_COLUMNS)
 
-        old_vehicles = old_map.keys()
+    def get_events(self, vehicle=None, zone=None, source=None, since=None, until=None, event=None, limit=None):
+        conditions, params = self._build_filter('time', vehicle, zone, source, until,
+                                                extra=(('event', event), ))
 
-        for new_vehicle in new_map.keys():
-            if new_vehicle not in old_vehicles:
-                diff_vz_map[new_vehicle] = set(new_map[new_vehicle])
-            else:
-                diff = list(old_map[new_vehicle] - new_map[new_vehicle])
-                if len(diff):
-                    diff_vz_map[new_vehicle] = diff
-
-        return diff_vz_map
-
-    def _get_new_vz_map(self, reservation_vz_map):
-        return self._get_vz_map_diff(old_map=self._observed_vz_map,
-                                     new_map=reservation_vz_map)
-
-    def _get_removed_vz_map(self, reservation_vz_map):
-        return self._get_vz_map_diff(old_map=reservation_vz_map,
-                                     new_map=self._observed_vz_map)
-
-    def _visit_vz_map(self, vz_map, func):
-        for vehicle in vz_map.keys():
-            for zone in vz_map[vehicle]:
-                func(vehicle=vehicle, zone=zone)
-
-    def _visit_remain_map(self, remain_map, func):
-        for key in remain_map.keys():
-            element = remain_map[key]
-            func(
-                vehicle=element[ParkingMonitor.__VEHICLE_KEY],
-                zone=element[ParkingMonitor.__ZONE_KEY],
-                remain=element[ParkingMonitor.__REMAIN_KEY]
-            )
-
-    def _clean_remain_map(self, reservations):
-        keys = self._observed_remain_map.keys()
-        for reservation in reservations:
-            key = ParkingMonitor.__REMAIN_MAP_KEY_FORMAT.format(reservation.vrp, reservation.zone)
-            if key not in keys:
-                del self._observed_remain_map[key]
+        if since is not None:
+            conditions.append('time >= ?')
+            params.append(since)
 
-    def measure_one_shot(self):
-        reservations = self._client.get_reservations()
-        reservation_vz_map = self._create_vz_map(reservations=reservations)
-        remain_map = self._create_remain_map(reservations=reservations)
+        sql = 'SELECT time, source, event, vrp, zone, remain FROM events'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY time'
+        if limit is not None:
+            sql += ' LIMIT {0:d}'.format(limit)
 
-        # changes
-        new_vz_map = self._get_new_vz_map(reservation_vz_map)
-        removed_vz_map = self._get_removed_vz_map(reservation_vz_map)
+        return self._query(sql, params, ReservationHistoryStore.EVENT_COLUMNS)
 
-        self._visit_vz_map(new_vz_map, self._on_new_reservation)
-        self._visit_vz_map(removed_vz_map, self._on_remove_reservation)
+    def get_zone_occupancy(self, since, until, source=None):
+        sql = 'SELECT zone, COUNT(*), SUM(MIN(COALESCE(last_seen, end), ?) - MAX(start, ?)) FROM reservations ' \
+              'WHERE start < ? AND COALESCE(last_seen, end) >= ?'
+        params = [until, since, until, since]
 
-        self._apply_vz_map_diff(vz_map_to_insert=new_vz_map, vz_map_to_remove=removed_vz_map)
+        if source is not None:
+            sql += ' AND source = ?'
+            params.append(source)
 
-        # time tick
-        remain_update = self._get_remain_update(remain_map)
+        sql += ' GROUP BY zone ORDER BY zone'
 
-        self._visit_remain_map(remain_update, self._on_remain_change)
+        return self._query(sql, params, ('zone', 'reservations', 'seconds'))
 
-        self._apply_remain_map(remain_update)
-        self._clean_remain_map(reservations)
+    def prune(self, before):
+        self.flush()
 
-        return reservations
+        with self._lock:
+            self._connection.execute('DELETE FROM events WHERE time < ?', (before, ))
+            self._connection.execute('DELETE FROM reservations WHERE last_seen IS NOT NULL AND last_seen < ?',
+                                     (before, ))
+            self._connection.commit()
 
 
 class NotifyBackend(object):
@@ -647,19 +3719,33 @@ class UnixPipeNotifyBackend(NotifyBackend):
 
 
 class SMSNotifyBackend(NotifyBackend):
-    def __init__(self, sms_client, recipients):
+    def __init__(self, sms_client, recipients, delivery_queue=None):
         super(SMSNotifyBackend, self).__init__()
 
         assert isinstance(sms_client, SMSClient)
         assert isinstance(recipients, list)
         assert all([isinstance(recipient, str) or isinstance(recipient, unicode) for recipient in recipients])
+        assert delivery_queue is None or isinstance(delivery_queue, SMSDeliveryQueue)
 
         self._sms_client = sms_client
         self._recipients = recipients
+        self._delivery_queue = delivery_queue  # None sends synchronously
+
+    @property
+    def delivery_queue(self):
+        return self._delivery_queue
 
     def send(self, text):
-        for recipient in self._recipients:
-            self._sms_client.send(to=recipient, text=text)
+        if self._delivery_queue is not None:
+            self._delivery_queue.start()
+            self._delivery_queue.put(recipients=self._recipients, text=text)
+            return
+
+        for offset in range(0, len(self._recipients), SMSClient.MAX_RECIPIENTS):
+            recipients = self._recipients[offset:offset + SMSClient.MAX_RECIPIENTS]
+            response = self._sms_client.send(to=recipients, text=text)
+            if response != SMSClient.RESPONSE_SENT:
+                sys.stderr.write('SMS to {0} failed: {1}\n'.format(','.join(recipients), repr(response)))
 
 
 class NotifyMessageFormatter(object):
@@ -727,18 +3813,23 @@ class NotifyFormatterRussian(NotifyMessageFormatter):
 
 
 class NotifyFilter(object):
+    # account is None for a single monitor and the fleet account otherwise
     def __init__(self):
         pass
 
-    def new_reservation_filter(self, vehicle, zone):
+    def new_reservation_filter(self, vehicle, zone, account=None):
         return True
 
-    def remove_reservation_filter(self, vehicle, zone):
+    def remove_reservation_filter(self, vehicle, zone, account=None):
         return True
 
-    def remain_filter(self, vehicle, zone, remain):
+    def remain_filter(self, vehicle, zone, remain, account=None):
         return True
 
+    def reservation_removed(self, vehicle, zone, account=None):
+        # called for every removed reservation, whether or not any filter lets the message through
+        pass
+
 
 class SimpleNotifyFilter(NotifyFilter):
     def __init__(self, deny_new=False, deny_remove=False, deny_remain=False):
@@ -748,92 +3839,282 @@ class SimpleNotifyFilter(NotifyFilter):
         self._deny_remove = deny_remove
         self._deny_remain = deny_remain
 
-    def new_reservation_filter(self, vehicle, zone):
+    def new_reservation_filter(self, vehicle, zone, account=None):
         return not self._deny_new
 
-    def remove_reservation_filter(self, vehicle, zone):
+    def remove_reservation_filter(self, vehicle, zone, account=None):
         return not self._deny_remove
 
-    def remain_filter(self, vehicle, zone, remain):
+    def remain_filter(self, vehicle, zone, remain, account=None):
         return not self._deny_remain
 
 
 class RemainStageNotifyFilter(NotifyFilter):
+    class _State(object):
+        __slots__ = ('last_remain', 'last_stage')
+
+        def __init__(self, last_remain):
+            self.last_remain = last_remain
+            self.last_stage = sys.maxint
+
     def __init__(self):
         super(RemainStageNotifyFilter, self).__init__()
 
-        self._stages = set()
-        self._remain_sent = {}
-        self._last_remain = {}
+        self._stages = []  # sorted
+        self._vehicle_stages = {}  # vehicle -> sorted stages, overrides zone and default stages
+        self._zone_stages = {}  # zone -> sorted stages, overrides default stages
+        self._states = {}  # (account, vehicle, zone) -> _State
 
-    def _get_vz_key(self, vehicle, zone):
-        return '{0}/{1}'.format(vehicle, zone)
+    def _get_stages(self, vehicle, zone):
+        stages = self._vehicle_stages.get(vehicle)
+        if stages is None:
+            stages = self._zone_stages.get(zone, self._stages)
 
-    def _try_get_dict_value(self, vehicle, zone, dictionary, default):
-        key = self._get_vz_key(vehicle=vehicle, zone=zone)
-        return dictionary[key] if key in dictionary.keys() else default
+        return stages
 
-    def _set_dict_value(self, vehicle, zone, dictionary, value):
-        key = self._get_vz_key(vehicle=vehicle, zone=zone)
-        if not value is None:
-            dictionary[key] = value
+    def _set_profile(self, profiles, key, stages):
+        if stages is None:
+            profiles.pop(key, None)
         else:
-            if key in dictionary.keys():
-                del dictionary[key]
+            profiles[key] = sorted(set(stages))
+
+    def clean(self):
+        for key in [key for key, state in self._states.iteritems() if state.last_stage == 0]:
+            del self._states[key]
 
-        self.clean()
+    @property
+    def stages(self):
+        return list(self._stages)
 
-    def _get_last_remain_sent(self, vehicle, zone):
-        return self._try_get_dict_value(vehicle=vehicle, zone=zone, dictionary=self._remain_sent, default=sys.maxint)
+    @property
+    def all_stages(self):
+        stages = set(self._stages)
+        for profile in self._vehicle_stages.values() + self._zone_stages.values():
+            stages.update(profile)
 
-    def _get_last_remain(self, vehicle, zone):
-        return self._try_get_dict_value(vehicle=vehicle, zone=zone, dictionary=self._remain_sent, default=-1)
+        return sorted(stages)
 
-    def _set_last_remain_sent(self, vehicle, zone, remain):
-        self._set_dict_value(vehicle=vehicle, zone=zone, dictionary=self._remain_sent, value=remain)
+    def add_remain_stage(self, remain):
+        position = bisect.bisect_left(self._stages, remain)
+        if position == len(self._stages) or self._stages[position] != remain:
+            self._stages.insert(position, remain)
 
-    def _reset_last_remain_sent(self, vehicle, zone):
-        self._set_last_remain_sent(vehicle=vehicle, zone=zone, remain=None)
+    def remove_remain_stage(self, remain):
+        position = bisect.bisect_left(self._stages, remain)
+        if position < len(self._stages) and self._stages[position] == remain:
+            del self._stages[position]
 
-    def _set_last_remain(self, vehicle, zone, remain):
-        self._set_dict_value(vehicle=vehicle, zone=zone, dictionary=self._last_remain, value=remain)
+    def set_vehicle_stages(self, vehicle, stages):
+        self._set_profile(self._vehicle_stages, vehicle, stages)
 
-    def clean(self):
-        for key in self._remain_sent.keys():
-            if self._remain_sent[key] == 0:
-                del self._remain_sent[key]
+    def set_zone_stages(self, zone, stages):
+        self._set_profile(self._zone_stages, zone, stages)
 
-    def add_remain_stage(self, remain):
-        self._stages.add(remain)
+    def forget(self, vehicle, zone, account=None):
+        self._states.pop((account, vehicle, zone), None)
 
-    def remove_remain_stage(self, remain):
-        if remain in self._stages:
-            self._stages.remove(remain)
+    def reservation_removed(self, vehicle, zone, account=None):
+        self.forget(vehicle=vehicle, zone=zone, account=account)
 
-    def remain_filter(self, vehicle, zone, remain):
-        if len(self._stages) == 0:
+    def remain_filter(self, vehicle, zone, remain, account=None):
+        stages = self._get_stages(vehicle=vehicle, zone=zone)
+        if len(stages) == 0:
             return True
 
-        if remain > self._get_last_remain(vehicle=vehicle, zone=zone):
-            self._reset_last_remain_sent(vehicle=vehicle, zone=zone)
+        key = (account, vehicle, zone)
+        state = self._states.get(key)
+
+        if state is None:
+            state = self._states[key] = RemainStageNotifyFilter._State(remain)
+        elif remain > state.last_remain:
+            # renewed, every stage is due again
+            state.last_stage = sys.maxint
+
+        state.last_remain = remain
+
+        # the lowest stage at or above remain is the one just reached, higher ones are covered by it
+        position = bisect.bisect_left(stages, remain)
+        if position == len(stages) or stages[position] >= state.last_stage:
+            return False
+
+        state.last_stage = stages[position]
+        return True
+
+
+class DeadlinePollScheduler(object):
+    def __init__(self, stages=None, min_interval=5.0, max_interval=300.0, slack=2.0):
+        assert 0 < min_interval <= max_interval
+        assert slack >= 0
+
+        self._stages = stages if stages is not None else []
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._slack = slack
+
+    def _get_stages(self):
+        if isinstance(self._stages, RemainStageNotifyFilter):
+            return self._stages.all_stages
+
+        return sorted(self._stages)
+
+    def _get_thresholds(self):
+        # whole remaining minutes reach a stage once fewer than (stage + 1) minutes are left;
+        # threshold 0 is the end of the reservation
+        return [0] + [stage * 60 + 59 for stage in self._get_stages() if stage >= 0]
+
+    def next_interval(self, reservations):
+        thresholds = self._get_thresholds()
+        interval = self._max_interval
+
+        for reservation in reservations:
+            remaining = reservation.remaining_second
+            position = bisect.bisect_left(thresholds, remaining)
+
+            if position > 0:
+                interval = min(interval, remaining - thresholds[position - 1] + self._slack)
+
+        return max(self._min_interval, interval)
+
+
+def send_to_backend(backend, text, metrics=NULL_METRICS):
+    labels = {'backend': type(backend).__name__}
+    started = time.time()
+
+    try:
+        backend.send(text=text)
+    except Exception, e:
+        metrics.inc('parking_notify_failures_total', labels=labels)
+        sys.stderr.write(repr(e))
+        sys.stderr.write('\n')
+        return False
+
+    metrics.observe('parking_notify_seconds', time.time() - started, labels=labels)
+    metrics.inc('parking_notify_sent_total', labels=labels)
+
+    return True
+
+
+class BackendDispatchQueue(object):
+    OVERFLOW_DROP_OLDEST = 'drop_oldest'
+    OVERFLOW_BLOCK = 'block'
+    OVERFLOW_COALESCE = 'coalesce'
+
+    def __init__(self, backend, max_size=64, overflow=OVERFLOW_DROP_OLDEST, separator='\n', metrics=None):
+        assert isinstance(backend, NotifyBackend)
+        assert metrics is None or isinstance(metrics, MetricsRegistry)
+        assert isinstance(max_size, int) and max_size > 0
+        assert overflow in (BackendDispatchQueue.OVERFLOW_DROP_OLDEST,
+                            BackendDispatchQueue.OVERFLOW_BLOCK,
+                            BackendDispatchQueue.OVERFLOW_COALESCE)
+
+        self._backend = backend
+        self._max_size = max_size
+        self._overflow = overflow
+        self._separator = separator
+        self._metrics = NULL_METRICS if metrics is None else metrics
+        self._labels = {'backend': type(backend).__name__}
+
+        self._condition = Condition()
+        self._queue = collections.deque()  # (enqueued_at, text)
+        self._thread = None
+        self._run_flag = False
+
+        self._stats = {
+            'sent': 0,
+            'failed': 0,
+            'dropped': 0,
+            'coalesced': 0,
+            'latency_total': 0.0,
+            'latency_max': 0.0
+        }
+
+    @property
+    def backend(self):
+        return self._backend
+
+    @property
+    def stats(self):
+        with self._condition:
+            stats = dict(self._stats)
+            stats['backend'] = type(self._backend).__name__
+            stats['backlog'] = len(self._queue)
+
+        return stats
+
+    def put(self, text):
+        with self._condition:
+            if len(self._queue) >= self._max_size:
+                if self._overflow == BackendDispatchQueue.OVERFLOW_DROP_OLDEST:
+                    self._queue.popleft()
+                    self._stats['dropped'] += 1
+                    self._metrics.inc('parking_notify_dropped_total', labels=self._labels)
+                elif self._overflow == BackendDispatchQueue.OVERFLOW_COALESCE:
+                    enqueued_at, last_text = self._queue.pop()
+                    self._queue.append((enqueued_at, last_text + self._separator + text))
+                    self._stats['coalesced'] += 1
+                    return
+                else:
+                    while self._run_flag and len(self._queue) >= self._max_size:
+                        self._condition.wait()
+
+            self._queue.append((time.time(), text))
+            self._metrics.set('parking_notify_backlog', len(self._queue), labels=self._labels)
+            self._condition.notify_all()
+
+    def _send(self, enqueued_at, text):
+        failed = not send_to_backend(self._backend, text, self._metrics)
+        latency = time.time() - enqueued_at
+
+        with self._condition:
+            self._stats['failed' if failed else 'sent'] += 1
+            self._stats['latency_total'] += latency
+            self._stats['latency_max'] = max(self._stats['latency_max'], latency)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._run_flag and not self._queue:
+                    self._condition.wait()
+
+                if not self._queue:
+                    break
+
+                enqueued_at, text = self._queue.popleft()
+                self._metrics.set('parking_notify_backlog', len(self._queue), labels=self._labels)
+                self._condition.notify_all()
 
-        self._set_last_remain(vehicle=vehicle, zone=zone, remain=remain)
+            self._send(enqueued_at, text)
 
-        last_remain = self._get_last_remain_sent(vehicle=vehicle, zone=zone)
-        passed = False
+    def start(self):
+        with self._condition:
+            if self._thread is not None:
+                return
+
+            self._run_flag = True
+
+            self._thread = Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
 
-        for stage in sorted(self._stages, reverse=True):
-            if remain <= stage:
-                if last_remain > stage:
-                    self._set_last_remain_sent(vehicle=vehicle, zone=zone, remain=stage)
-                    passed = True
+    def stop(self, wait=False):
+        with self._condition:
+            if self._thread is None:
+                return
+
+            thread = self._thread
+            self._thread = None
+            self._run_flag = False
+            self._condition.notify_all()
 
-        return passed
+        # the worker drains the backlog before exiting
+        if wait:
+            thread.join()
 
 
 class ParkingMonitorNotifier(object):
     def __init__(self, monitor, notify_backend, formatter,
-                 message_filter=None, update_interval=30.0, idle_update_interval=None):
+                 message_filter=None, update_interval=30.0, idle_update_interval=None, poll_scheduler=None,
+                 dispatch_queue_size=None, dispatch_overflow=None, metrics=None):
 
         if not isinstance(notify_backend, list):
             notify_backend_list = [notify_backend, ]
@@ -845,12 +4126,15 @@ class ParkingMonitorNotifier(object):
         else:
             message_filter_list = list(message_filter)
 
-        assert isinstance(monitor, ParkingMonitor)
+        assert monitor is None or isinstance(monitor, ParkingMonitor)
         assert all([isinstance(e, NotifyBackend) for e in notify_backend_list])
         assert all([isinstance(e, NotifyFilter) for e in message_filter_list])
         assert isinstance(formatter, NotifyMessageFormatter)
         assert (isinstance(update_interval, int) or isinstance(update_interval, float)) and update_interval > 0
-        assert idle_update_interval is None or (isinstance(idle_update_interval, int) and idle_update_interval > 0)
+        assert idle_update_interval is None or \
+            ((isinstance(idle_update_interval, int) or isinstance(idle_update_interval, float)) and idle_update_interval > 0)
+        assert poll_scheduler is None or isinstance(poll_scheduler, DeadlinePollScheduler)
+        assert metrics is None or isinstance(metrics, MetricsRegistry)
 
         self._monitor = monitor
         self._notify_backend = notify_backend_list
@@ -858,47 +4142,127 @@ class ParkingMonitorNotifier(object):
         self._formatter = formatter
         self._update_interval = update_interval
         self._idle_update_interval = update_interval * 2.0 if idle_update_interval is None else idle_update_interval
+        self._poll_scheduler = poll_scheduler
+        self._metrics = NULL_METRICS if metrics is None else metrics
+
+        if dispatch_queue_size is None:
+            self._dispatch_queues = None
+        else:
+            overflow = BackendDispatchQueue.OVERFLOW_DROP_OLDEST if dispatch_overflow is None else dispatch_overflow
+            self._dispatch_queues = [BackendDispatchQueue(backend=backend, max_size=dispatch_queue_size,
+                                                          overflow=overflow, metrics=metrics)
+                                     for backend in notify_backend_list]
 
+        self._fleets = {}  # id(fleet) -> (fleet, handlers)
         self._run_flag = False
 
+    def _get_poll_interval(self, reservations):
+        if len(reservations) == 0:
+            return self._idle_update_interval
+
+        if self._poll_scheduler is None:
+            return self._update_interval
+
+        return self._poll_scheduler.next_interval(reservations)
+
     def _notify_send(self, text):
+        if self._dispatch_queues is not None:
+            for dispatch_queue in self._dispatch_queues:
+                dispatch_queue.put(text)
+            return
+
         for backend in self.notify_backend:
-            backend.send(text=text)
+            send_to_backend(backend, text, self._metrics)
 
-    def _on_new_reservation(self, vehicle, zone):
+    def _start_dispatch(self):
+        for dispatch_queue in self._dispatch_queues or []:
+            dispatch_queue.start()
+
+    def _stop_dispatch(self):
+        for dispatch_queue in self._dispatch_queues or []:
+            dispatch_queue.stop()
+
+    @property
+    def dispatch_stats(self):
+        return [dispatch_queue.stats for dispatch_queue in self._dispatch_queues or []]
+
+    def _notify_account_send(self, account, text):
+        if account is not None:
+            if isinstance(account, unicode):
+                account = account.encode('utf-8')
+            text = '{0}: {1}'.format(account, text)
+
+        self._notify_send(text)
+
+    def _on_new_reservation(self, vehicle, zone, account=None):
         for message_filter in self._message_filter:
-            if not message_filter.new_reservation_filter(vehicle=vehicle, zone=zone):
+            if not message_filter.new_reservation_filter(vehicle=vehicle, zone=zone, account=account):
                 return
 
-        self._notify_send(self._formatter.get_new_reservation_message(vehicle=vehicle,
-                                                                      zone=zone))
+        self._notify_account_send(account, self._formatter.get_new_reservation_message(vehicle=vehicle,
+                                                                                       zone=zone))
+
+    def _on_remove_reservation(self, vehicle, zone, account=None):
+        for message_filter in self._message_filter:
+            message_filter.reservation_removed(vehicle=vehicle, zone=zone, account=account)
 
-    def _on_remove_reservation(self, vehicle, zone):
         for message_filter in self._message_filter:
-            if not message_filter.remove_reservation_filter(vehicle=vehicle, zone=zone):
+            if not message_filter.remove_reservation_filter(vehicle=vehicle, zone=zone, account=account):
                 return
 
-        self._notify_send(self._formatter.get_remove_reservation_message(vehicle=vehicle,
-                                                                         zone=zone))
+        self._notify_account_send(account, self._formatter.get_remove_reservation_message(vehicle=vehicle,
+                                                                                          zone=zone))
 
-    def _on_reservation_remain_change(self, vehicle, zone, remain):
+    def _on_reservation_remain_change(self, vehicle, zone, remain, account=None):
         for message_filter in self._message_filter:
-            if not message_filter.remain_filter(vehicle=vehicle, zone=zone, remain=remain):
+            if not message_filter.remain_filter(vehicle=vehicle, zone=zone, remain=remain, account=account):
                 return
 
-        self._notify_send(self._formatter.get_remain_message(vehicle=vehicle,
-                                                             zone=zone,
-                                                             remain=remain))
+        self._notify_account_send(account, self._formatter.get_remain_message(vehicle=vehicle,
+                                                                              zone=zone,
+                                                                              remain=remain))
 
     def _subscribe_monitor_events(self):
+        if self._monitor is None:
+            return
+
         self._monitor.add_on_new_reservation_event(self._on_new_reservation)
         self._monitor.add_on_remove_reservation_event(self._on_remove_reservation)
         self._monitor.add_on_remain_changed_event(self._on_reservation_remain_change)
 
     def _remove_monitor_events(self):
+        if self._monitor is None:
+            return
+
         self._monitor.remove_on_new_reservation_event(self._on_new_reservation)
         self._monitor.remove_on_remove_reservation_event(self._on_remove_reservation)
-        self._monitor.remove_on_remove_reservation_event(self._on_reservation_remain_change)
+        self._monitor.remove_on_remain_changed_event(self._on_reservation_remain_change)
+
+    def attach_fleet(self, fleet):
+        assert isinstance(fleet, ParkingFleetMonitor) or isinstance(fleet, ShardedFleetMonitor)
+        assert id(fleet) not in self._fleets
+
+        # fleet events carry the account first, it keeps filter state and messages of accounts apart
+        handlers = (
+            lambda account, vehicle, zone: self._on_new_reservation(vehicle, zone, account),
+            lambda account, vehicle, zone: self._on_remove_reservation(vehicle, zone, account),
+            lambda account, vehicle, zone, remain: self._on_reservation_remain_change(vehicle, zone, remain,
+                                                                                      account)
+        )
+
+        fleet.add_on_new_reservation_event(handlers[0])
+        fleet.add_on_remove_reservation_event(handlers[1])
+        fleet.add_on_remain_changed_event(handlers[2])
+
+        self._fleets[id(fleet)] = (fleet, handlers)
+        self._start_dispatch()
+
+    def detach_fleet(self, fleet):
+        fleet, handlers = self._fleets.pop(id(fleet))
+
+        fleet.remove_on_new_reservation_event(handlers[0])
+        fleet.remove_on_remove_reservation_event(handlers[1])
+        fleet.remove_on_remain_changed_event(handlers[2])
 
     @property
     def notify_backend(self):
@@ -907,46 +4271,489 @@ class ParkingMonitorNotifier(object):
     def stop(self):
         self._run_flag = False
         self._remove_monitor_events()
+        self._stop_dispatch()
 
     def run(self):
         self._run_flag = True
         self._subscribe_monitor_events()
+        self._start_dispatch()
 
         while self._run_flag:
+            if self._monitor is None:
+                # attached fleets push their events, there is nothing to poll here
+                time.sleep(self._update_interval)
+                continue
+
             try:
                 reservations = self._monitor.measure_one_shot()
-                time.sleep(self._update_interval if len(reservations) > 0 else self._idle_update_interval)
+                time.sleep(self._get_poll_interval(reservations))
             except Exception, e:
                 sys.stderr.write(repr(e))
                 sys.stderr.write('\n')
 
 
-def wait_and_start_reservation(client, vehicle, zone, duration, wait):
+def create_renewal_retry_policy():
+    # any failure is worth another try while the car stands unpaid, the HTTP layer already failed fast
+    return RetryPolicy(retries=16, base_delay=1.0, max_delay=60.0, retryable=(Exception, ))
+
+
+def wait_and_start_reservation(client, vehicle, zone, duration, wait, retry_policy=None):
     assert isinstance(client, ParkingClient)
+    assert retry_policy is None or isinstance(retry_policy, RetryPolicy)
+
+    if retry_policy is None:
+        retry_policy = create_renewal_retry_policy()
+
+    def on_retry(error):
+        sys.stderr.write(repr(error))
+        sys.stderr.write('\n')
 
     time.sleep(wait)
-    retries_remain = 16
-    while True:
+    retry_policy.call(lambda: client.start_reservation(vehicle=vehicle, zone=zone, duration=duration),
+                      on_retry=on_retry)
+
+    print('Хитрое продление {0} в зоне {1} на {2} мин. :)'.format(vehicle, zone, duration))
+    print('Осталось {0} денег.'.format(client.get_balance_cent() / 100))
+
+
+class RenewalScheduler(object):
+    ACTION_START = 'start'
+    ACTION_RENEW = 'renew'
+
+    def __init__(self, client, workers=4, state_path=None, retry_policy=None):
+        assert isinstance(client, ParkingClient)
+        assert retry_policy is None or isinstance(retry_policy, RetryPolicy)
+
+        self._client = client
+        self._pool = WorkerPool(workers=workers)
+        self._state_path = state_path
+        self._retry_policy = create_renewal_retry_policy() if retry_policy is None else retry_policy
+
+        self._condition = Condition()
+        self._jobs = {}  # (vehicle, zone) -> job dict, at most one pending job per parked car
+        self._generations = {}  # (vehicle, zone) -> int, drops heap entries of replaced and cancelled jobs
+        self._schedule = []  # heap of (due, generation, key)
+
+        self._run_flag = False
+        self._thread = None
+
+        self._done_handlers = []
+
+        if state_path is not None:
+            self._load()
+
+    def add_on_job_done_event(self, handler):
+        self._done_handlers.append(handler)
+
+    def remove_on_job_done_event(self, handler):
+        self._done_handlers.remove(handler)
+
+    def _try_invoke_notify_handlers(self, handlers, *args):
+        for handler in handlers:
+            try:
+                handler(*args)
+            except Exception, e:
+                sys.stderr.write(repr(e))
+
+    def _load(self):
+        if not os.path.exists(self._state_path):
+            return
+
         try:
-            client.start_reservation(vehicle=vehicle, zone=zone, duration=duration)
-            break
-        except Exception, e:
+            with open(self._state_path, 'rb') as state:
+                jobs = json.load(state)
+        except (IOError, ValueError), e:
             sys.stderr.write(repr(e))
-            sys.stderr.write('\n')
-            retries_remain -= 1
-            if retries_remain > 0:
-                sys.stderr.write(repr(e))
+            return
+
+        with self._condition:
+            for job in jobs:
+                self._push(job)
+
+    def _save(self):
+        if self._state_path is None:
+            return
+
+        temp_path = self._state_path + '.tmp'
+        with open(temp_path, 'wb') as output:
+            json.dump(sorted(self._jobs.values(), key=lambda job: job['due']), output)
+
+        os.rename(temp_path, self._state_path)
+
+    def _push(self, job):
+        key = (job['vehicle'], job['zone'])
+        generation = self._generations.get(key, 0) + 1
+
+        self._jobs[key] = job
+        self._generations[key] = generation
+
+        heapq.heappush(self._schedule, (job['due'], generation, key))
+        self._condition.notify()
+
+    def schedule(self, action, vehicle, zone, duration, delay, vehicle_type=None):
+        assert action in (RenewalScheduler.ACTION_START, RenewalScheduler.ACTION_RENEW)
+        assert delay >= 0
+
+        job = {
+            'action': action,
+            'vehicle': vehicle,
+            'zone': zone,
+            'duration': duration,
+            'vehicle_type': vehicle_type,
+            'due': time.time() + delay,
+            'attempt': 0
+        }
+
+        # a newer job for the same car replaces the pending one
+        with self._condition:
+            self._push(job)
+            self._save()
+
+        return job
+
+    def schedule_start(self, vehicle, zone, duration, delay, vehicle_type=None):
+        return self.schedule(RenewalScheduler.ACTION_START, vehicle, zone, duration, delay, vehicle_type)
+
+    def schedule_renew(self, vehicle, zone, duration, delay):
+        return self.schedule(RenewalScheduler.ACTION_RENEW, vehicle, zone, duration, delay)
+
+    def cancel(self, vehicle, zone):
+        key = (vehicle, zone)
+
+        with self._condition:
+            job = self._jobs.pop(key, None)
+            if job is None:
+                return False
+
+            self._generations[key] += 1
+            self._save()
+
+        return True
+
+    @property
+    def jobs(self):
+        with self._condition:
+            return sorted([dict(job) for job in self._jobs.values()], key=lambda job: job['due'])
+
+    def _execute(self, job):
+        if job['action'] == RenewalScheduler.ACTION_START:
+            return self._client.start_reservation(vehicle=job['vehicle'], zone=job['zone'],
+                                                  duration=job['duration'], vehicle_type=job['vehicle_type'])
+
+        reservation = first(reservation for reservation in self._client.get_reservations()
+                            if reservation.vrp == job['vehicle'] and reservation.zone == job['zone'])
+        if reservation is None:
+            raise Exception(u'No reservation of {0} in zone {1}'.format(job['vehicle'], job['zone']))
+
+        return self._client.renew_reservation(reservation, job['duration'])
+
+    def _fire(self, key, generation, job):
+        error = None
+
+        try:
+            self._execute(job)
+        except Exception, e:
+            error = e
+
+        with self._condition:
+            if self._generations.get(key) != generation:
+                return
+
+            # retries go back to the heap instead of sleeping on a worker
+            if error is not None and self._retry_policy.is_retryable(error) and \
+                    job['attempt'] + 1 < self._retry_policy.retries:
+                sys.stderr.write(repr(error))
                 sys.stderr.write('\n')
-                time.sleep(1)
-                continue
+
+                job['attempt'] += 1
+                job['due'] = time.time() + self._retry_policy.get_delay(job['attempt'] - 1)
+                self._jobs[key] = job
+                heapq.heappush(self._schedule, (job['due'], generation, key))
+                self._condition.notify()
+                self._save()
+                return
+
+            del self._jobs[key]
+            self._generations[key] += 1
+            self._save()
+
+        self._try_invoke_notify_handlers(self._done_handlers, job, error)
+
+    def _run(self):
+        with self._condition:
+            while self._run_flag:
+                now = time.time()
+
+                while self._schedule and self._schedule[0][0] <= now:
+                    _, generation, key = heapq.heappop(self._schedule)
+                    if self._generations.get(key) == generation:
+                        self._pool.submit(self._fire, key, generation, dict(self._jobs[key]))
+
+                timeout = self._schedule[0][0] - now if self._schedule else None
+                self._condition.wait(timeout)
+
+    def start(self):
+        with self._condition:
+            if self._thread is not None:
+                return
+
+            self._run_flag = True
+            self._pool.start()
+
+            self._thread = Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, wait=True):
+        with self._condition:
+            thread = self._thread
+            self._thread = None
+            self._run_flag = False
+            self._condition.notify()
+
+        if thread is not None:
+            thread.join()
+
+        # pending jobs stay in the state file and resume on the next start
+        self._pool.stop(wait=wait)
+
+
+class ParkingDaemon(ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    DEFAULT_SOCKET_PATH = os.path.expanduser('~/.parking.sock')
+
+    class RequestHandler(StreamRequestHandler):
+        def handle(self):
+            # one JSON request per line, one JSON response per line
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    break
+
+                self.wfile.write(json.dumps(self.server.handle_request(line)))
+                self.wfile.write('\n')
+
+    def __init__(self, clients, socket_path=DEFAULT_SOCKET_PATH, default_account=None):
+        if not isinstance(clients, dict):
+            clients = {'default': clients}
+
+        assert len(clients) > 0
+        assert all([isinstance(client, ParkingClient) for client in clients.values()])
+        assert default_account is None or default_account in clients
+
+        self._clients = dict(clients)
+        self._default_account = sorted(clients.keys())[0] if default_account is None else default_account
+        self._started = time.time()
+
+        # a socket left over by a crashed daemon would fail the bind, one of a running daemon is kept
+        if os.path.exists(socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_path)
+            except socket.error:
+                os.remove(socket_path)
             else:
-                raise e
+                raise Exception('Another daemon is listening on {0}'.format(socket_path))
+            finally:
+                probe.close()
 
-    print('Хитрое продление {0} в зоне {1} на {2} мин. :)'.format(vehicle, zone, duration))
-    print('Осталось {0} денег.'.format(client.get_balance_cent() / 100))
+        # anyone who can connect acts on the account, so the socket is created 0600 rather than chmod-ed later
+        umask = os.umask(0177)
+        try:
+            ThreadingUnixStreamServer.__init__(self, socket_path, ParkingDaemon.RequestHandler)
+        finally:
+            os.umask(umask)
+
+        self._commands = {
+            'start': self._start,
+            'renew': self._renew,
+            'stop': self._stop,
+            'balance': self._balance,
+            'price': self._price,
+            'status': self._status
+        }
+
+    def warm_up(self):
+        # login, user info and zones are paid once here instead of on every command
+        for account, client in self._clients.items():
+            try:
+                client.account_id
+                if isinstance(client, HttpParkingClient):
+                    client.zone_catalog.objects
+                    client.start_session_refresher()
+            except Exception, e:
+                sys.stderr.write('{0}: {1}\n'.format(account, repr(e)))
 
+    def _find_reservation(self, client, vehicle, zone):
+        reservation = first(reservation for reservation in client.get_reservations()
+                            if reservation.vrp == vehicle and reservation.zone == zone)
+        if reservation is None:
+            raise Exception(u'No reservation of {0} in zone {1}'.format(vehicle, zone))
 
-if __name__ == '__main__':
+        return reservation
+
+    def _start(self, client, vehicle, zone, duration, vehicle_type=None):
+        return client.start_reservation(vehicle=vehicle, zone=zone, duration=duration, vehicle_type=vehicle_type)
+
+    def _renew(self, client, vehicle, zone, duration):
+        return client.renew_reservation(self._find_reservation(client, vehicle, zone), duration)
+
+    def _stop(self, client, vehicle, zone):
+        return client.stop_reservation(self._find_reservation(client, vehicle, zone))
+
+    def _balance(self, client):
+        return client.get_balance_cent()
+
+    def _price(self, client, zone, vehicle_type=ParkingClient.VEHICLE_TYPE_CAR):
+        return client.get_price(zone=zone, vehicle_type=vehicle_type)
+
+    def _status(self, client):
+        status = {
+            'uptime': time.time() - self._started,
+            'reservations': [reservation_to_dict(reservation) for reservation in client.get_reservations()]
+        }
+
+        if isinstance(client, HttpParkingClient):
+            status['session_expires'] = client.session_expires
+            status['pool'] = client.pool_stats
+
+        return status
+
+    def handle_request(self, line):
+        try:
+            request = json.loads(line)
+            handler = self._commands.get(request.get('command'))
+            if handler is None:
+                raise Exception('Unknown command {0}'.format(request.get('command')))
+
+            client = self._clients[request.get('account') or self._default_account]
+            return {'ok': True, 'result': handler(client, **request.get('args', {}))}
+        except Exception, e:
+            return {'ok': False, 'error': unicode(e), 'name': getattr(e, 'name', type(e).__name__)}
+
+    def start(self):
+        thread = Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+class ParkingDaemonClient(object):
+    def __init__(self, socket_path=ParkingDaemon.DEFAULT_SOCKET_PATH, timeout=60.0):
+        self._socket_path = socket_path
+        self._timeout = timeout
+
+    def call(self, command, account=None, **args):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(self._timeout)
+
+        try:
+            connection.connect(self._socket_path)
+            connection.sendall(json.dumps({'command': command, 'account': account, 'args': args}) + '\n')
+
+            response = connection.makefile('rb').readline()
+        finally:
+            connection.close()
+
+        if not response:
+            raise Exception('Daemon closed the connection')
+
+        response = json.loads(response)
+        if not response['ok']:
+            raise ParkingApiError(response['name'], response['error'])
+
+        return response['result']
+
+
+def run_daemon(args):
+    password = args.password if args.password is not None else os.environ.get('PARKING_PASSWORD')
+    if not args.email or not password:
+        raise Exception('--email and --password (or PARKING_PASSWORD) are required')
+
+    session_store = None if args.session_file is None else JsonFileSessionStore(args.session_file)
+    client = HttpParkingClient(args.email, password, connection_retries=8, host=args.host,
+                               secure=not args.insecure, session_store=session_store)
+
+    daemon = ParkingDaemon(clients=client, socket_path=args.socket)
+    daemon.warm_up()
+
+    try:
+        daemon.serve_forever()
+    finally:
+        daemon.server_close()
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        client.close()
+
+
+def run_command(args):
+    command_args = dict((name, getattr(args, name)) for name in args.command_args)
+
+    try:
+        result = ParkingDaemonClient(socket_path=args.socket).call(args.command, account=args.account, **command_args)
+    except (ParkingApiError, socket.error), e:
+        # daemon errors carry plates, which are unicode
+        sys.stderr.write(u'{0}\n'.format(unicode(e)).encode('utf-8'))
+        sys.exit(1)
+
+    if args.command == 'balance':
+        print('Осталось {0} денег.'.format(result / 100))
+    elif isinstance(result, dict) or isinstance(result, list):
+        print(json.dumps(result, indent=2, sort_keys=True))
+    elif result is not None:
+        print(result)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='parking client daemon and commands')
+    parser.add_argument('--socket', default=ParkingDaemon.DEFAULT_SOCKET_PATH)
+    parser.add_argument('--account', default=None)
+    subparsers = parser.add_subparsers(dest='command')
+
+    daemon_parser = subparsers.add_parser('daemon', help='keep a logged in client behind a unix socket')
+    daemon_parser.add_argument('--email', default=os.environ.get('PARKING_EMAIL'))
+    daemon_parser.add_argument('--password', default=None)
+    daemon_parser.add_argument('--host', default=None)
+    daemon_parser.add_argument('--insecure', action='store_true', help='plain http, for fakeserver.py')
+    daemon_parser.add_argument('--session-file', default=None)
+    daemon_parser.set_defaults(func=run_daemon)
+
+    vehicle_zone_parsers = []
+    for command, help_text in (('start', 'start a reservation'), ('renew', 'renew a reservation'),
+                               ('stop', 'stop a reservation')):
+        command_parser = subparsers.add_parser(command, help=help_text)
+        command_parser.add_argument('vehicle', type=lambda value: value.decode('utf-8'))
+        command_parser.add_argument('zone', type=int)
+        vehicle_zone_parsers.append(command_parser)
+
+    vehicle_zone_parsers[0].add_argument('--duration', type=int, default=60)
+    vehicle_zone_parsers[0].add_argument('--vehicle-type', dest='vehicle_type', default=None)
+    vehicle_zone_parsers[0].set_defaults(command_args=('vehicle', 'zone', 'duration', 'vehicle_type'))
+    vehicle_zone_parsers[1].add_argument('--duration', type=int, default=60)
+    vehicle_zone_parsers[1].set_defaults(command_args=('vehicle', 'zone', 'duration'))
+    vehicle_zone_parsers[2].set_defaults(command_args=('vehicle', 'zone'))
+
+    subparsers.add_parser('balance', help='account balance').set_defaults(command_args=())
+
+    price_parser = subparsers.add_parser('price', help='zone price per hour in cents')
+    price_parser.add_argument('zone', type=int)
+    price_parser.add_argument('--vehicle-type', dest='vehicle_type', default=ParkingClient.VEHICLE_TYPE_CAR)
+    price_parser.set_defaults(command_args=('zone', 'vehicle_type'))
+
+    subparsers.add_parser('status', help='reservations and session of the daemon').set_defaults(command_args=())
+
+    args = parser.parse_args(argv)
+    getattr(args, 'func', run_command)(args)
+
+
+def run_example():
     jew_auto_renew = True  # хитрое продление
     start_now = True  # начать прямо сейчас
     user_email = 'example@domain.tld'
@@ -975,19 +4782,39 @@ if __name__ == '__main__':
     remain_filter.add_remain_stage(60)
 
     if jew_auto_renew:
-        on_reservation_ends = lambda v, z: Thread(target=wait_and_start_reservation,
-                                                  args=(parking_client, v, z, 60, 60 * 10)).start()
+        renewal_scheduler = RenewalScheduler(client=parking_client, state_path='renewals.json')
+
+        def on_renewal_done(job, error):
+            if error is not None:
+                print('Не вышло хитрое продление {0} в зоне {1}: {2}'.format(job['vehicle'], job['zone'], repr(error)))
+                return
+
+            print('Хитрое продление {0} в зоне {1} на {2} мин. :)'.format(job['vehicle'], job['zone'], job['duration']))
+            print('Осталось {0} денег.'.format(parking_client.get_balance_cent() / 100))
 
+        on_reservation_ends = lambda v, z: renewal_scheduler.schedule_start(vehicle=v, zone=z, duration=60,
+                                                                            delay=60 * 10)
+
+        renewal_scheduler.add_on_job_done_event(on_renewal_done)
         parking_monitor.add_on_remove_reservation_event(on_reservation_ends)
+        renewal_scheduler.start()
 
     notifiers = [stdout_notify_backend, sms_notify_backend] if sms_enabled else [stdout_notify_backend, ]
     monitor_notifier = ParkingMonitorNotifier(monitor=parking_monitor,
                                               notify_backend=notifiers,
                                               formatter=messages_formatter,
                                               message_filter=[remain_filter, deny_new_reservation_notify_filter],
-                                              update_interval=32)
+                                              update_interval=32,
+                                              poll_scheduler=DeadlinePollScheduler(stages=remain_filter))
 
     if start_now:
         parking_client.start_reservation(vehicle='А123ВЕ59', zone=101, duration=60)
 
     monitor_notifier.run()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(sys.argv[1:])
+    else:
+        run_example()
@@ -0,0 +1,977 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Denis Vesnin, https://github.com/aeromg'
+
+import os
+import sys
+import json
+import stat
+import time
+import zlib
+import random
+import shutil
+import struct
+import tempfile
+import httplib
+import socket
+import unittest
+import StringIO
+from threading import Thread, Event
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+import parking
+from parking import CircuitBreaker, CircuitOpenError, RetryPolicy, HttpParkingClient, RequestNotConfirmedError, \
+    ParkingMonitor, MonitorFanoutServer, ReservationHistoryStore, ParkingDaemon, ParkingMonitorNotifier, \
+    RemainStageNotifyFilter, SimpleNotifyFilter, NotifyFormatterRussian, NotifyBackend, ParkingFleetMonitor, \
+    FederatedParkingClient, PriceQuoteEngine, ZoneCatalog, ZoneSpatialIndex, \
+    SMSClient, SMSDeliveryQueue, SMSNotifyBackend, BackendDispatchQueue, ResponseCache
+from fakeserver import FakeParkingState, FakeParkingServer
+
+
+class CountingServer(HTTPServer):
+    def __init__(self, handler_class):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), handler_class)
+        self.requests = []
+
+        thread = Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def host(self):
+        return '{0}:{1}'.format(*self.server_address)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class CorruptGzipHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        body = 'definitely not gzip'
+
+        self.send_response(200)
+        self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class EncodedHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # large enough to arrive in several read chunks even compressed
+    BODY = ''.join('{0:08x}'.format(random.getrandbits(32)) for _ in xrange(16384))
+
+    def log_message(self, format, *args):
+        pass
+
+    def _encode(self, wbits):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, wbits)
+        return compressor.compress(EncodedHandler.BODY) + compressor.flush()
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        encoding, body = {
+            '/gzip': ('gzip', self._encode(16 + zlib.MAX_WBITS)),
+            '/deflate': ('deflate', self._encode(zlib.MAX_WBITS)),
+            '/raw-deflate': ('deflate', self._encode(-zlib.MAX_WBITS))
+        }[self.path]
+
+        self.send_response(200)
+        self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StalledHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _stall(self):
+        self.server.requests.append((self.command, self.path))
+        time.sleep(0.5)
+        self.close_connection = 1
+
+    do_GET = _stall
+    do_PUT = _stall
+
+
+class LostResponseHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self):
+        self.server.requests.append((self.command, self.path))
+        self.rfile.read(int(self.headers.getheader('content-length', 0)))
+
+        # the first request to a /lost path is processed but its response never arrives
+        if self.path.startswith('/lost') and (self.command, self.path) not in self.server.requests[:-1]:
+            self.close_connection = 1
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('ok')
+
+    def do_GET(self):
+        self._handle()
+
+    def do_PUT(self):
+        self._handle()
+
+
+class RetryPolicyCircuitBreakerTest(unittest.TestCase):
+    def _open_breaker(self, policy, host):
+        def fail():
+            raise socket.error('down')
+
+        with self.assertRaises(socket.error):
+            policy.call(fail, host=host)
+
+        breaker = policy.get_breaker(host)
+        self.assertEqual(breaker.state, CircuitBreaker.STATE_OPEN)
+        return breaker
+
+    def test_non_retryable_trial_reopens_breaker(self):
+        policy = RetryPolicy(retries=1, base_delay=0, failure_threshold=1, reset_timeout=0.01)
+        breaker = self._open_breaker(policy, 'host')
+        time.sleep(0.02)
+
+        def corrupt():
+            raise ValueError('not retryable')
+
+        with self.assertRaises(ValueError):
+            policy.call(corrupt, host='host')
+
+        self.assertEqual(breaker.state, CircuitBreaker.STATE_OPEN)
+
+        # once the reset timeout is over again a new trial gets through and closes the breaker
+        time.sleep(0.02)
+        self.assertEqual(policy.call(lambda: 'ok', host='host'), 'ok')
+        self.assertEqual(breaker.state, CircuitBreaker.STATE_CLOSED)
+
+    def test_open_breaker_refuses_calls(self):
+        policy = RetryPolicy(retries=1, base_delay=0, failure_threshold=1, reset_timeout=60)
+        self._open_breaker(policy, 'host')
+
+        with self.assertRaises(CircuitOpenError):
+            policy.call(lambda: 'ok', host='host')
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def _gated_loader(self, value, calls):
+        gate = Event()
+
+        def load():
+            calls.append(value)
+            gate.wait()
+            return value
+
+        return gate, load
+
+    def _get_in_thread(self, cache, loader, results):
+        thread = Thread(target=lambda: results.append(cache.get('reservations', loader, ttl=60)))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _wait_for(self, predicate, timeout=2.0):
+        deadline = time.time() + timeout
+        while not predicate() and time.time() < deadline:
+            time.sleep(0.01)
+        return predicate()
+
+    def test_write_during_read_does_not_cache_stale_result(self):
+        cache = ResponseCache()
+        calls = []
+        stale_gate, load_stale = self._gated_loader('stale', calls)
+        fresh_gate, load_fresh = self._gated_loader('fresh', calls)
+
+        # a read and a waiter share one request
+        stale_results = []
+        stale_readers = [self._get_in_thread(cache, load_stale, stale_results) for _ in xrange(3)]
+        self.assertTrue(self._wait_for(lambda: cache.stats['coalesced'] == 2))
+
+        # a write lands while that read is in flight, the next read must not join it
+        cache.invalidate('reservations')
+        fresh_results = []
+        fresh_readers = [self._get_in_thread(cache, load_fresh, fresh_results)]
+        self.assertTrue(self._wait_for(lambda: calls == ['stale', 'fresh']))
+
+        # the stale read finishing neither caches its result nor ends the fresh one
+        stale_gate.set()
+        for thread in stale_readers:
+            thread.join(2.0)
+        self.assertEqual(stale_results, ['stale'] * 3)
+
+        fresh_readers.append(self._get_in_thread(cache, load_fresh, fresh_results))
+        self.assertTrue(self._wait_for(lambda: cache.stats['coalesced'] == 3))
+
+        fresh_gate.set()
+        for thread in fresh_readers:
+            thread.join(2.0)
+        self.assertEqual(fresh_results, ['fresh'] * 2)
+
+        self.assertEqual(cache.get('reservations', self.fail, ttl=60), 'fresh')
+        self.assertEqual(calls, ['stale', 'fresh'])
+        self.assertEqual(cache.stats['hits'], 1)
+
+
+class HttpParkingClientTransportTest(unittest.TestCase):
+    def test_corrupt_body_is_not_retried_and_keeps_breaker_closed(self):
+        server = CountingServer(CorruptGzipHandler)
+        policy = RetryPolicy(retries=3, base_delay=0, failure_threshold=1)
+        client = HttpParkingClient('user', 'password', host=server.host, secure=False, retry_policy=policy)
+
+        try:
+            with self.assertRaises(httplib.HTTPException):
+                client._request(method='GET', url='/corrupt')
+
+            self.assertEqual(server.requests, ['/corrupt'])
+            self.assertEqual(policy.get_breaker(server.host).state, CircuitBreaker.STATE_CLOSED)
+        finally:
+            client.close()
+            server.stop()
+
+    def test_encoded_bodies_are_decoded_in_chunks(self):
+        server = CountingServer(EncodedHandler)
+        client = HttpParkingClient('user', 'password', host=server.host, secure=False)
+
+        try:
+            for url in ('/gzip', '/deflate', '/raw-deflate'):
+                response = client._request(method='GET', url=url)
+
+                self.assertEqual(response.body, EncodedHandler.BODY)
+                self.assertGreater(response.raw_size, HttpParkingClient.READ_CHUNK_SIZE)
+                self.assertLess(response.raw_size, len(EncodedHandler.BODY))
+        finally:
+            client.close()
+            server.stop()
+
+    def test_stalled_server_times_out_and_trips_breaker(self):
+        server = CountingServer(StalledHandler)
+        policy = RetryPolicy(retries=2, base_delay=0, failure_threshold=3)
+        client = HttpParkingClient('user', 'password', host=server.host, secure=False, retry_policy=policy,
+                                   timeout=0.1)
+
+        try:
+            started = time.time()
+            with self.assertRaises(socket.timeout):
+                client._request(method='GET', url='/stalled')
+            with self.assertRaises(RequestNotConfirmedError):
+                client._request(method='PUT', url='/stalled', params_json={})
+
+            self.assertLess(time.time() - started, 2.0)
+            self.assertEqual(policy.get_breaker(server.host).state, CircuitBreaker.STATE_OPEN)
+            with self.assertRaises(CircuitOpenError):
+                client._request(method='GET', url='/stalled')
+        finally:
+            client.close()
+            server.stop()
+
+    def _create_client(self, server):
+        policy = RetryPolicy(retries=3, base_delay=0)
+        return HttpParkingClient('user', 'password', host=server.host, secure=False, retry_policy=policy)
+
+    def test_lost_put_response_is_not_replayed(self):
+        server = CountingServer(LostResponseHandler)
+        client = self._create_client(server)
+
+        try:
+            # a kept-alive socket makes the failure look like a stale connection
+            client._request(method='GET', url='/warm')
+
+            with self.assertRaises(RequestNotConfirmedError):
+                client._request(method='PUT', url='/lost/start', params_json={})
+
+            self.assertEqual(server.requests.count(('PUT', '/lost/start')), 1)
+        finally:
+            client.close()
+            server.stop()
+
+    def test_lost_get_response_is_replayed(self):
+        server = CountingServer(LostResponseHandler)
+        client = self._create_client(server)
+
+        try:
+            client._request(method='GET', url='/warm')
+
+            self.assertEqual(client._request(method='GET', url='/lost/reservations').body, 'ok')
+            self.assertEqual(server.requests.count(('GET', '/lost/reservations')), 2)
+        finally:
+            client.close()
+            server.stop()
+
+
+class HttpParkingClientSessionTest(unittest.TestCase):
+    def _client_with_session(self, lifetime):
+        client = HttpParkingClient('user', 'password', session_ttl=1800.0, session_refresh_ahead=120.0)
+        client._session_started = time.time()
+        client._session_expires = client._session_started + lifetime
+        return client
+
+    def test_short_session_is_refreshed_halfway(self):
+        client = self._client_with_session(60.0)
+        self.assertFalse(client._is_session_expiring())
+
+        refresh_at = client._get_session_refresh_at(client._session_started, client._session_expires)
+        self.assertAlmostEqual(refresh_at - client._session_started, 30.0)
+
+    def test_expired_session_waits_minimum_interval(self):
+        client = self._client_with_session(-5.0)
+        self.assertFalse(client._is_session_expiring())
+
+        refresh_at = client._get_session_refresh_at(client._session_started, client._session_expires)
+        self.assertAlmostEqual(refresh_at - client._session_started, HttpParkingClient.SESSION_MIN_REFRESH_INTERVAL)
+
+    def test_long_session_uses_refresh_ahead(self):
+        client = self._client_with_session(1800.0)
+
+        refresh_at = client._get_session_refresh_at(client._session_started, client._session_expires)
+        self.assertAlmostEqual(client._session_expires - refresh_at, 120.0)
+
+    def _get_concurrently(self, client, count=8):
+        errors = []
+
+        def get():
+            try:
+                client._get_json(HttpParkingClient.URL_RESERVATIONS)
+            except Exception, e:
+                errors.append(e)
+
+        threads = [Thread(target=get) for _ in xrange(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+
+    def test_expired_session_is_renewed_once(self):
+        server = FakeParkingServer(FakeParkingState('user', 'password'), latency=0.05)
+        server.start()
+        client = server.create_client('user', 'password')
+        try:
+            client.login()
+            client._session_started -= 7200.0
+            client._session_expires -= 7200.0
+
+            self._get_concurrently(client)
+            self.assertEqual(len(server.state._sessions), 2)
+        finally:
+            client.close()
+            server.stop()
+
+    def test_rejected_session_is_replaced_once(self):
+        server = FakeParkingServer(FakeParkingState('user', 'password'), latency=0.05)
+        server.start()
+        client = server.create_client('user', 'password')
+        try:
+            client.login()
+            server.state.expire_sessions()
+
+            self._get_concurrently(client)
+            self.assertEqual(len(server.state._sessions), 1)
+        finally:
+            client.close()
+            server.stop()
+
+    def test_malformed_stored_session_is_a_miss(self):
+        store = parking.MemorySessionStore()
+        client = HttpParkingClient('user', 'password', session_store=store)
+
+        for session in ({'cookie': 'sid=1'}, {'expires': 'soon', 'cookie': 'sid=1', 'user_info': None}, []):
+            store._sessions[client._session_key] = session
+            client._session_restored = False
+            self.assertFalse(client._restore_session())
+            self.assertFalse(client.is_login_ok)
+
+
+class ParkingMonitorTest(unittest.TestCase):
+    def setUp(self):
+        state = FakeParkingState('user', 'password')
+        # a frozen backend clock keeps remaining minutes exact between polls
+        now = int(time.time() * 1000)
+        state._now_ms = lambda: now
+
+        self.server = FakeParkingServer(state)
+        self.server.start()
+        self.client = self.server.create_client('user', 'password')
+        self.monitor = ParkingMonitor(self.client)
+
+        self.events = []
+        self.monitor.add_on_new_reservation_event(lambda vehicle, zone: self.events.append(('new', vehicle, zone)))
+        self.monitor.add_on_remove_reservation_event(
+            lambda vehicle, zone: self.events.append(('remove', vehicle, zone)))
+        self.monitor.add_on_remain_changed_event(
+            lambda vehicle, zone, remain: self.events.append(('remain', vehicle, zone, remain)))
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def _poll(self):
+        del self.events[:]
+        return dict(((reservation.vrp, reservation.zone), reservation)
+                    for reservation in self.monitor.measure_one_shot())
+
+    def test_new_changed_and_removed_reservations(self):
+        self.client.start_reservation(vehicle='A001AA', zone=101, duration=60)
+        self._poll()
+        self.assertEqual(self.events, [('new', 'A001AA', 101), ('remain', 'A001AA', 101, 60)])
+
+        self.client.start_reservation(vehicle='B002BB', zone=102, duration=45)
+        reservations = self._poll()
+        self.assertEqual(self.events, [('new', 'B002BB', 102), ('remain', 'B002BB', 102, 45)])
+
+        # nothing changed, nothing is reported
+        self._poll()
+        self.assertEqual(self.events, [])
+
+        self.client.renew_reservation(reservations['A001AA', 101], 30)
+        reservations = self._poll()
+        self.assertEqual(self.events, [('remain', 'A001AA', 101, 90)])
+
+        self.client.stop_reservation(reservations['B002BB', 102])
+        self._poll()
+        self.assertEqual(self.events, [('remove', 'B002BB', 102)])
+        self.assertEqual(self.monitor.observed, {('A001AA', 101): 90})
+
+    def test_reappearing_reservation_is_new_again(self):
+        self.client.start_reservation(vehicle='A001AA', zone=101, duration=60)
+        reservation = self._poll()['A001AA', 101]
+
+        self.client.stop_reservation(reservation)
+        self._poll()
+        self.assertEqual(self.events, [('remove', 'A001AA', 101)])
+
+        self.client.start_reservation(vehicle='A001AA', zone=101, duration=30)
+        self._poll()
+        self.assertEqual(self.events, [('new', 'A001AA', 101), ('remain', 'A001AA', 101, 30)])
+
+    def test_duplicate_plate_and_zone_report_the_longest(self):
+        self.client.start_reservation(vehicle='A001AA', zone=101, duration=30)
+        short = self._poll()['A001AA', 101]
+
+        self.client.start_reservation(vehicle='A001AA', zone=101, duration=90)
+        self._poll()
+        self.assertEqual(self.events, [('remain', 'A001AA', 101, 90)])
+
+        # one of the two ending is not a removal while the other one still runs
+        self.client.stop_reservation(short)
+        self._poll()
+        self.assertEqual(self.events, [])
+
+
+class MonitorFanoutServerTest(unittest.TestCase):
+    def setUp(self):
+        monitor = ParkingMonitor(HttpParkingClient('user', 'password'))
+        self.server = MonitorFanoutServer(monitor, address=('127.0.0.1', 0), poll_timeout=0.1)
+        self.thread = Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _poll_status(self, timeout):
+        connection = httplib.HTTPConnection('127.0.0.1', self.server.server_address[1], timeout=5)
+        try:
+            connection.request('GET', '/poll?timeout=' + timeout)
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        finally:
+            connection.close()
+
+    def test_invalid_timeout_is_rejected(self):
+        for timeout in ('abc', 'nan', 'inf', '-1'):
+            self.assertEqual(self._poll_status(timeout), 400)
+
+    def test_long_timeout_is_clamped(self):
+        started = time.time()
+        self.assertEqual(self._poll_status('1e9'), 200)
+        self.assertLess(time.time() - started, 2.0)
+
+
+class MonitorFanoutServerPollingTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = FakeParkingServer(FakeParkingState('user', 'password'))
+        self.backend.start()
+        self.client = self.backend.create_client('user', 'password')
+        self.monitor = ParkingMonitor(self.client)
+        self.server = MonitorFanoutServer(self.monitor, address=('127.0.0.1', 0), update_interval=60.0,
+                                          keepalive_interval=0.05)
+
+    def tearDown(self):
+        self.client.close()
+        self.backend.stop()
+
+    def test_published_events_do_not_trigger_polls(self):
+        polls = []
+        self.monitor.add_on_poll_event(polls.append)
+        self.server.start()
+        try:
+            while not polls:
+                time.sleep(0.01)
+
+            # another consumer polls the same monitor, its events reach subscribers but not the poll loop
+            self.client.start_reservation(vehicle='A001AA', zone=101, duration=60)
+            self.monitor.measure_one_shot()
+            self.assertEqual(self.server.wait_events(since=0, timeout=1.0)['events'][0]['event'],
+                             MonitorFanoutServer.EVENT_NEW)
+
+            time.sleep(0.2)
+            self.assertEqual(len(polls), 2)
+        finally:
+            self.server.stop()
+
+    def test_stop_with_open_event_streams_is_quiet(self):
+        self.server.start()
+
+        streams = []
+        for _ in xrange(3):
+            stream = socket.create_connection(self.server.server_address)
+            stream.sendall('GET /events HTTP/1.1\r\nHost: localhost\r\n\r\n')
+            streams.append(stream)
+        time.sleep(0.2)
+
+        stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+        try:
+            for stream in streams:
+                # reset instead of closing gracefully, like a client that went away
+                stream.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+                stream.close()
+            self.server.stop()
+            time.sleep(0.2)
+
+            self.assertEqual(sys.stderr.getvalue(), '')
+        finally:
+            sys.stderr = stderr
+
+
+class ReservationHistoryStoreTest(unittest.TestCase):
+    def _row(self, vrp, end):
+        return {'id': 1, 'account': None, 'vrp': vrp, 'zone': 100, 'vehicleType': 'car', 'renewed': False,
+                'start': 1000.0, 'end': end, 'remaining_second': 0}
+
+    def test_same_id_from_different_sources(self):
+        store = ReservationHistoryStore(':memory:')
+        try:
+            store._write_batch([('poll', (1000.0, 'a', [self._row('A001AA', 2000.0)])),
+                                ('poll', (1000.0, 'b', [self._row('B002BB', 3000.0)]))])
+            store._write_batch([('poll', (1500.0, 'a', [self._row('A001AA', 2500.0)])),
+                                ('poll', (1600.0, 'b', []))])
+
+            reservations = dict((row['source'], row) for row in store.get_reservations())
+            self.assertEqual(sorted(reservations), ['a', 'b'])
+            self.assertEqual((reservations['a']['end'], reservations['a']['last_seen']), (2500.0, None))
+            self.assertEqual((reservations['b']['end'], reservations['b']['last_seen']), (3000.0, 1600.0))
+        finally:
+            store.close()
+
+    def test_reappearing_reservation_is_active_again(self):
+        store = ReservationHistoryStore(':memory:')
+        try:
+            store._write_batch([('poll', (1000.0, 'a', [self._row('A001AA', 2000.0)]))])
+            store._write_batch([('poll', (1100.0, 'a', []))])
+            store._write_batch([('poll', (1200.0, 'a', [self._row('A001AA', 2600.0)]))])
+
+            reservation, = store.get_reservations()
+            self.assertEqual((reservation['end'], reservation['first_seen'], reservation['last_seen']),
+                             (2600.0, 1000.0, None))
+
+            # tracked as active again, so it can disappear a second time
+            store._write_batch([('poll', (1300.0, 'a', []))])
+            self.assertEqual(store.get_reservations()[0]['last_seen'], 1300.0)
+        finally:
+            store.close()
+
+
+class ParkingDaemonTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.directory, 'parking.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_socket_is_private_and_not_stolen(self):
+        daemon = ParkingDaemon(HttpParkingClient('user', 'password'), socket_path=self.socket_path)
+        try:
+            self.assertEqual(stat.S_IMODE(os.stat(self.socket_path).st_mode), 0600)
+            self.assertRaises(Exception, ParkingDaemon, HttpParkingClient('user', 'password'),
+                              socket_path=self.socket_path)
+            self.assertTrue(os.path.exists(self.socket_path))
+        finally:
+            daemon.server_close()
+
+        # the path outlives the closed daemon and is taken over as stale
+        ParkingDaemon(HttpParkingClient('user', 'password'), socket_path=self.socket_path).server_close()
+
+    def _run_cli(self, *argv):
+        server = FakeParkingServer(FakeParkingState('user', 'password'))
+        server.start()
+        client = server.create_client('user', 'password')
+        daemon = ParkingDaemon(client, socket_path=self.socket_path)
+        daemon.start()
+
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO.StringIO(), StringIO.StringIO()
+        try:
+            client.start_reservation(vehicle=u'А123ВЕ59', zone=101, duration=60)
+            try:
+                parking.main(['--socket', self.socket_path] + list(argv))
+                code = 0
+            except SystemExit, e:
+                code = e.code
+
+            return code, sys.stdout.getvalue(), sys.stderr.getvalue()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+            daemon.shutdown()
+            daemon.server_close()
+            client.close()
+            server.stop()
+
+    def test_missing_reservation_error_keeps_plate(self):
+        code, output, errors = self._run_cli('stop', 'А111ВЕ59', '101')
+
+        self.assertEqual(code, 1)
+        self.assertIn('А111ВЕ59', errors)
+
+    def test_renew_prints_confirmation(self):
+        code, output, errors = self._run_cli('renew', 'А123ВЕ59', '101', '--duration', '30')
+
+        self.assertEqual((code, errors), (0, ''))
+        self.assertTrue(json.loads(output)['reservation']['renewed'])
+
+
+class PriceQuoteEngineTest(unittest.TestCase):
+    OBJECTS = [
+        {'number': 101, 'prices': [{'vehicleType': 'car', 'price': 60}, {'vehicleType': 'truck', 'price': 120}]},
+        {'number': 102, 'prices': [{'vehicleType': 'car', 'price': 0}]},
+        {'number': 103, 'prices': [{'vehicleType': 'car', 'price': 30}]}
+    ]
+
+    def _results(self):
+        engine = PriceQuoteEngine(ZoneCatalog(loader=lambda: PriceQuoteEngineTest.OBJECTS), balance_loader=lambda: 90)
+
+        return [engine.get_prices(vehicle_type='truck'),
+                engine.cost_matrix([30, 60], vehicle_type='truck'),
+                engine.quote([(101, 'car', 30), (102, 'truck', 60), (999, 'car', 60)]),
+                engine.quote([]),
+                engine.cheapest_zones(60, count=2),
+                engine.max_durations(),
+                engine.max_durations(vehicle_type='truck'),
+                engine.fit_budget([(101, 'car', 120), (103, 'car', 60), (102, 'truck', 60)])]
+
+    def test_lists_with_none_for_unsold(self):
+        self.assertEqual(self._results(), [
+            ([101, 102, 103], [120.0, None, None]),
+            ([101, 102, 103], [[60.0, 120.0], [None, None], [None, None]]),
+            [30.0, None, None],
+            [],
+            [(102, 0.0), (103, 30.0)],
+            ([101, 102, 103], [90, float('inf'), 180]),
+            ([101, 102, 103], [45, None, None]),
+            ([120.0, 30.0, None], [False, True, False])
+        ])
+
+    def test_numpy_and_list_paths_agree(self):
+        if parking.numpy is None:
+            self.skipTest('numpy is not installed')
+
+        with_numpy = self._results()
+        numpy_module, parking.numpy = parking.numpy, None
+        try:
+            self.assertEqual(self._results(), with_numpy)
+        finally:
+            parking.numpy = numpy_module
+
+
+class ZoneSpatialIndexTest(unittest.TestCase):
+    # fakeserver zones are 0.0035 degree squares on a 0.004 degree grid, zone 101 starts at lon 56.22, lat 58.0
+    def setUp(self):
+        self.objects = FakeParkingState('user', 'password', zones=30).get_zones()
+        self.index = ZoneSpatialIndex()
+        self.index.update(self.objects)
+
+    def _brute_force_within(self, lat, lon, radius):
+        scale_lon = self.index._get_lon_scale(lat)
+        found = [(self.index._distance(zone, lon, lat, scale_lon), zone) for zone in self.index.zones]
+        return [(zone, distance) for distance, zone in sorted(found) if distance <= radius]
+
+    def test_point_in_zone(self):
+        self.assertEqual(self.index.point_in_zone(58.00175, 56.22175), [101])
+        self.assertEqual(self.index.point_in_zone(58.00175 + 0.004, 56.22175 + 0.004), [112])
+        self.assertEqual(self.index.point_in_zone(58.00175, 56.22375), [])
+        self.assertEqual(self.index.point_in_zone(10.0, 10.0), [])
+
+    def test_nearest_zone(self):
+        zone, distance = self.index.nearest_zone(58.00175, 56.2236)
+        self.assertEqual(zone, 101)
+        self.assertAlmostEqual(distance, 0.0001 * self.index._get_lon_scale(58.00175), places=3)
+
+        self.assertEqual(self.index.nearest_zone(58.00175, 56.22175), (101, 0.0))
+        self.assertEqual(self.index.nearest_zone(58.5, 56.22175)[0], 121)
+        self.assertIsNone(self.index.nearest_zone(58.5, 56.22175, max_distance=1000.0))
+
+    def test_zones_within(self):
+        for radius in (0.0, 300.0, 1000.0):
+            self.assertEqual(self.index.zones_within(58.00175, 56.22175, radius),
+                             self._brute_force_within(58.00175, 56.22175, radius))
+
+        self.assertEqual(self.index.zones_within(58.00175, 56.22175, 0.0), [(101, 0.0)])
+        self.assertEqual(self.index.zones_within(58.5, 56.22175, 1000.0), [])
+
+    def test_zones_within_huge_radius_is_clipped(self):
+        started = time.time()
+        found = self.index.zones_within(58.00175, 56.22175, 2000000.0)
+
+        self.assertLess(time.time() - started, 1.0)
+        self.assertEqual(sorted(zone for zone, _ in found), self.index.zones)
+
+    def test_update_reindexes_changed_zones_only(self):
+        unchanged = self.index._shapes[103]
+        moved = dict(self.objects[0], location={'type': 'Point', 'coordinates': [56.5, 58.5]})
+
+        self.index.update([moved] + [obj for obj in self.objects[2:]])
+
+        self.assertIs(self.index._shapes[103], unchanged)
+        self.assertNotIn(102, self.index.zones)
+        self.assertFalse(any(102 in zones for zones in self.index._cells.values()))
+        self.assertEqual(self.index.point_in_zone(58.00175, 56.22175), [])
+        self.assertEqual(self.index.nearest_zone(58.5, 56.5), (101, 0.0))
+        self.assertEqual(self.index.zones_within(58.5, 56.5, 100.0), [(101, 0.0)])
+
+
+class FederatedParkingClientTest(unittest.TestCase):
+    def setUp(self):
+        self.servers = dict((host, FakeParkingServer(FakeParkingState('user', 'password')))
+                            for host in ('perm', 'kazan'))
+        for server in self.servers.values():
+            server.start()
+            server.state.start_reservation(vehicle=u'А123ВЕ59', zone=101, duration=60)
+
+        self.client = FederatedParkingClient(dict((host, server.create_client('user', 'password'))
+                                                  for host, server in self.servers.items()))
+
+    def tearDown(self):
+        for host in self.client.hosts:
+            self.client.get_client(host).close()
+        for server in self.servers.values():
+            server.stop()
+
+    def test_monitor_keeps_cities_apart(self):
+        monitor = ParkingMonitor(self.client)
+        events = []
+        monitor.add_on_new_reservation_event(lambda vehicle, zone: events.append(('new', vehicle, zone)))
+        monitor.add_on_remove_reservation_event(lambda vehicle, zone: events.append(('remove', vehicle, zone)))
+
+        monitor.measure_one_shot()
+        self.assertEqual(events, [('new', u'А123ВЕ59', 101)] * 2)
+
+        self.servers['kazan'].state.cancel_reservation(1)
+        self.client.get_client('kazan')._invalidate_account_cache()
+        del events[:]
+
+        monitor.measure_one_shot()
+        self.assertEqual(events, [('remove', u'А123ВЕ59', 101)])
+        self.assertEqual(monitor.observed.keys(), [(u'А123ВЕ59', 101, 'perm')])
+
+
+class RecordingNotifyBackend(NotifyBackend):
+    def __init__(self):
+        super(RecordingNotifyBackend, self).__init__()
+        self.texts = []
+
+    def send(self, text):
+        self.texts.append(text)
+
+
+class GatedNotifyBackend(RecordingNotifyBackend):
+    def __init__(self):
+        super(GatedNotifyBackend, self).__init__()
+        self.gate = Event()
+
+    def send(self, text):
+        self.gate.wait()
+        super(GatedNotifyBackend, self).send(text)
+
+
+class RecordingSMSClient(SMSClient):
+    def __init__(self):
+        super(RecordingSMSClient, self).__init__(api_id='test')
+        self.calls = []
+
+    def send(self, to, text):
+        self.calls.append((sorted(to), text))
+        return SMSClient.RESPONSE_SENT
+
+
+class SMSDeliveryTest(unittest.TestCase):
+    def test_backend_sends_synchronously_by_default(self):
+        sms_client = RecordingSMSClient()
+        backend = SMSNotifyBackend(sms_client=sms_client, recipients=['79220000001', '79220000002'])
+
+        backend.send('hello')
+        self.assertEqual(sms_client.calls, [(['79220000001', '79220000002'], 'hello')])
+
+    def test_queue_coalesces_texts_per_recipient(self):
+        sms_client = RecordingSMSClient()
+        queue = SMSDeliveryQueue(sms_client=sms_client, coalesce_window=0.2)
+        backend = SMSNotifyBackend(sms_client=sms_client, recipients=['1', '2'], delivery_queue=queue)
+
+        backend.send('first')
+        backend.send('second')
+        queue.put(['3'], 'third')
+        time.sleep(0.5)
+
+        self.assertEqual(sorted(sms_client.calls), [(['1', '2'], 'first\nsecond'), (['3'], 'third')])
+        self.assertEqual(queue.stats['api_calls'], 2)
+        self.assertEqual(queue.stats['sent'], 3)
+        queue.stop()
+
+    def test_stop_flushes_pending_batches(self):
+        sms_client = RecordingSMSClient()
+        queue = SMSDeliveryQueue(sms_client=sms_client, coalesce_window=60.0)
+        queue.start()
+
+        queue.put(['1'], 'pending')
+        queue.stop()
+
+        self.assertEqual(sms_client.calls, [(['1'], 'pending')])
+        self.assertEqual(queue.stats['pending'], 0)
+
+
+class BackendDispatchQueueTest(unittest.TestCase):
+    def _wait_for(self, predicate, timeout=2.0):
+        deadline = time.time() + timeout
+        while not predicate() and time.time() < deadline:
+            time.sleep(0.01)
+        return predicate()
+
+    def test_drop_oldest(self):
+        backend = RecordingNotifyBackend()
+        queue = BackendDispatchQueue(backend, max_size=2, overflow=BackendDispatchQueue.OVERFLOW_DROP_OLDEST)
+        for text in ('a', 'b', 'c'):
+            queue.put(text)
+
+        queue.start()
+        queue.stop(wait=True)
+
+        self.assertEqual(backend.texts, ['b', 'c'])
+        self.assertEqual((queue.stats['sent'], queue.stats['dropped']), (2, 1))
+
+    def test_coalesce(self):
+        backend = RecordingNotifyBackend()
+        queue = BackendDispatchQueue(backend, max_size=2, overflow=BackendDispatchQueue.OVERFLOW_COALESCE)
+        for text in ('a', 'b', 'c', 'd'):
+            queue.put(text)
+
+        queue.start()
+        queue.stop(wait=True)
+
+        self.assertEqual(backend.texts, ['a', 'b\nc\nd'])
+        self.assertEqual((queue.stats['sent'], queue.stats['coalesced']), (2, 2))
+
+    def _block_put(self, queue):
+        queue.start()
+        queue.put('a')
+        self.assertTrue(self._wait_for(lambda: queue.stats['backlog'] == 0))
+        queue.put('b')
+
+        # the worker is stuck on 'a' and 'b' fills the queue
+        blocked = Thread(target=queue.put, args=('c', ))
+        blocked.daemon = True
+        blocked.start()
+        blocked.join(0.2)
+        self.assertTrue(blocked.is_alive())
+
+        return blocked
+
+    def test_block_waits_for_room(self):
+        backend = GatedNotifyBackend()
+        queue = BackendDispatchQueue(backend, max_size=1, overflow=BackendDispatchQueue.OVERFLOW_BLOCK)
+        blocked = self._block_put(queue)
+
+        backend.gate.set()
+        blocked.join(2.0)
+        self.assertFalse(blocked.is_alive())
+
+        queue.stop(wait=True)
+        self.assertEqual(backend.texts, ['a', 'b', 'c'])
+        self.assertEqual(queue.stats['dropped'], 0)
+
+    def test_stop_releases_blocked_put(self):
+        backend = GatedNotifyBackend()
+        queue = BackendDispatchQueue(backend, max_size=1, overflow=BackendDispatchQueue.OVERFLOW_BLOCK)
+        blocked = self._block_put(queue)
+
+        # the poll thread must not hang on a backend that stopped consuming
+        queue.stop()
+        blocked.join(2.0)
+        self.assertFalse(blocked.is_alive())
+
+        # what was accepted before stop is still delivered
+        backend.gate.set()
+        self.assertTrue(self._wait_for(lambda: len(backend.texts) == 3))
+        self.assertEqual(backend.texts, ['a', 'b', 'c'])
+
+
+class ParkingMonitorNotifierTest(unittest.TestCase):
+    def test_denied_remove_still_resets_remain_stages(self):
+        remain_filter = RemainStageNotifyFilter()
+        remain_filter.add_remain_stage(5)
+        notifier = ParkingMonitorNotifier(monitor=None, notify_backend=[], formatter=NotifyFormatterRussian(),
+                                          message_filter=[SimpleNotifyFilter(deny_remove=True), remain_filter])
+
+        self.assertTrue(remain_filter.remain_filter(u'А123ВЕ59', 101, 5))
+        notifier._on_remove_reservation(u'А123ВЕ59', 101)
+
+        self.assertEqual(remain_filter._states, {})
+        self.assertTrue(remain_filter.remain_filter(u'А123ВЕ59', 101, 5))
+
+    def test_fleet_accounts_keep_separate_state_and_messages(self):
+        remain_filter = RemainStageNotifyFilter()
+        remain_filter.add_remain_stage(5)
+        backend = RecordingNotifyBackend()
+        notifier = ParkingMonitorNotifier(monitor=None, notify_backend=backend, formatter=NotifyFormatterRussian(),
+                                          message_filter=[remain_filter])
+        fleet = ParkingFleetMonitor(workers=1)
+        notifier.attach_fleet(fleet)
+
+        for account in ('first', 'second'):
+            fleet._try_invoke_notify_handlers(fleet._remain_changed_handlers, account, 'A123BE59', 101, 5)
+        fleet._try_invoke_notify_handlers(fleet._remove_reservation_handlers, 'first', 'A123BE59', 101)
+
+        self.assertEqual([text.split(':')[0] for text in backend.texts], ['first', 'second', 'first'])
+        self.assertEqual(remain_filter._states.keys(), [('second', 'A123BE59', 101)])
+
+    def test_federation_is_monitored_per_host(self):
+        federated = FederatedParkingClient({'perm': HttpParkingClient('user', 'password', host='perm.local'),
+                                            'kazan': HttpParkingClient('user', 'password', host='kazan.local')})
+        fleet = ParkingFleetMonitor(workers=1)
+
+        fleet.add_federation(federated)
+        self.assertEqual(sorted(fleet.accounts), ['kazan', 'perm'])
+        self.assertIs(fleet.get_monitor('perm')._client, federated.get_client('perm'))
+
+
+if __name__ == '__main__':
+    unittest.main()